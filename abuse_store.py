@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+濫用記錄模塊 - 持久化的封禁名單和可疑分數，機器人進程和 API 服務共用同一個追加日誌文件
+
+- 鍵帶命名空間: user:<Telegram ID>、ip:<地址>、device:<設備 ID>、code:<激活碼>
+- 封禁帶有效期（0 表示永久），到期後自動失效
+- 可疑分數按半衰期指數衰減，超過閾值時自動封禁；分數記錄數有上限，超出時淘汰最久未更新的
+- 檢查和記錄只讀寫內存（O(1)），不做文件 IO；記錄產生的事件由後台線程追加到日誌（JSON Lines），
+  後台線程同時讀取其他進程追加的事件
+- 日誌過長時由後台線程在文件排他鎖內替換為當前狀態的快照，其他進程發現文件被替換後重新加載
+"""
+
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:  # Windows 沒有 fcntl，只保證單進程內的一致性
+    HAS_FCNTL = False
+
+logger = logging.getLogger(__name__)
+
+class AbuseStore:
+    """共享濫用記錄"""
+
+    SCORE_FLOOR = 0.05        # 衰減到此值以下的分數在壓縮時清除
+    COMPACT_MIN_LINES = 5000  # 日誌行數超過此值且超過記錄數兩倍時壓縮
+
+    def __init__(self, store_file: str = 'abuse_store.jsonl', half_life: float = 3600.0,
+                 ban_threshold: float = 10.0, ban_seconds: float = 86400.0, reload_interval: float = 5.0,
+                 max_keys: int = 20000):
+        self.store_file = store_file
+        self.lock_file = f"{store_file}.lock"
+        self.half_life = half_life
+        self.ban_threshold = ban_threshold
+        self.ban_seconds = ban_seconds
+        self.reload_interval = reload_interval
+        self.max_keys = max_keys
+        self.source = f"{os.getpid()}-{os.urandom(4).hex()}"  # 區分本實例寫入的事件
+
+        self.lock = threading.Lock()
+        self.bans: Dict[str, Dict] = {}              # {鍵: {'until': 到期時間戳（0 為永久）, 'reason': 原因}}
+        self.scores: OrderedDict = OrderedDict()     # {鍵: [分數, 更新時間戳]}，按最近更新排序
+        self.pending: List[Dict] = []                # 已應用到內存、尚未寫入日誌的事件
+
+        # 日誌讀取位置（文件被替換時 inode 改變，從頭重新加載）
+        self.offset = 0
+        self.inode = None
+        self.lines = 0
+
+        self.stats = {
+            'checks': 0,
+            'blocked': 0,
+            'reloads': 0,
+            'compactions': 0,
+            'evicted': 0
+        }
+
+        self._read_new()
+        self.closed = False
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='abuse-store', daemon=True)
+        self.thread.start()
+
+    # 內存狀態（在 self.lock 內調用）
+
+    def _decay(self, score: float, seconds: float) -> float:
+        return score * 0.5 ** (max(0.0, seconds) / self.half_life)
+
+    def _decayed(self, entry: list, now: float) -> float:
+        return self._decay(entry[0], now - entry[1])
+
+    def _add_points(self, key: str, points: float, at: float) -> float:
+        """按事件時間累加分數（事件亂序到達時結果相同），返回更新後的分數"""
+        entry = self.scores.pop(key, None)
+        if entry is None:
+            entry = [points, at]
+        elif at >= entry[1]:
+            entry = [self._decay(entry[0], at - entry[1]) + points, at]
+        else:
+            entry = [entry[0] + self._decay(points, entry[1] - at), entry[1]]
+        self.scores[key] = entry  # 重新插入，保持按最近更新排序
+        while len(self.scores) > self.max_keys:
+            self.scores.popitem(last=False)
+            self.stats['evicted'] += 1
+        return entry[0]
+
+    def _apply(self, event: Dict):
+        op, key = event.get('op'), event.get('key')
+        if not key:
+            return
+        if op == 'score':
+            self._add_points(key, event['points'], event['at'])
+        elif op == 'set':
+            self.scores.pop(key, None)
+            self.scores[key] = [event['score'], event['at']]
+        elif op == 'ban':
+            until = event.get('until', 0)
+            current = self.bans.get(key)
+            # 同一個鍵的多次封禁取最長的
+            if current and (not current['until'] or (until and until <= current['until'])):
+                return
+            self.bans[key] = {'until': until, 'reason': event.get('reason', '')}
+        elif op == 'unban':
+            self.bans.pop(key, None)
+            self.scores.pop(key, None)
+
+    def _record(self, event: Dict):
+        """應用事件並交給後台線程寫入日誌"""
+        self._apply(event)
+        event['src'] = self.source
+        self.pending.append(event)
+        self.wakeup.set()
+
+    def _active_ban(self, key: str, now: float) -> Optional[Dict]:
+        ban = self.bans.get(key)
+        if ban and (not ban['until'] or ban['until'] > now):
+            return ban
+        return None
+
+    def _prune(self, now: float):
+        for key in [key for key, ban in self.bans.items() if ban['until'] and ban['until'] <= now]:
+            del self.bans[key]
+        for key in [key for key, entry in self.scores.items() if self._decayed(entry, now) < self.SCORE_FLOOR]:
+            del self.scores[key]
+
+    # 日誌文件（只在後台線程和構造函數中調用）
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        """跨進程文件鎖: 追加和讀取用共享鎖，壓縮替換文件用排他鎖"""
+        if not HAS_FCNTL:
+            yield
+            return
+        with open(self.lock_file, 'a') as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+    def _append(self, events: List[Dict]):
+        if not events:
+            return
+        data = ''.join(json.dumps(event, ensure_ascii=False) + '\n' for event in events).encode('utf-8')
+        try:
+            # O_APPEND 單次寫入，多個進程同時追加時行不會交錯
+            fd = os.open(self.store_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.error(f"❌ 寫入濫用記錄失敗: {e}")
+            with self.lock:
+                self.pending[:0] = events  # 下一輪重試
+
+    def _read_new(self):
+        """讀取日誌新增的事件；文件被其他進程壓縮替換後從頭重新加載"""
+        try:
+            stat = os.stat(self.store_file)
+        except FileNotFoundError:
+            return
+        reload = stat.st_ino != self.inode or stat.st_size < self.offset
+        offset = 0 if reload else self.offset
+        if stat.st_size == offset and not reload:
+            return
+
+        events = []
+        try:
+            with open(self.store_file, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # 寫入中的行，下次再讀
+                    offset += len(line)
+                    try:
+                        events.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        logger.warning(f"⚠️ 濫用記錄 {self.store_file} 中有無效記錄")
+        except IOError as e:
+            logger.warning(f"⚠️ 加載濫用記錄失敗: {e}")
+            return
+
+        with self.lock:
+            if reload:
+                # 重新加載包括本實例已寫入的事件，再應用尚未寫入的事件
+                self.bans, self.scores = {}, OrderedDict()
+                for event in events:
+                    self._apply(event)
+                for event in self.pending:
+                    self._apply(event)
+                self.lines = len(events)
+                self.stats['reloads'] += 1
+            else:
+                for event in events:
+                    if event.get('src') != self.source:
+                        self._apply(event)
+                self.lines += len(events)
+            self.inode = stat.st_ino
+            self.offset = offset
+
+    def _compact(self):
+        """把日誌替換為當前狀態的快照（在文件排他鎖內、讀取全部事件後調用）"""
+        now = time.time()
+        with self.lock:
+            self._prune(now)
+            self.pending = []  # 尚未寫入的事件已包含在內存狀態中
+            events = ([{'op': 'ban', 'key': key, 'until': ban['until'], 'reason': ban['reason']}
+                       for key, ban in self.bans.items()] +
+                      [{'op': 'set', 'key': key, 'score': entry[0], 'at': entry[1]}
+                       for key, entry in self.scores.items()])
+
+        temp_file = f"{self.store_file}.tmp.{os.getpid()}"
+        try:
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(event, ensure_ascii=False) + '\n' for event in events)
+            os.replace(temp_file, self.store_file)
+            stat = os.stat(self.store_file)
+        except OSError as e:
+            logger.error(f"❌ 壓縮濫用記錄失敗: {e}")
+            return
+        self.inode, self.offset, self.lines = stat.st_ino, stat.st_size, len(events)
+        self.stats['compactions'] += 1
+
+    def _needs_compaction(self) -> bool:
+        return self.lines > max(self.COMPACT_MIN_LINES, 2 * (len(self.scores) + len(self.bans)))
+
+    def _sync(self):
+        """寫入待寫事件並讀取其他進程的新事件，日誌過長時壓縮"""
+        if self._needs_compaction():
+            with self._file_lock(exclusive=True):
+                self._read_new()
+                self._compact()
+            return
+        with self._file_lock(exclusive=False):
+            with self.lock:
+                events, self.pending = self.pending, []
+            self._append(events)
+            self._read_new()
+
+    def _run(self):
+        while True:
+            closed = self.closed  # 關閉後再同步一輪，寫入剩餘事件
+            self.wakeup.wait(self.reload_interval)
+            self.wakeup.clear()
+            try:
+                self._sync()
+            except Exception as e:
+                logger.error(f"❌ 同步濫用記錄失敗: {e}")
+            if closed:
+                return
+
+    def close(self):
+        """寫入剩餘事件並停止後台線程"""
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join(timeout=5)
+
+    # 分數
+
+    def score(self, key: str) -> float:
+        """當前（衰減後的）可疑分數"""
+        entry = self.scores.get(key)
+        return self._decayed(entry, time.time()) if entry else 0.0
+
+    def add_score(self, key: str, points: float = 1.0, reason: str = '') -> float:
+        """增加可疑分數，超過閾值時封禁，返回新分數"""
+        now = time.time()
+        banned = False
+        with self.lock:
+            self._record({'op': 'score', 'key': key, 'points': points, 'at': now})
+            score = self._decayed(self.scores[key], now)
+            if score > self.ban_threshold and not self._active_ban(key, now):
+                self._record({'op': 'ban', 'key': key, 'until': now + self.ban_seconds if self.ban_seconds else 0,
+                              'reason': f"可疑分數 {score:.1f}: {reason}"})
+                banned = True
+        if banned:
+            logger.warning(f"🚫 {key} 可疑分數 {score:.1f} 超過閾值，封禁 {self.ban_seconds / 3600:.0f} 小時")
+        return score
+
+    # 封禁
+
+    def ban(self, key: str, seconds: Optional[float] = None, reason: str = ''):
+        """封禁（seconds 為 None 時使用默認時長，0 為永久）"""
+        duration = self.ban_seconds if seconds is None else seconds
+        with self.lock:
+            self._record({'op': 'ban', 'key': key, 'until': time.time() + duration if duration else 0,
+                          'reason': reason})
+        logger.warning(f"🚫 已封禁 {key}（{'永久' if not duration else f'{duration / 3600:.1f} 小時'}）: {reason}")
+
+    def unban(self, key: str):
+        with self.lock:
+            self._record({'op': 'unban', 'key': key})
+
+    def is_banned(self, key: str) -> bool:
+        """O(1) 檢查是否處於封禁中（只讀內存）"""
+        self.stats['checks'] += 1
+        if self._active_ban(key, time.time()):
+            self.stats['blocked'] += 1
+            return True
+        return False
+
+    def any_banned(self, *keys: Optional[str]) -> bool:
+        """任一鍵處於封禁中（忽略空鍵）"""
+        return any(self.is_banned(key) for key in keys if key)
+
+    # 查看
+
+    def recent_scores(self, n: int) -> List[Tuple[str, float]]:
+        """最近更新的 n 個可疑分數（最新在前）"""
+        now = time.time()
+        with self.lock:
+            return [(key, self._decayed(entry, now))
+                    for key, entry in itertools.islice(reversed(self.scores.items()), n)]
+
+    def get_stats(self) -> Dict:
+        now = time.time()
+        with self.lock:
+            banned = sum(1 for ban in self.bans.values() if not ban['until'] or ban['until'] > now)
+            scored = len(self.scores)
+            pending = len(self.pending)
+        return {
+            'banned': banned,
+            'scored': scored,
+            'pending_writes': pending,
+            **self.stats
+        }
@@ -4,14 +4,15 @@
 激活碼管理模塊
 """
 
+import asyncio
 import random
 import string
-import requests
 import logging
 import os
 from datetime import datetime, timedelta
 from typing import Dict, Optional
 
+from cloud_sync import CloudSyncQueue
 from config import Config
 from database import Database
 
@@ -20,50 +21,49 @@ logger = logging.getLogger(__name__)
 class ActivationCodeManager:
     """激活碼管理器"""
     
-    def __init__(self):
+    def __init__(self, db: Database = None):
         self.config = Config()
-        self.db = Database()
+        # 與機器人共用同一個數據庫實例；單獨使用時自行創建
+        self.db = db or Database(self.config.DATABASE_FILE)
         
         # 雲端同步配置
         self.api_url = "https://tgwang.up.railway.app"  # 統一使用同一個服務
         self.api_key = os.getenv("API_KEY", "tg-api-secure-key-2024")
         self.enable_cloud_sync = True
         
+        # 後台同步隊列（未發送的激活碼跨重啟保留）
+        self.sync_queue = CloudSyncQueue(
+            self.api_url,
+            self.api_key,
+            queue_file=os.getenv('CLOUD_SYNC_QUEUE_FILE', 'cloud_sync_queue.json')
+        )
+        self.sync_task = None
+        
         logger.info(f"激活碼管理器初始化 - 雲端同步: {'啟用' if self.enable_cloud_sync else '關閉'}")
     
     def _sync_to_cloud(self, activation_code: str, code_data: Dict) -> bool:
-        """同步激活碼到雲端"""
+        """加入雲端同步隊列（後台批量發送，不阻塞調用方）"""
         if not self.enable_cloud_sync:
             return True
-            
-        try:
-            sync_data = {
-                "activation_code": activation_code,
-                "code_data": code_data
-            }
-            
-            headers = {
-                "X-API-Key": self.api_key,
-                "Content-Type": "application/json"
-            }
-            
-            response = requests.post(
-                f"{self.api_url}/sync/activation_code",
-                json=sync_data,
-                headers=headers,
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                logger.info(f"✅ 激活碼 {activation_code} 已同步到雲端")
-                return True
-            else:
-                logger.warning(f"⚠️ 雲端同步失敗: {response.status_code}")
-                return False
-                
-        except Exception as e:
-            logger.warning(f"⚠️ 雲端同步錯誤: {e}")
-            return False
+        
+        self.sync_queue.enqueue(activation_code, code_data)
+        return True
+    
+    async def start_cloud_sync(self):
+        """啟動後台雲端同步任務（需在事件循環中調用）"""
+        if self.enable_cloud_sync and not self.sync_queue.is_running:
+            self.sync_task = asyncio.create_task(self.sync_queue.run())
+    
+    async def stop_cloud_sync(self):
+        """停止後台雲端同步任務（盡量同步剩餘激活碼並關閉會話）"""
+        if self.sync_task is None:
+            return
+        await self.sync_queue.stop()
+        self.sync_task = None
+    
+    def get_sync_status(self) -> Dict:
+        """雲端同步隊列狀態"""
+        return self.sync_queue.get_status()
     
     def generate_activation_code(self, plan_type: str, days: int, user_id: int, 
                                order_id: str = None) -> str:
@@ -92,7 +92,7 @@ class ActivationCodeManager:
         # 保存到數據庫
         self.db.save_activation_code(code_data)
         
-        # 同步到雲端
+        # 加入雲端同步隊列
         self._sync_to_cloud(code, code_data)
         
         return code
@@ -199,17 +199,16 @@ class ActivationCodeManager:
         """獲取用戶的所有激活碼"""
         user_codes = []
         
-        for code, data in self.db.data['activation_codes'].items():
-            if data['user_id'] == user_id:
-                user_codes.append({
-                    'code': code,
-                    'plan_type': data['plan_type'],
-                    'days': data['days'],
-                    'created_at': data['created_at'],
-                    'expires_at': data['expires_at'],
-                    'used': data['used'],
-                    'used_at': data.get('used_at')
-                })
+        for data in self.db.get_user_activation_codes(user_id):
+            user_codes.append({
+                'code': data['activation_code'],
+                'plan_type': data['plan_type'],
+                'days': data['days'],
+                'created_at': data['created_at'],
+                'expires_at': data['expires_at'],
+                'used': data['used'],
+                'used_at': data.get('used_at')
+            })
         
         # 按創建時間排序
         user_codes.sort(key=lambda x: x['created_at'], reverse=True)
@@ -235,30 +234,5 @@ class ActivationCodeManager:
         return expired_count
     
     def get_activation_statistics(self) -> Dict:
-        """獲取激活碼統計"""
-        stats = {
-            'total': 0,
-            'trial': 0,
-            'weekly': 0,
-            'monthly': 0,
-            'used': 0,
-            'expired': 0,
-            'active': 0
-        }
-        
-        current_time = datetime.now()
-        
-        for code, data in self.db.data['activation_codes'].items():
-            stats['total'] += 1
-            stats[data['plan_type']] += 1
-            
-            if data['used']:
-                stats['used'] += 1
-            else:
-                expires_at = datetime.fromisoformat(data['expires_at'])
-                if current_time > expires_at:
-                    stats['expired'] += 1
-                else:
-                    stats['active'] += 1
-        
-        return stats
\ No newline at end of file
+        """獲取激活碼統計（由數據庫寫入時增量維護，不掃描全部激活碼）"""
+        return self.db.aggregates.activation_statistics()
\ No newline at end of file
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TRON API 速率限制模塊 - 令牌桶 + 優先級隊列 + 自適應退避
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# 請求優先級（數值越小越優先）
+PRIORITY_CONFIRMATION = 0  # 確認檢查：已匹配交易的確認
+PRIORITY_VERIFY = 1        # 付款驗證：用戶等待中的訂單
+PRIORITY_SCAN = 2          # 推測性掃描：區塊遍歷
+
+PRIORITY_NAMES = {
+    PRIORITY_CONFIRMATION: 'confirmation',
+    PRIORITY_VERIFY: 'verify',
+    PRIORITY_SCAN: 'scan'
+}
+
+class TokenBucket:
+    """令牌桶"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def try_consume(self, tokens: float = 1.0) -> float:
+        """嘗試消耗令牌，成功返回 0，否則返回需要等待的秒數"""
+        now = time.monotonic()
+        self._refill(now)
+
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0.0
+
+        return (tokens - self.tokens) / self.rate
+
+    def available(self) -> float:
+        """當前可用令牌數"""
+        self._refill(time.monotonic())
+        return self.tokens
+
+class TronApiRateLimiter:
+    """TRON API 共享速率限制器"""
+
+    def __init__(self, rate: float, burst: float, backoff_base: float = 1.0, backoff_max: float = 60.0):
+        self.bucket = TokenBucket(rate, burst)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        # 等待中的請求 (priority, seq)
+        self._waiters = []
+        self._counter = itertools.count()
+        self._condition = None
+        self._loop = None
+
+        # 服務端要求的暫停時間（Retry-After / 429）
+        self._blocked_until = 0.0
+
+        # 指標
+        self._recent_requests = deque()
+        self.metrics = {
+            'requests_total': 0,
+            'requests_by_priority': {name: 0 for name in PRIORITY_NAMES.values()},
+            'throttled_responses': 0,
+            'server_errors': 0,
+            'retries': 0,
+            'wait_seconds_total': 0.0
+        }
+
+    def _get_condition(self) -> asyncio.Condition:
+        """獲取綁定當前事件循環的條件變量"""
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+            self._waiters = []
+        return self._condition
+
+    async def acquire(self, priority: int = PRIORITY_SCAN):
+        """獲取一個請求配額，高優先級請求先放行"""
+        condition = self._get_condition()
+        entry = (priority, next(self._counter))
+        started_at = time.monotonic()
+
+        async with condition:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    timeout = None
+                    if self._waiters[0] == entry:
+                        now = time.monotonic()
+                        if now < self._blocked_until:
+                            timeout = self._blocked_until - now
+                        else:
+                            timeout = self.bucket.try_consume()
+                            if timeout == 0:
+                                heapq.heappop(self._waiters)
+                                condition.notify_all()
+                                break
+
+                    try:
+                        await asyncio.wait_for(condition.wait(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                    condition.notify_all()
+                raise
+
+        self._record_request(priority, time.monotonic() - started_at)
+
+    def _record_request(self, priority: int, waited: float):
+        now = time.monotonic()
+        self._recent_requests.append(now)
+        while self._recent_requests and self._recent_requests[0] < now - 60:
+            self._recent_requests.popleft()
+
+        self.metrics['requests_total'] += 1
+        self.metrics['requests_by_priority'][PRIORITY_NAMES.get(priority, 'scan')] += 1
+        self.metrics['wait_seconds_total'] += waited
+
+    def backoff_delay(self, attempt: int) -> float:
+        """指數退避（帶抖動）"""
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def record_response(self, status: int, retry_after: Optional[float] = None, attempt: int = 0) -> float:
+        """記錄響應狀態，返回重試前應等待的秒數"""
+        if status == 429:
+            self.metrics['throttled_responses'] += 1
+        elif status >= 500:
+            self.metrics['server_errors'] += 1
+        else:
+            return 0.0
+
+        delay = retry_after if retry_after is not None else self.backoff_delay(attempt)
+
+        # 限流時暫停所有請求，避免共享密鑰被繼續懲罰
+        if status == 429:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            logger.warning(f"⚠️ TRON API 限流，暫停 {delay:.1f} 秒")
+
+        return delay
+
+    def record_retry(self):
+        """記錄一次重試"""
+        self.metrics['retries'] += 1
+
+    def get_metrics(self) -> Dict:
+        """獲取配額使用指標"""
+        now = time.monotonic()
+        while self._recent_requests and self._recent_requests[0] < now - 60:
+            self._recent_requests.popleft()
+
+        requests_last_minute = len(self._recent_requests)
+        quota_per_minute = self.bucket.rate * 60
+
+        metrics = dict(self.metrics)
+        metrics['requests_by_priority'] = dict(self.metrics['requests_by_priority'])
+        metrics.update({
+            'rate_per_second': self.bucket.rate,
+            'burst': self.bucket.capacity,
+            'tokens_available': round(self.bucket.available(), 2),
+            'requests_last_minute': requests_last_minute,
+            'quota_usage': round(requests_last_minute / quota_per_minute, 3) if quota_per_minute else 0.0,
+            'waiting_requests': len(self._waiters),
+            'blocked_seconds': round(max(0.0, self._blocked_until - now), 1)
+        })
+        return metrics
+
+_shared_limiter: Optional[TronApiRateLimiter] = None
+
+def get_shared_limiter() -> TronApiRateLimiter:
+    """獲取進程內共享的速率限制器（所有監控器共用同一 API 密鑰配額）"""
+    global _shared_limiter
+    if _shared_limiter is None:
+        config = Config()
+        _shared_limiter = TronApiRateLimiter(
+            rate=config.TRONGRID_RATE_LIMIT,
+            burst=config.TRONGRID_RATE_BURST
+        )
+        logger.info(f"🚦 TRON API 速率限制: {config.TRONGRID_RATE_LIMIT}/秒，突發 {config.TRONGRID_RATE_BURST}")
+    return _shared_limiter
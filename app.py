@@ -284,6 +284,44 @@ async def sync_activation_code(
         logger.error(f"同步過程出錯: {e}")
         raise HTTPException(status_code=500, detail="服務器錯誤")
 
+@app.post("/sync/activation_codes")
+async def sync_activation_codes(
+    request: dict,
+    x_api_key: Optional[str] = Header(None)
+):
+    """批量同步激活碼（供機器人同步隊列使用）"""
+    
+    if x_api_key != API_KEY:
+        raise HTTPException(status_code=401, detail="無效的API密鑰")
+    
+    codes = request.get("codes") or []
+    if not isinstance(codes, list) or len(codes) > 500:
+        raise HTTPException(status_code=400, detail="數據格式錯誤或數量超過500")
+    
+    try:
+        synced = []
+        failed = []
+        for item in codes:
+            activation_code = item.get("activation_code")
+            code_data = item.get("code_data")
+            
+            if activation_code and code_data and db_adapter.save_activation_code(activation_code, code_data):
+                synced.append(activation_code)
+            else:
+                failed.append(activation_code)
+        
+        logger.info(f"批量同步激活碼: 成功 {len(synced)} 個，失敗 {len(failed)} 個")
+        return {
+            "success": not failed,
+            "message": f"同步成功 {len(synced)} 個，失敗 {len(failed)} 個",
+            "synced": synced,
+            "failed": failed
+        }
+        
+    except Exception as e:
+        logger.error(f"批量同步過程出錯: {e}")
+        raise HTTPException(status_code=500, detail="服務器錯誤")
+
 @app.get("/status/{device_id}")
 async def check_status(
     device_id: str,
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+執行器模塊 - 把阻塞的存儲操作移出事件循環，並統計每個處理器的耗時
+
+- 存儲: JSON 數據庫每次寫入都會序列化整個文件，放到專用線程中串行執行，
+  寫入順序與調用順序一致，事件循環在等待期間繼續處理其他用戶的更新
+- 網絡: 統一使用 aiohttp 異步請求（TRON 監控、雲端同步），不在此執行器中運行
+"""
+
+import asyncio
+import functools
+import logging
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+class LatencyStats:
+    """耗時統計（次數、平均、p95、最大）"""
+
+    SAMPLES = 200
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=self.SAMPLES)
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def to_dict(self) -> Dict:
+        values = sorted(self.samples)
+        p95 = values[int(0.95 * (len(values) - 1))] if values else 0.0
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total / self.count * 1000, 1) if self.count else 0.0,
+            'p95_ms': round(p95 * 1000, 1),
+            'max_ms': round(self.max * 1000, 1)
+        }
+
+class StorageExecutor:
+    """存儲執行器 - 單線程池串行執行阻塞的數據庫操作"""
+
+    SLOW_THRESHOLD = 0.5  # 超過此秒數的存儲操作記錄警告
+
+    def __init__(self):
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
+        self.queue_wait = LatencyStats()
+        self.operations: Dict[str, LatencyStats] = defaultdict(LatencyStats)
+        self.pending = 0
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """在存儲線程中執行 func，返回其結果"""
+        loop = asyncio.get_running_loop()
+        name = getattr(func, '__name__', repr(func))
+        submitted_at = time.perf_counter()
+        started_at = None
+
+        def call():
+            nonlocal started_at
+            started_at = time.perf_counter()
+            return func(*args, **kwargs)
+
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(self.pool, call)
+        finally:
+            self.pending -= 1
+            finished_at = time.perf_counter()
+            if started_at is not None:
+                self.queue_wait.record(started_at - submitted_at)
+                elapsed = finished_at - started_at
+                self.operations[name].record(elapsed)
+                if elapsed > self.SLOW_THRESHOLD:
+                    logger.warning(f"🐢 存儲操作 {name} 耗時 {elapsed:.2f} 秒")
+
+    def shutdown(self):
+        """等待已提交的寫入完成後關閉線程池"""
+        self.pool.shutdown(wait=True)
+
+    def get_metrics(self) -> Dict:
+        return {
+            'pending': self.pending,
+            'queue_wait': self.queue_wait.to_dict(),
+            'operations': {name: stats.to_dict() for name, stats in self.operations.items()}
+        }
+
+class HandlerTimer:
+    """處理器計時 - 記錄每個 Telegram 處理器的耗時和並發數"""
+
+    SLOW_THRESHOLD = 1.0  # 超過此秒數的處理器記錄警告
+
+    def __init__(self):
+        self.handlers: Dict[str, LatencyStats] = defaultdict(LatencyStats)
+        self.active: Dict[str, int] = defaultdict(int)
+        self.peak_active: Dict[str, int] = defaultdict(int)
+
+    def wrap(self, handler: Callable) -> Callable:
+        """包裝異步處理器，返回帶計時的處理器"""
+        name = getattr(handler, '__name__', repr(handler))
+
+        @functools.wraps(handler)
+        async def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            self.active[name] += 1
+            self.peak_active[name] = max(self.peak_active[name], self.active[name])
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                self.active[name] -= 1
+                elapsed = time.perf_counter() - started_at
+                self.handlers[name].record(elapsed)
+                if elapsed > self.SLOW_THRESHOLD:
+                    logger.warning(f"🐢 處理器 {name} 耗時 {elapsed:.2f} 秒")
+
+        return timed
+
+    def get_metrics(self) -> Dict:
+        return {
+            name: {**stats.to_dict(), 'active': self.active[name], 'peak_active': self.peak_active[name]}
+            for name, stats in self.handlers.items()
+        }
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+群發模塊 - 管理員向全部用戶、試用用戶或某方案買家群發消息
+
+- 受眾按用戶 ID 升序從數據庫索引查詢，進度以「最後處理的用戶 ID」保存到檢查點，
+  重啟後從斷點繼續，不會重發已完成的批次（中斷時最多重發一個批次）
+- 消息通過發送隊列的營銷通道發送，並按 BROADCAST_RATE 限速，給用戶操作的回覆留出配額
+- 用戶屏蔽機器人或註銷時標記為已屏蔽，之後的群發不再包含該用戶
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from telegram.error import BadRequest, Forbidden
+
+from api_rate_limiter import TokenBucket
+from telegram_outbox import PRIORITY_INTERACTIVE, PRIORITY_MARKETING
+
+logger = logging.getLogger(__name__)
+
+AUDIENCES = {
+    'all': '全部用戶',
+    'trial': '試用用戶',
+    'weekly': '週卡買家',
+    'monthly': '月卡買家'
+}
+
+class BroadcastManager:
+    """群發管理器（同一時間只運行一個群發任務）"""
+
+    CHECKPOINT_SECTION = 'broadcast'
+    BATCH_SIZE = 30            # 每批並發發送的消息數，每批完成後保存一次進度
+    PROGRESS_INTERVAL = 5.0    # 向管理員更新進度的最短間隔（秒）
+
+    def __init__(self, db, storage, outbox, checkpoint, rate: float = 20.0):
+        self.db = db
+        self.storage = storage
+        self.outbox = outbox
+        self.checkpoint = checkpoint
+        self.bucket = TokenBucket(rate, rate)
+        self.job: Optional[Dict] = checkpoint.get(self.CHECKPOINT_SECTION) if checkpoint else None
+        self.task: Optional[asyncio.Task] = None
+
+    def is_running(self) -> bool:
+        return bool(self.task and not self.task.done())
+
+    def _save(self):
+        if self.checkpoint:
+            self.checkpoint.save(self.CHECKPOINT_SECTION, self.job)
+
+    async def start(self, audience: str, text: str, admin_chat_id: int) -> Dict:
+        """創建並啟動群發任務"""
+        if audience not in AUDIENCES:
+            raise ValueError(f"未知的群發受眾: {audience}")
+        if self.is_running():
+            raise RuntimeError("已有群發任務正在進行")
+
+        self.job = {
+            'job_id': datetime.now().strftime('%Y%m%d%H%M%S'),
+            'audience': audience,
+            'text': text,
+            'admin_chat_id': admin_chat_id,
+            'progress_message_id': None,
+            'status': 'running',
+            'last_user_id': 0,
+            'total': 0,
+            'sent': 0,
+            'failed': 0,
+            'blocked': 0,
+            'started_at': datetime.now().isoformat(),
+            'finished_at': None
+        }
+        self._save()
+
+        try:
+            message = await self.outbox.send_message(admin_chat_id, self.format_progress(), PRIORITY_INTERACTIVE)
+            self.job['progress_message_id'] = message.message_id
+        except Exception as e:
+            logger.warning(f"⚠️ 發送群發進度消息失敗: {e}")
+
+        self.task = asyncio.create_task(self._run())
+        logger.info(f"📢 群發任務 {self.job['job_id']} 已啟動，受眾: {AUDIENCES[audience]}")
+        return self.job
+
+    def resume(self, stopped: bool = False) -> bool:
+        """重啟後恢復未完成的群發任務；stopped=True 時同時繼續被管理員停止的任務"""
+        if not self.job or self.is_running():
+            return False
+        if stopped and self.job.get('status') == 'stopped':
+            self.job['status'] = 'running'
+            self._save()
+        if self.job.get('status') != 'running':
+            return False
+        logger.info(f"📢 恢復群發任務 {self.job['job_id']}，從用戶 {self.job['last_user_id']} 之後繼續")
+        self.task = asyncio.create_task(self._run())
+        return True
+
+    def stop(self) -> bool:
+        """停止群發（當前批次發完後停止，進度保留）"""
+        if not self.job or self.job.get('status') != 'running':
+            return False
+        self.job['status'] = 'stopped'
+        self._save()
+        return True
+
+    async def shutdown(self):
+        """機器人關閉時中斷群發，任務保持運行狀態以便重啟後恢復"""
+        if self.is_running():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    @staticmethod
+    def _is_unreachable(error: BaseException) -> bool:
+        """用戶屏蔽了機器人、已註銷或聊天不存在"""
+        if isinstance(error, Forbidden):
+            return True
+        return isinstance(error, BadRequest) and 'chat not found' in str(error).lower()
+
+    async def _send_batch(self, user_ids: List[int]) -> list:
+        futures = []
+        for user_id in user_ids:
+            wait = self.bucket.try_consume()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self.bucket.try_consume()
+            futures.append(self.outbox.enqueue(user_id, priority=PRIORITY_MARKETING, text=self.job['text']))
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    async def _run(self):
+        job = self.job
+        try:
+            audience = await self.storage.run(self.db.get_audience, job['audience'])
+            remaining = [user_id for user_id in audience if user_id > job['last_user_id']]
+            job['total'] = job['sent'] + job['failed'] + job['blocked'] + len(remaining)
+            last_report = time.monotonic()
+
+            for start in range(0, len(remaining), self.BATCH_SIZE):
+                if job['status'] != 'running':
+                    break
+                batch = remaining[start:start + self.BATCH_SIZE]
+                results = await self._send_batch(batch)
+                if any(isinstance(result, asyncio.CancelledError) for result in results):
+                    return  # 發送隊列已關閉，本批次重啟後重發
+
+                blocked = []
+                for user_id, result in zip(batch, results):
+                    if not isinstance(result, BaseException):
+                        job['sent'] += 1
+                    elif self._is_unreachable(result):
+                        blocked.append(user_id)
+                    else:
+                        job['failed'] += 1
+                if blocked:
+                    job['blocked'] += len(blocked)
+                    await self.storage.run(self.db.mark_users_blocked, blocked)
+
+                job['last_user_id'] = batch[-1]
+                self._save()
+
+                if time.monotonic() - last_report >= self.PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    self._report_progress()
+
+            if job['status'] == 'running':
+                job['status'] = 'completed'
+            job['finished_at'] = datetime.now().isoformat()
+            self._save()
+            self._report_progress()
+            logger.info(f"📢 群發任務 {job['job_id']} 結束（{job['status']}）: 成功 {job['sent']}，"
+                        f"失敗 {job['failed']}，已屏蔽 {job['blocked']}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ 群發任務 {job['job_id']} 出錯，重啟後將從斷點繼續: {e}")
+
+    def _report_progress(self):
+        """更新管理員的進度消息（不等待結果）"""
+        job = self.job
+        if not job.get('admin_chat_id'):
+            return
+        if job.get('progress_message_id'):
+            self.outbox.enqueue(job['admin_chat_id'], 'edit_message_text', PRIORITY_INTERACTIVE,
+                                message_id=job['progress_message_id'], text=self.format_progress())
+        else:
+            self.outbox.enqueue(job['admin_chat_id'], priority=PRIORITY_INTERACTIVE, text=self.format_progress())
+
+    def format_progress(self) -> str:
+        job = self.job
+        if not job:
+            return "📢 暫無群發任務"
+        status_names = {'running': '🟢 發送中', 'stopped': '⏸️ 已停止', 'completed': '✅ 已完成'}
+        done = job['sent'] + job['failed'] + job['blocked']
+        return (
+            f"📢 群發任務 {job['job_id']}\n"
+            f"受眾: {AUDIENCES.get(job['audience'], job['audience'])}\n"
+            f"狀態: {status_names.get(job['status'], job['status'])}\n"
+            f"進度: {done}/{job['total'] or '-'}\n"
+            f"成功: {job['sent']}，失敗: {job['failed']}，已屏蔽（已移出受眾）: {job['blocked']}\n"
+            f"更新時間: {datetime.now().strftime('%H:%M:%S')}"
+        )
@@ -8,6 +8,8 @@ import os
 import json
 from datetime import datetime, timedelta
 
+from transaction_ledger import get_ledger_path, load_ledger
+
 def check_current_setup():
     """檢查當前配置"""
     print("🔧 當前配置檢查:")
@@ -41,7 +43,7 @@ def check_database_orders():
             data = json.load(f)
         
         orders = data.get('orders', {})
-        transactions = data.get('transactions', {})
+        transactions = data.get('transactions') or load_ledger(get_ledger_path(db_file))
         
         print(f"📊 總訂單數: {len(orders)}")
         print(f"💰 總交易數: {len(transactions)}")
@@ -101,7 +103,7 @@ def check_transactions():
         with open(db_file, 'r', encoding='utf-8') as f:
             data = json.load(f)
         
-        transactions = data.get('transactions', {})
+        transactions = data.get('transactions') or load_ledger(get_ledger_path(db_file))
         
         if not transactions:
             print("  📝 沒有交易記錄")
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+雲端同步隊列模塊 - 激活碼在後台批量同步到雲端，生成激活碼時不阻塞
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+class CloudSyncQueue:
+    """激活碼雲端同步隊列（持久化、批量、失敗退避重試，反復被拒絕的激活碼移入死信列表）"""
+
+    def __init__(self, api_url: str, api_key: str, queue_file: str = 'cloud_sync_queue.json',
+                 batch_size: int = 50, flush_interval: float = 2.0, max_backoff: float = 300.0,
+                 max_attempts: int = 10):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.queue_file = queue_file
+        self.dead_letter_file = f"{os.path.splitext(queue_file)[0]}_dead_letter.json"
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts  # 雲端拒絕次數上限（連接失敗不計入）
+
+        self.lock = threading.Lock()
+        # 待同步項目 {activation_code: {'code_data': {...}, 'attempts': int, 'enqueued_at': float}}，按入隊順序
+        self.pending: Dict[str, Dict] = self._load_queue(self.queue_file)
+        # 超過拒絕次數上限的項目，不再自動重試（格式同上）
+        self.dead_letters: Dict[str, Dict] = self._load_queue(self.dead_letter_file)
+
+        self.bulk_supported = True  # 雲端不支持批量接口時退回逐個同步
+        self.is_running = False
+        self._wake_event: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._run_task: Optional[asyncio.Task] = None
+        self._consecutive_failures = 0
+
+        self.stats = {
+            'synced': 0,
+            'failed_attempts': 0,
+            'batches': 0,
+            'last_error': None
+        }
+
+        if self.pending:
+            logger.info(f"☁️ 恢復 {len(self.pending)} 個待同步激活碼")
+        if self.dead_letters:
+            logger.warning(f"⚠️ {len(self.dead_letters)} 個激活碼多次被雲端拒絕，需人工處理")
+
+    def _load_queue(self, path: str) -> Dict[str, Dict]:
+        """加載持久化隊列"""
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (json.JSONDecodeError, IOError) as e:
+                logger.warning(f"⚠️ 加載雲端同步隊列 {path} 失敗: {e}")
+        return {}
+
+    def _save_queue(self, path: str = None, items: Dict[str, Dict] = None):
+        """保存隊列（先寫臨時文件再替換），默認保存待同步隊列"""
+        path = path or self.queue_file
+        try:
+            temp_file = f"{path}.tmp"
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.pending if items is None else items, f, ensure_ascii=False)
+            os.replace(temp_file, path)
+        except IOError as e:
+            logger.error(f"❌ 保存雲端同步隊列失敗: {e}")
+
+    def enqueue(self, activation_code: str, code_data: Dict):
+        """加入同步隊列，立即返回"""
+        with self.lock:
+            entry = self.pending.pop(activation_code, None) or {'attempts': 0, 'enqueued_at': time.time()}
+            entry['code_data'] = code_data  # 同一激活碼只保留最新數據
+            self.pending[activation_code] = entry
+            self._save_queue()
+
+        # 湊滿一批時立即喚醒後台任務（退避期間不提前重試）
+        if len(self.pending) >= self.batch_size and not self._consecutive_failures:
+            self._wake()
+
+    def _wake(self):
+        if self._loop and self._wake_event:
+            self._loop.call_soon_threadsafe(self._wake_event.set)
+
+    def _take_batch(self) -> List[Dict]:
+        with self.lock:
+            return [{'activation_code': code, 'code_data': entry['code_data']}
+                    for code, entry in list(self.pending.items())[:self.batch_size]]
+
+    def _complete(self, synced: List[str], failed: List[str]):
+        """移除已同步項目；被拒絕的項目記錄次數並移到隊尾，不阻塞其他激活碼，超過上限時移入死信列表"""
+        dead = []
+        with self.lock:
+            for code in synced:
+                self.pending.pop(code, None)
+            for code in failed:
+                entry = self.pending.pop(code, None)
+                if not entry:
+                    continue
+                entry['attempts'] += 1
+                if entry['attempts'] >= self.max_attempts:
+                    self.dead_letters[code] = entry
+                    dead.append(code)
+                else:
+                    self.pending[code] = entry
+            self._save_queue()
+            if dead:
+                self._save_queue(self.dead_letter_file, self.dead_letters)
+        self.stats['synced'] += len(synced)
+        self.stats['failed_attempts'] += len(failed)
+        if dead:
+            logger.error(f"❌ {len(dead)} 個激活碼被雲端拒絕 {self.max_attempts} 次，移入死信列表: {', '.join(dead)}")
+
+    def retry_dead_letters(self) -> int:
+        """把死信列表中的激活碼重新加入同步隊列（重置拒絕次數），返回數量"""
+        with self.lock:
+            count = len(self.dead_letters)
+            for code, entry in self.dead_letters.items():
+                entry['attempts'] = 0
+                self.pending[code] = entry
+            self.dead_letters = {}
+            self._save_queue()
+            self._save_queue(self.dead_letter_file, self.dead_letters)
+        if count:
+            self._wake()
+        return count
+
+    def _headers(self) -> Dict:
+        return {
+            "X-API-Key": self.api_key,
+            "Content-Type": "application/json"
+        }
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """獲取復用的 HTTP 會話"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15))
+        return self._session
+
+    async def _send_bulk(self, batch: List[Dict]):
+        """批量同步，返回 (已同步, 被拒絕)；接口不存在時返回 None"""
+        session = self._get_session()
+        async with session.post(f"{self.api_url}/sync/activation_codes", json={'codes': batch},
+                                headers=self._headers()) as response:
+            if response.status in (404, 405):
+                return None
+            if 400 <= response.status < 500 and response.status != 429:
+                # 整批被拒絕時逐個同步，找出被拒絕的激活碼
+                return await self._send_each(batch)
+            if response.status != 200:
+                raise RuntimeError(f"批量同步失敗: HTTP {response.status}")
+            result = await response.json(content_type=None)
+            synced = result.get('synced', [])
+            failed = [item['activation_code'] for item in batch if item['activation_code'] not in synced]
+            return synced, failed
+
+    async def _send_each(self, batch: List[Dict]):
+        """逐個同步（兼容舊版雲端），返回 (已同步, 被拒絕)；連接失敗時停止，剩餘項目留在隊列中"""
+        session = self._get_session()
+        synced, failed = [], []
+        for item in batch:
+            try:
+                async with session.post(f"{self.api_url}/sync/activation_code", json=item,
+                                        headers=self._headers()) as response:
+                    (synced if response.status == 200 else failed).append(item['activation_code'])
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if not synced and not failed:
+                    raise
+                break
+        return synced, failed
+
+    async def flush_once(self) -> Tuple[int, int]:
+        """同步一批，返回 (成功數量, 被拒絕數量)；雲端無法連接時拋出異常"""
+        batch = self._take_batch()
+        if not batch:
+            return 0, 0
+
+        self.stats['batches'] += 1
+        result = await self._send_bulk(batch) if self.bulk_supported else None
+        if result is None:
+            if self.bulk_supported:
+                logger.info("☁️ 雲端不支持批量同步接口，改為逐個同步")
+                self.bulk_supported = False
+            result = await self._send_each(batch)
+
+        synced, failed = result
+        self._complete(synced, failed)
+
+        if synced:
+            logger.info(f"✅ {len(synced)} 個激活碼已同步到雲端")
+        if failed:
+            logger.warning(f"⚠️ {len(failed)} 個激活碼被雲端拒絕")
+        return len(synced), len(failed)
+
+    def backoff_delay(self) -> float:
+        """連續失敗時的退避時間（指數增長，帶抖動）"""
+        delay = min(self.max_backoff, self.flush_interval * (2 ** self._consecutive_failures))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def run(self):
+        """後台同步循環"""
+        self.is_running = True
+        self._loop = asyncio.get_running_loop()
+        self._wake_event = asyncio.Event()
+        self._run_task = asyncio.current_task()
+        logger.info(f"☁️ 雲端同步隊列已啟動，待同步 {len(self.pending)} 個")
+
+        while self.is_running:
+            delay = self.flush_interval
+            try:
+                while self.pending and self.is_running:
+                    synced, failed = await self.flush_once()
+                    if failed and not synced:
+                        raise RuntimeError(f"{failed} 個激活碼同步失敗")
+                    # 同步了任何項目都說明雲端可用，不再退避
+                    self._consecutive_failures = 0
+                    if failed:
+                        break  # 被拒絕的項目已移到隊尾，下一輪再試
+                self._consecutive_failures = 0
+            except Exception as e:
+                self._consecutive_failures += 1
+                self.stats['last_error'] = str(e)
+                delay = self.backoff_delay()
+                logger.warning(f"⚠️ 雲端同步錯誤: {e}，{delay:.1f} 秒後重試")
+
+            try:
+                await asyncio.wait_for(self._wake_event.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wake_event.clear()
+
+    async def stop(self, timeout: float = 10.0):
+        """停止後台循環，在超時內盡量同步剩餘激活碼，然後關閉會話（未同步的保留在隊列文件中）"""
+        self.is_running = False
+        self._wake()
+        if self._run_task and not self._run_task.done():
+            try:
+                await asyncio.wait_for(self._run_task, timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        if self.pending:
+            try:
+                await asyncio.wait_for(self._drain(), timeout)
+            except Exception as e:
+                logger.warning(f"⚠️ 關閉前同步激活碼失敗: {e}，剩餘 {len(self.pending)} 個下次啟動後同步")
+
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _drain(self):
+        while self.pending:
+            synced, failed = await self.flush_once()
+            if failed or not synced:
+                return
+
+    def get_status(self) -> Dict:
+        """隊列狀態"""
+        with self.lock:
+            oldest = min((entry['enqueued_at'] for entry in self.pending.values()), default=None)
+        return {
+            'queue_depth': len(self.pending),
+            'dead_letters': len(self.dead_letters),
+            'oldest_age_seconds': round(time.time() - oldest, 1) if oldest else 0.0,
+            'bulk_supported': self.bulk_supported,
+            **self.stats
+        }
@@ -16,8 +16,19 @@ class Config:
         
         # TronScan API 配置
         self.TRONGRID_API_KEY = os.getenv('TRONGRID_API_KEY')  # 保持變量名不變
-        self.TRONGRID_API_URL = "https://apilist.tronscanapi.com"  # 改為 TronScan API
-        
+        self.TRONGRID_API_URL = os.getenv('TRONGRID_API_URL', "https://apilist.tronscanapi.com")  # 改為 TronScan API（可指向本地模擬服務）
+
+        # API 速率限制（所有監控器共享同一密鑰配額）
+        self.TRONGRID_RATE_LIMIT = float(os.getenv('TRONGRID_RATE_LIMIT', '5'))  # 每秒請求數
+        self.TRONGRID_RATE_BURST = float(os.getenv('TRONGRID_RATE_BURST', '10'))
+        self.TRONGRID_MAX_RETRIES = int(os.getenv('TRONGRID_MAX_RETRIES', '3'))
+
+        # 多個兼容端點（逗號分隔，如 TronScan、TronGrid、自建節點），按延遲和錯誤率選擇
+        api_urls_str = os.getenv('TRON_API_URLS', '')
+        self.TRON_API_URLS = [url.strip() for url in api_urls_str.split(',') if url.strip()] or [self.TRONGRID_API_URL]
+        self.TRON_HEDGE_ENABLED = os.getenv('TRON_HEDGE_ENABLED', 'true').lower() == 'true'  # 慢請求超過 p95 時向備用端點對沖
+        self.TRON_HEDGE_MIN_DELAY = float(os.getenv('TRON_HEDGE_MIN_DELAY', '0.3'))  # 對沖前最少等待秒數
+
         # USDT 配置
         self.USDT_ADDRESS = os.getenv('USDT_ADDRESS', 'TGEhjpGrYT2mtST2vHxTd5dTxfh21UzkRP')
         self.USDT_CONTRACT = os.getenv('USDT_CONTRACT', 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t')
@@ -32,6 +43,12 @@ class Config:
         # 監控配置
         self.MONITORING_INTERVAL = int(os.getenv('MONITORING_INTERVAL', '60'))  # 秒
         self.CONFIRMATION_BLOCKS = int(os.getenv('CONFIRMATION_BLOCKS', '1'))  # 確認區塊數
+        self.CONFIRMATION_STATE_FILE = os.getenv('CONFIRMATION_STATE_FILE', 'confirmation_state.json')
+        
+        # 監控檢查點（重啟後從斷點恢復）
+        self.MONITOR_CHECKPOINT_FILE = os.getenv('MONITOR_CHECKPOINT_FILE', 'monitor_checkpoint.json')
+        self.CATCHUP_MAX_BLOCKS = int(os.getenv('CATCHUP_MAX_BLOCKS', '1200'))  # 重啟後最多補掃的區塊數（約1小時）
+        self.CATCHUP_MAX_MINUTES = int(os.getenv('CATCHUP_MAX_MINUTES', '180'))  # 重啟後付款查詢最多回溯的分鐘數
         
         # 訂單配置
         self.ORDER_TIMEOUT_HOURS = int(os.getenv('ORDER_TIMEOUT_HOURS', '24'))
@@ -39,6 +56,41 @@ class Config:
         # 激活碼配置
         self.ACTIVATION_CODE_LENGTH = int(os.getenv('ACTIVATION_CODE_LENGTH', '16'))
         
+        # 同時處理的 Telegram 更新數（不同用戶並發，同一用戶按順序）
+        self.CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '32'))
+        
+        # 更新接收方式: polling（長輪詢）或 webhook（Telegram 推送到內置 HTTP 服務）
+        self.BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+        self.WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # 公網地址，為空時只啟動本地服務不註冊
+        self.WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+        self.WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', '8443')))
+        self.WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'webhook')
+        self.WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+        self.WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+        self.WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '25'))
+        
+        # Telegram 發送限速（全局約 30 條/秒，每個聊天約 1 條/秒）
+        self.TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+        self.TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+        self.TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+        # 群發每秒最多發送條數（低於全局限速，給用戶操作的回覆留出配額）
+        self.BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '20'))
+        
+        # 緩存會話的最多用戶數（按最近訪問淘汰）
+        self.USER_SESSION_CACHE_SIZE = int(os.getenv('USER_SESSION_CACHE_SIZE', '10000'))
+        
+        # 統計聚合全量核對間隔（秒），修正增量統計可能出現的偏差
+        self.STATS_RECONCILE_INTERVAL = float(os.getenv('STATS_RECONCILE_INTERVAL', '3600'))
+        
+        # 濫用記錄（機器人進程和 API 服務共用的封禁名單和可疑分數追加日誌）
+        self.ABUSE_STORE_FILE = os.getenv('ABUSE_STORE_FILE', 'abuse_store.jsonl')
+        # 可疑分數半衰期（秒），分數超過閾值時自動封禁指定秒數
+        self.ABUSE_SCORE_HALF_LIFE = float(os.getenv('ABUSE_SCORE_HALF_LIFE', '3600'))
+        self.ABUSE_BAN_THRESHOLD = float(os.getenv('ABUSE_BAN_THRESHOLD', '10'))
+        self.ABUSE_BAN_SECONDS = float(os.getenv('ABUSE_BAN_SECONDS', '86400'))
+        # 可疑分數記錄數上限，超出時淘汰最久未更新的
+        self.ABUSE_MAX_KEYS = int(os.getenv('ABUSE_MAX_KEYS', '20000'))
+        
         # 驗證配置
         self.validate_config()
     
@@ -57,6 +109,14 @@ class Config:
         # 驗證 USDT 地址格式
         if not self.USDT_ADDRESS.startswith('T') or len(self.USDT_ADDRESS) != 34:
             raise ValueError(f"無效的 USDT 地址格式: {self.USDT_ADDRESS}")
+        
+        # 驗證收款地址和合約地址的 Base58 校驗和（地址輸錯時在啟動時給出明確提示）
+        from tron_monitor import base58_to_hex
+        for var in ('USDT_ADDRESS', 'USDT_CONTRACT'):
+            try:
+                base58_to_hex(getattr(self, var))
+            except ValueError as e:
+                raise ValueError(f"無效的 {var}: {e}")
     
     def get_trongrid_headers(self) -> dict:
         """獲取 TronGrid API 請求頭"""
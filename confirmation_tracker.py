@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+交易確認追蹤模塊 - 候選轉賬的確認狀態機（持久化）
+
+狀態流轉: seen → confirming → confirmed / failed
+鏈上已確認但付款回調失敗的交易保持 confirming，每輪（包括重啟後）重新投遞，直到回調成功才變為 confirmed
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+STATE_SEEN = 'seen'                # 掃描到匹配的轉賬，尚未達到確認深度
+STATE_CONFIRMING = 'confirming'    # 已達到深度，正在獲取交易詳情
+STATE_CONFIRMED = 'confirmed'      # 交易成功且確認數足夠，付款已投遞
+STATE_FAILED = 'failed'            # 交易執行失敗或多次查詢無結果
+
+FINAL_STATES = (STATE_CONFIRMED, STATE_FAILED)
+
+class ConfirmationTracker:
+    """候選轉賬確認隊列"""
+
+    def __init__(self, state_file: str = 'confirmation_state.json', required_confirmations: int = 1,
+                 max_attempts: int = 20, retention_hours: int = 24):
+        self.state_file = state_file
+        self.required_confirmations = required_confirmations
+        self.max_attempts = max_attempts
+        self.retention_seconds = retention_hours * 3600
+        self.lock = threading.Lock()
+        self.candidates: Dict[str, Dict] = self._load_state()
+
+        pending = sum(1 for c in self.candidates.values() if c['state'] not in FINAL_STATES)
+        if pending:
+            logger.info(f"⏳ 恢復 {pending} 筆待確認交易")
+
+    def _load_state(self) -> Dict[str, Dict]:
+        """加載持久化狀態"""
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (json.JSONDecodeError, IOError) as e:
+                logger.warning(f"⚠️ 加載確認狀態失敗: {e}")
+        return {}
+
+    def _save_state(self):
+        """保存狀態（先寫臨時文件再替換，避免崩潰時損壞）"""
+        try:
+            temp_file = f"{self.state_file}.tmp"
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.candidates, f, ensure_ascii=False)
+            os.replace(temp_file, self.state_file)
+        except IOError as e:
+            logger.error(f"❌ 保存確認狀態失敗: {e}")
+
+    def has(self, tx_id: str) -> bool:
+        """交易是否已在追蹤中"""
+        return tx_id in self.candidates
+
+    def add_candidate(self, tx_id: str, transfer: Dict, block_number: int) -> bool:
+        """加入候選轉賬，已存在時返回 False"""
+        with self.lock:
+            if tx_id in self.candidates:
+                return False
+
+            self.candidates[tx_id] = {
+                'state': STATE_SEEN,
+                'block_number': block_number,
+                'transfer': transfer,
+                'attempts': 0,
+                'updated_at': time.time()
+            }
+            self._save_state()
+
+        logger.info(f"👀 候選轉賬 {tx_id} 位於區塊 {block_number}，等待 {self.required_confirmations} 個確認")
+        return True
+
+    def due_candidates(self, head_block: int) -> List[str]:
+        """已達到確認深度、需要獲取詳情的交易"""
+        due = []
+        for tx_id, candidate in self.candidates.items():
+            if candidate['state'] in FINAL_STATES:
+                continue
+            if head_block - candidate['block_number'] >= self.required_confirmations:
+                due.append(tx_id)
+        return due
+
+    def get(self, tx_id: str) -> Optional[Dict]:
+        return self.candidates.get(tx_id)
+
+    def _set_state(self, tx_id: str, state: str, **fields):
+        with self.lock:
+            candidate = self.candidates.get(tx_id)
+            if not candidate:
+                return
+            candidate['state'] = state
+            candidate['updated_at'] = time.time()
+            candidate.update(fields)
+            self._save_state()
+
+    def mark_confirming(self, tx_ids: List[str]):
+        """批量標記為確認中"""
+        with self.lock:
+            now = time.time()
+            for tx_id in tx_ids:
+                candidate = self.candidates.get(tx_id)
+                if candidate:
+                    candidate['state'] = STATE_CONFIRMING
+                    candidate['attempts'] += 1
+                    candidate['updated_at'] = now
+            self._save_state()
+
+    def mark_confirmed(self, tx_id: str, block_number: int, confirmations: int):
+        self._set_state(tx_id, STATE_CONFIRMED, block_number=block_number, confirmations=confirmations)
+
+    def mark_delivery_failed(self, tx_id: str, reason: str):
+        """鏈上已確認但投遞失敗：保持確認中狀態並重置查詢次數（投遞重試不會被標記為失敗），下一輪重新投遞"""
+        self._set_state(tx_id, STATE_CONFIRMING, attempts=0, last_error=reason)
+        logger.warning(f"⚠️ 交易 {tx_id} 投遞失敗，下一輪重試: {reason}")
+
+    def mark_failed(self, tx_id: str, reason: str):
+        self._set_state(tx_id, STATE_FAILED, reason=reason)
+        logger.warning(f"⚠️ 交易 {tx_id} 確認失敗: {reason}")
+
+    def retry_later(self, tx_id: str) -> bool:
+        """詳情暫不可用，下次再查；超過最大次數返回 False"""
+        candidate = self.candidates.get(tx_id)
+        if not candidate:
+            return False
+        if candidate['attempts'] >= self.max_attempts:
+            self.mark_failed(tx_id, f"{candidate['attempts']} 次查詢無結果")
+            return False
+        return True
+
+    def prune(self) -> int:
+        """移除保留期外的已完成記錄"""
+        cutoff = time.time() - self.retention_seconds
+        with self.lock:
+            expired = [tx_id for tx_id, c in self.candidates.items()
+                       if c['state'] in FINAL_STATES and c['updated_at'] < cutoff]
+            for tx_id in expired:
+                del self.candidates[tx_id]
+            if expired:
+                self._save_state()
+        return len(expired)
+
+    def get_stats(self) -> Dict:
+        stats = {STATE_SEEN: 0, STATE_CONFIRMING: 0, STATE_CONFIRMED: 0, STATE_FAILED: 0}
+        for candidate in self.candidates.values():
+            stats[candidate['state']] += 1
+        return stats
@@ -4,19 +4,88 @@
 數據庫管理模塊 - 使用 JSON 文件作為簡單數據庫
 """
 
+import bisect
 import json
+import logging
 import os
 import threading
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional
+
+from order_ids import order_id_lower_bound, order_id_time
+from stats_aggregator import StatsAggregator
+from transaction_ledger import TransactionLedger, get_ledger_path
+
+logger = logging.getLogger(__name__)
+
+def amount_to_units(amount: float) -> int:
+    """金額轉換為整數最小單位（6 位小數，與 USDT / TRX 鏈上精度一致）"""
+    return int(round(amount * 1_000_000))
 
 class Database:
     """簡單的 JSON 數據庫"""
     
+    RECONCILE_BATCH_SIZE = 500  # 統計核對時每批在鎖內讀取的記錄數（每批持鎖數毫秒）
+    
     def __init__(self, db_file: str = 'bot_database.json'):
         self.db_file = db_file
         self.lock = threading.Lock()
         self.data = self._load_data()
+        
+        # 待付款訂單索引 {金額單位: {收款地址: {order_id}}}
+        self.pending_index = {}
+        self.index_metrics = {
+            'collisions': 0,
+            'ambiguous_lookups': 0,
+            'hits': 0,
+            'misses': 0
+        }
+        self._rebuild_pending_index()
+        
+        # 時間索引：新格式訂單號按創建時間排序，直接按訂單號範圍查詢；
+        # 舊格式訂單號按 (created_at, order_id) 排序
+        self.order_time_index: List[str] = []
+        self.legacy_time_index: List[tuple] = []
+        self._rebuild_time_index()
+        
+        # 按用戶索引訂單和激活碼，按訂單索引激活碼
+        self.orders_by_user: Dict[int, List[str]] = {}
+        self.codes_by_user: Dict[int, List[str]] = {}
+        self.code_by_order: Dict[str, str] = {}
+        self._rebuild_user_index()
+        
+        # 寫入監聽器，參數為受影響的用戶 ID（用於使緩存失效）
+        self.write_listeners: List[Callable[[int], None]] = []
+        
+        # 統計聚合由寫入路徑增量維護，管理面板讀取時不再掃描
+        self.aggregates = StatsAggregator()
+        self.aggregates.rebuild(self.data)
+        
+        # 已處理交易寫入追加式賬本，主數據庫不再保存
+        self.ledger = TransactionLedger(get_ledger_path(db_file))
+        self._migrate_transactions()
+    
+    def _migrate_transactions(self):
+        """把舊版數據庫中的交易記錄遷移到賬本"""
+        transactions = self.data.pop('transactions', None)
+        if not transactions:
+            return
+        
+        def recorded_at(transaction_data: Dict) -> Optional[float]:
+            try:
+                return datetime.fromisoformat(transaction_data.get('timestamp', '')).timestamp()
+            except (TypeError, ValueError):
+                return None
+        
+        # 按記錄時間順序寫入，窗口外的舊記錄直接合併到磁盤去重段
+        items = sorted(transactions.items(), key=lambda item: recorded_at(item[1]) or 0)
+        for tx_hash, transaction_data in items:
+            self.ledger.append(tx_hash, transaction_data, recorded_at(transaction_data))
+        self.ledger.compact()
+        
+        with self.lock:
+            self._save_data()
+        logger.info(f"📦 已遷移 {len(transactions)} 筆交易記錄到賬本 {self.ledger.ledger_file}")
     
     def _load_data(self) -> Dict:
         """加載數據"""
@@ -39,7 +108,6 @@ class Database:
             'orders': {},
             'activation_codes': {},
             'trial_users': set(),
-            'transactions': {},
             'statistics': {
                 'total_revenue': 0.0,
                 'orders_created': 0,
@@ -47,6 +115,82 @@ class Database:
             }
         }
     
+    def _rebuild_pending_index(self):
+        """從訂單數據重建待付款索引"""
+        self.pending_index = {}
+        for order in self.data['orders'].values():
+            if order.get('status') == 'pending':
+                self._index_order(order)
+    
+    def _rebuild_time_index(self):
+        """從訂單數據重建時間索引"""
+        self.order_time_index = []
+        self.legacy_time_index = []
+        for order in self.data['orders'].values():
+            if order_id_time(order['order_id']):
+                self.order_time_index.append(order['order_id'])
+            else:
+                self.legacy_time_index.append((order.get('created_at', ''), order['order_id']))
+        self.order_time_index.sort()
+        self.legacy_time_index.sort()
+    
+    def _rebuild_user_index(self):
+        """從數據重建用戶索引"""
+        self.orders_by_user = {}
+        self.codes_by_user = {}
+        self.code_by_order = {}
+        for order in self.data['orders'].values():
+            self.orders_by_user.setdefault(order['user_id'], []).append(order['order_id'])
+        for code, code_data in self.data['activation_codes'].items():
+            self._index_activation_code(code, code_data)
+    
+    def _index_activation_code(self, code: str, code_data: Dict):
+        self.codes_by_user.setdefault(code_data.get('user_id'), []).append(code)
+        if code_data.get('order_id'):
+            self.code_by_order.setdefault(code_data['order_id'], code)
+    
+    def add_write_listener(self, listener: Callable[[int], None]):
+        """註冊寫入監聽器，用戶的訂單、試用狀態或激活碼變化時以用戶 ID 調用"""
+        self.write_listeners.append(listener)
+    
+    def _notify_write(self, user_id: int):
+        for listener in self.write_listeners:
+            try:
+                listener(user_id)
+            except Exception as e:
+                logger.error(f"❌ 寫入監聽器出錯: {e}")
+    
+    def _add_to_time_index(self, order: Dict):
+        if order_id_time(order['order_id']):
+            bisect.insort(self.order_time_index, order['order_id'])
+        else:
+            bisect.insort(self.legacy_time_index, (order.get('created_at', ''), order['order_id']))
+    
+    def _index_order(self, order: Dict):
+        """把待付款訂單加入金額索引"""
+        units = amount_to_units(order['amount'])
+        address = order.get('payment_address') or ''
+        order_ids = self.pending_index.setdefault(units, {}).setdefault(address, set())
+        order_ids.add(order['order_id'])
+        
+        if len(order_ids) > 1:
+            self.index_metrics['collisions'] += 1
+            logger.warning(f"⚠️ 待付款金額衝突: {order['amount']} -> {sorted(order_ids)}")
+    
+    def _unindex_order(self, order: Dict):
+        """把訂單從金額索引移除"""
+        units = amount_to_units(order['amount'])
+        address = order.get('payment_address') or ''
+        by_address = self.pending_index.get(units)
+        if not by_address or address not in by_address:
+            return
+        
+        by_address[address].discard(order['order_id'])
+        if not by_address[address]:
+            del by_address[address]
+        if not by_address:
+            del self.pending_index[units]
+    
     def _save_data(self):
         """保存數據"""
         try:
@@ -70,12 +214,43 @@ class Database:
                     'created_at': datetime.now().isoformat(),
                     'last_active': datetime.now().isoformat()
                 }
+                self.aggregates.on_user_added(self.data['users'][str(user_id)])
             else:
                 # 更新最後活躍時間
-                self.data['users'][str(user_id)]['last_active'] = datetime.now().isoformat()
+                user = self.data['users'][str(user_id)]
+                user['last_active'] = datetime.now().isoformat()
+                # 曾屏蔽機器人的用戶重新互動，恢復接收群發
+                if user.pop('blocked_at', None):
+                    self.aggregates.on_user_blocked(user_id, False)
             
             self._save_data()
     
+    def mark_users_blocked(self, user_ids: List[int]):
+        """標記用戶已屏蔽機器人（群發時發送被拒絕），之後的群發受眾不再包含這些用戶"""
+        with self.lock:
+            blocked_at = datetime.now().isoformat()
+            for user_id in user_ids:
+                user = self.data['users'].get(str(user_id))
+                if user is not None:
+                    user['blocked_at'] = blocked_at
+                self.aggregates.on_user_blocked(user_id)
+            self._save_data()
+    
+    def get_audience(self, audience: str) -> List[int]:
+        """群發受眾（按用戶 ID 升序，排除已屏蔽機器人的用戶）
+        
+        audience: all（全部用戶）、trial（試用用戶）或方案名（該方案的付費用戶）
+        """
+        with self.lock:
+            if audience == 'all':
+                user_ids = [int(user_id) for user_id in self.data['users']]
+            elif audience == 'trial':
+                user_ids = list(self.data['trial_users'])
+            else:
+                user_ids = list(self.aggregates.buyers_by_plan.get(audience, ()))
+            blocked = self.aggregates.blocked_users
+            return sorted(user_id for user_id in user_ids if user_id not in blocked)
+    
     def has_used_trial(self, user_id: int) -> bool:
         """檢查用戶是否已使用過試用"""
         return user_id in self.data['trial_users']
@@ -85,14 +260,22 @@ class Database:
         with self.lock:
             self.data['trial_users'].add(user_id)
             self._save_data()
+            self._notify_write(user_id)
     
     def create_order(self, order_data: Dict):
         """創建訂單"""
         with self.lock:
             order_id = order_data['order_id']
+            if order_id not in self.data['orders']:
+                self._add_to_time_index(order_data)
+                self.orders_by_user.setdefault(order_data['user_id'], []).append(order_id)
             self.data['orders'][order_id] = order_data
             self.data['statistics']['orders_created'] += 1
+            self.aggregates.on_order_created(order_data)
+            if order_data.get('status') == 'pending':
+                self._index_order(order_data)
             self._save_data()
+            self._notify_write(order_data['user_id'])
     
     def get_order(self, order_id: str) -> Optional[Dict]:
         """獲取訂單"""
@@ -102,6 +285,11 @@ class Database:
         """更新訂單狀態"""
         with self.lock:
             if order_id in self.data['orders']:
+                order = self.data['orders'][order_id]
+                if order.get('status') == 'pending' and status != 'pending':
+                    self._unindex_order(order)
+                self.aggregates.on_order_status_changed(order, order.get('status'), status)
+                
                 self.data['orders'][order_id]['status'] = status
                 self.data['orders'][order_id]['updated_at'] = datetime.now().isoformat()
                 
@@ -113,21 +301,51 @@ class Database:
                     self.data['statistics']['total_revenue'] += amount
                 
                 self._save_data()
+                self._notify_write(order['user_id'])
+    
+    def find_pending_order(self, amount: float, to_address: str = None) -> Optional[Dict]:
+        """根據精確金額（和收款地址）查找唯一的待付款訂單，存在衝突時不返回"""
+        by_address = self.pending_index.get(amount_to_units(amount), {})
+        
+        if to_address:
+            # 舊訂單沒有記錄收款地址，也作為候選
+            order_ids = by_address.get(to_address, set()) | by_address.get('', set())
+        else:
+            order_ids = set().union(*by_address.values()) if by_address else set()
+        
+        if not order_ids:
+            self.index_metrics['misses'] += 1
+            return None
+        
+        if len(order_ids) > 1:
+            self.index_metrics['ambiguous_lookups'] += 1
+            logger.warning(f"⚠️ 金額 {amount} 對應多個待付款訂單，拒絕自動匹配: {sorted(order_ids)}")
+            return None
+        
+        self.index_metrics['hits'] += 1
+        return self.data['orders'].get(next(iter(order_ids)))
+    
+    def get_pending_orders(self) -> List[Dict]:
+        """獲取所有待付款訂單（通過索引，不掃描全部訂單）"""
+        order_ids = {order_id for by_address in self.pending_index.values()
+                     for ids in by_address.values() for order_id in ids}
+        return [self.data['orders'][order_id] for order_id in order_ids if order_id in self.data['orders']]
     
     def find_order_by_amount(self, amount: float) -> Optional[Dict]:
         """根據金額查找待付款訂單"""
-        for order in self.data['orders'].values():
-            if (order['status'] == 'pending' and 
-                abs(order['amount'] - amount) < 0.01):  # 允許小數點誤差
-                return order
-        return None
+        return self.find_pending_order(amount)
+    
+    def get_pending_index_metrics(self) -> Dict:
+        """獲取待付款索引指標"""
+        metrics = dict(self.index_metrics)
+        metrics['indexed_amounts'] = len(self.pending_index)
+        return metrics
     
     def get_user_orders(self, user_id: int) -> List[Dict]:
-        """獲取用戶的所有訂單"""
-        user_orders = []
-        for order in self.data['orders'].values():
-            if order['user_id'] == user_id:
-                user_orders.append(order)
+        """獲取用戶的所有訂單（通過用戶索引，不掃描全部訂單）"""
+        orders = self.data['orders']
+        user_orders = [orders[order_id] for order_id in list(self.orders_by_user.get(user_id, ()))
+                       if order_id in orders]
         
         # 按創建時間排序
         user_orders.sort(key=lambda x: x['created_at'], reverse=True)
@@ -137,9 +355,13 @@ class Database:
         """保存激活碼"""
         with self.lock:
             activation_code = code_data['activation_code']
+            if activation_code not in self.data['activation_codes']:
+                self._index_activation_code(activation_code, code_data)
             self.data['activation_codes'][activation_code] = code_data
             self.data['statistics']['activations_generated'] += 1
+            self.aggregates.on_activation_code_saved(code_data)
             self._save_data()
+            self._notify_write(code_data.get('user_id'))
     
     def get_activation_code(self, activation_code: str) -> Optional[Dict]:
         """獲取激活碼信息"""
@@ -147,20 +369,20 @@ class Database:
     
     def get_activation_code_by_order(self, order_id: str) -> Optional[str]:
         """根據訂單ID獲取激活碼"""
-        for code, data in self.data['activation_codes'].items():
-            if data.get('order_id') == order_id:
-                return code
-        return None
+        return self.code_by_order.get(order_id)
+    
+    def get_user_activation_codes(self, user_id: int) -> List[Dict]:
+        """獲取用戶的所有激活碼數據（通過用戶索引）"""
+        codes = self.data['activation_codes']
+        return [codes[code] for code in list(self.codes_by_user.get(user_id, ())) if code in codes]
     
     def save_transaction(self, tx_hash: str, transaction_data: Dict):
-        """保存交易記錄"""
-        with self.lock:
-            self.data['transactions'][tx_hash] = transaction_data
-            self._save_data()
+        """保存交易記錄（追加到賬本，不重寫主數據庫）"""
+        self.ledger.append(tx_hash, transaction_data)
     
     def transaction_exists(self, tx_hash: str) -> bool:
         """檢查交易是否已存在"""
-        return tx_hash in self.data['transactions']
+        return self.ledger.contains(tx_hash)
     
     def cleanup_expired_orders(self):
         """清理過期訂單"""
@@ -175,75 +397,91 @@ class Database:
                         expired_orders.append(order_id)
             
             for order_id in expired_orders:
+                self._unindex_order(self.data['orders'][order_id])
+                self.aggregates.on_order_status_changed(self.data['orders'][order_id], 'pending', 'expired')
                 self.data['orders'][order_id]['status'] = 'expired'
             
             if expired_orders:
                 self._save_data()
+                for order_id in expired_orders:
+                    self._notify_write(self.data['orders'][order_id]['user_id'])
             
             return len(expired_orders)
     
     def get_statistics(self) -> Dict:
-        """獲取統計數據"""
+        """獲取統計數據（讀取增量維護的聚合，不掃描訂單和激活碼，可在事件循環中直接調用）"""
         stats = self.data['statistics'].copy()
-        
-        # 計算額外統計
         stats['total_users'] = len(self.data['users'])
         stats['total_orders'] = len(self.data['orders'])
         stats['trial_users'] = len(self.data['trial_users'])
+        stats.update(self.aggregates.snapshot())
+        return stats
+    
+    def reconcile_statistics(self) -> Dict:
+        """全量重建統計聚合並與增量結果核對，返回有偏差的字段 {字段: (增量值, 重建值)}
         
-        # 按狀態統計訂單
-        status_counts = {}
-        for order in self.data['orders'].values():
-            status = order['status']
-            status_counts[status] = status_counts.get(status, 0) + 1
-        
-        stats['pending_orders'] = status_counts.get('pending', 0)
-        stats['completed_orders'] = status_counts.get('paid', 0)
-        stats['expired_orders'] = status_counts.get('expired', 0)
+        分批重建，每批只短暫持有鎖，不阻塞客戶寫入；不要在存儲線程中調用（會佔用存儲線程直到重建完成）"""
+        with self.lock:
+            previous = self.aggregates
+            rebuilt = previous.begin_rebuild()
+            keys = {kind: list(self.data[kind]) for kind in StatsAggregator.KINDS}
         
-        # 激活碼統計
-        stats['total_activations'] = len(self.data['activation_codes'])
-        stats['used_activations'] = sum(1 for code_data in self.data['activation_codes'].values() 
-                                       if code_data.get('used', False))
-        stats['trial_activations'] = sum(1 for code_data in self.data['activation_codes'].values() 
-                                        if code_data.get('plan_type') == 'trial')
+        try:
+            unread = {kind: set(kind_keys) for kind, kind_keys in keys.items()}
+            with self.lock:
+                rebuilt.start_forwarding(unread, keys)
+            
+            for kind, kind_keys in keys.items():
+                for start in range(0, len(kind_keys), self.RECONCILE_BATCH_SIZE):
+                    with self.lock:
+                        records = self.data[kind]
+                        rebuilt.add_records(kind, [(key, records[key])
+                                                   for key in kind_keys[start:start + self.RECONCILE_BATCH_SIZE]
+                                                   if key in records])
+            
+            # 讀取時會先彈出新到期的激活碼（重建後首次讀取需處理全部已到期的），先在鎖外完成
+            rebuilt.activation_statistics()
+            self.aggregates.activation_statistics()
+            with self.lock:
+                current = self.aggregates.snapshot()
+                expected = rebuilt.snapshot()
+                self.aggregates = rebuilt
+        finally:
+            previous.end_rebuild()
         
-        # 今日收入
-        today = datetime.now().date()
-        today_revenue = 0.0
-        for order in self.data['orders'].values():
-            if order['status'] == 'paid':
-                order_date = datetime.fromisoformat(order['created_at']).date()
-                if order_date == today:
-                    today_revenue += order['amount']
+        drift = {key: (current[key], value) for key, value in expected.items() if current.get(key) != value}
+        if drift:
+            logger.warning(f"⚠️ 統計聚合與全量重建不一致，已修正: {drift}")
+        return drift
+    
+    def get_orders_between(self, start: datetime, end: datetime = None) -> List[Dict]:
+        """獲取創建時間在 [start, end) 內的訂單（按訂單號範圍查詢，不掃描全部訂單）"""
+        order_ids = self.order_time_index[bisect.bisect_left(self.order_time_index, order_id_lower_bound(start)):
+                                          bisect.bisect_left(self.order_time_index, order_id_lower_bound(end))
+                                          if end else None]
         
-        stats['today_revenue'] = today_revenue
+        start_key, end_key = start.isoformat(), end.isoformat() if end else None
+        legacy = self.legacy_time_index[bisect.bisect_left(self.legacy_time_index, (start_key,)):
+                                        bisect.bisect_left(self.legacy_time_index, (end_key,)) if end_key else None]
         
-        return stats
+        orders = self.data['orders']
+        return ([orders[order_id] for order_id in order_ids if order_id in orders]
+                + [orders[order_id] for _, order_id in legacy if order_id in orders])
+    
+    def latest_order_id(self) -> Optional[str]:
+        """最新的按時間排序的訂單號"""
+        return self.order_time_index[-1] if self.order_time_index else None
     
     def get_recent_orders_by_amount(self, amount: float, hours: int = 1) -> List[Dict]:
         """獲取指定時間內相同金額的訂單"""
         cutoff_time = datetime.now() - timedelta(hours=hours)
-        matching_orders = []
-        
-        for order in self.data['orders'].values():
-            order_time = datetime.fromisoformat(order['created_at'])
-            if (order_time > cutoff_time and 
-                abs(order['amount'] - amount) < 0.001):  # 允許極小誤差
-                matching_orders.append(order)
-        
-        return matching_orders
+        return [order for order in self.get_orders_between(cutoff_time)
+                if abs(order['amount'] - amount) < 0.001]  # 允許極小誤差
     
     def get_recent_orders(self, days: int = 7) -> List[Dict]:
         """獲取最近的訂單"""
         cutoff_date = datetime.now() - timedelta(days=days)
-        recent_orders = []
-        
-        for order in self.data['orders'].values():
-            order_date = datetime.fromisoformat(order['created_at'])
-            if order_date > cutoff_date:
-                recent_orders.append(order)
-        
+        recent_orders = self.get_orders_between(cutoff_date)
         recent_orders.sort(key=lambda x: x['created_at'], reverse=True)
         return recent_orders
     
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地 TronScan 模擬服務 - 回放錄製或合成的鏈上交易，用於壓測付款流程
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+from tron_monitor import base58_to_hex, hex_to_base58check
+
+logger = logging.getLogger(__name__)
+
+USDT_CONTRACT = 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t'
+
+def random_hex_address() -> str:
+    """生成隨機 21 字節 TRON 地址"""
+    return '41' + os.urandom(20).hex()
+
+class FakeChain:
+    """模擬鏈 - 按固定間隔出塊，包含預約付款和背景交易"""
+
+    def __init__(self, block_interval: float = 3.0, noise_per_block: int = 0,
+                 usdt_contract: str = USDT_CONTRACT, start_block: int = 60_000_000):
+        self.block_interval = block_interval
+        self.noise_per_block = noise_per_block
+        self.usdt_contract_hex = base58_to_hex(usdt_contract)
+
+        self.blocks: Dict[int, Dict] = {}
+        self.transaction_infos: Dict[str, Dict] = {}
+        self.head = start_block
+
+        # 按收款地址索引的已上鏈轉賬（最新在後）
+        self.transfers_by_address = defaultdict(list)
+
+        # 待上鏈轉賬 [(上鏈時間, 轉賬)]
+        self.scheduled: List = []
+
+        # 錄製的區塊（回放模式）
+        self.replay_blocks: List[Dict] = []
+
+    def schedule_transfer(self, to_address: str, amount: float, currency: str = 'USDT',
+                          at: float = None, success: bool = True, method: str = 'transfer') -> Dict:
+        """預約一筆轉賬，在 at 時間之後的第一個區塊上鏈（USDT 可用 transfer 或 transferFrom）"""
+        transfer = {
+            'tx_id': os.urandom(32).hex(),
+            'from_hex': random_hex_address(),
+            'to_hex': base58_to_hex(to_address),
+            'amount_units': int(round(amount * 1_000_000)),
+            'currency': currency,
+            'success': success,
+            'method': method
+        }
+        self.scheduled.append((at or time.time(), transfer))
+        return transfer
+
+    def _build_transaction(self, transfer: Dict) -> Dict:
+        """構造 getblockbynum 返回格式的交易"""
+        if transfer['currency'] == 'TRX':
+            contract = {
+                'type': 'TransferContract',
+                'parameter': {'value': {
+                    'owner_address': transfer['from_hex'],
+                    'to_address': transfer['to_hex'],
+                    'amount': transfer['amount_units']
+                }}
+            }
+        else:
+            amount = format(transfer['amount_units'], '064x')
+            if transfer.get('method') == 'transferFrom':
+                # transferFrom(from, to, amount)：調用者是被授權方，不是付款方
+                data = '23b872dd' + '0' * 24 + transfer['from_hex'][2:] + '0' * 24 + transfer['to_hex'][2:] + amount
+            else:
+                data = 'a9059cbb' + '0' * 24 + transfer['to_hex'][2:] + amount
+            contract = {
+                'type': 'TriggerSmartContract',
+                'parameter': {'value': {
+                    'owner_address': transfer['from_hex'],
+                    'contract_address': self.usdt_contract_hex,
+                    'data': data
+                }}
+            }
+
+        return {'txID': transfer['tx_id'], 'raw_data': {'contract': [contract]}}
+
+    def _build_transaction_info(self, transfer: Dict, block_number: int, timestamp_ms: int) -> Dict:
+        """構造 gettransactioninfobyid 返回格式"""
+        info = {
+            'id': transfer['tx_id'],
+            'blockNumber': block_number,
+            'blockTimeStamp': timestamp_ms,
+            'receipt': {'result': 'SUCCESS' if transfer['success'] else 'REVERT'}
+        }
+
+        if transfer['currency'] != 'TRX':
+            info['contract_address'] = self.usdt_contract_hex
+            info['log'] = [{
+                'address': self.usdt_contract_hex[2:],
+                'topics': [
+                    'ddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef',
+                    '0' * 24 + transfer['from_hex'][2:],
+                    '0' * 24 + transfer['to_hex'][2:]
+                ],
+                'data': format(transfer['amount_units'], '064x')
+            }]
+
+        return info
+
+    def mine_block(self) -> Dict:
+        """出一個新區塊"""
+        now = time.time()
+        number = self.head + 1
+        timestamp_ms = int(now * 1000)
+
+        due = [t for at, t in self.scheduled if at <= now]
+        self.scheduled = [(at, t) for at, t in self.scheduled if at > now]
+
+        # 背景交易：轉給隨機地址的 USDT
+        for _ in range(self.noise_per_block):
+            due.append({
+                'tx_id': os.urandom(32).hex(),
+                'from_hex': random_hex_address(),
+                'to_hex': random_hex_address(),
+                'amount_units': random.randint(1, 10_000) * 10_000,
+                'currency': 'USDT',
+                'success': True
+            })
+
+        transactions = []
+        for transfer in due:
+            transactions.append(self._build_transaction(transfer))
+            self.transaction_infos[transfer['tx_id']] = self._build_transaction_info(transfer, number, timestamp_ms)
+            transfer['block_number'] = number
+            transfer['timestamp'] = timestamp_ms
+            if transfer['success']:
+                self.transfers_by_address[transfer['to_hex']].append(transfer)
+
+        block = {
+            'blockID': os.urandom(32).hex(),
+            'block_header': {'raw_data': {'number': number, 'timestamp': timestamp_ms}},
+            'transactions': transactions
+        }
+        self.blocks[number] = block
+        self.head = number
+        return block
+
+    def replay_next_block(self) -> Optional[Dict]:
+        """回放下一個錄製區塊"""
+        if not self.replay_blocks:
+            return None
+
+        recorded = self.replay_blocks.pop(0)
+        block = recorded['block']
+        number = block['block_header']['raw_data']['number']
+
+        self.blocks[number] = block
+        for info in recorded.get('transaction_infos', []):
+            self.transaction_infos[info['id']] = info
+        self.head = number
+        return block
+
+    def load_fixture(self, path: str):
+        """加載錄製的區塊數據 {"blocks": [{"block": {...}, "transaction_infos": [...]}]}"""
+        with open(path, 'r', encoding='utf-8') as f:
+            self.replay_blocks = json.load(f).get('blocks', [])
+        if self.replay_blocks:
+            first = self.replay_blocks[0]['block']['block_header']['raw_data']['number']
+            self.head = first - 1
+        logger.info(f"📼 加載錄製區塊 {len(self.replay_blocks)} 個")
+
+    def save_fixture(self, path: str):
+        """保存已出的區塊為錄製數據"""
+        blocks = []
+        for number in sorted(self.blocks):
+            block = self.blocks[number]
+            infos = [self.transaction_infos[tx['txID']] for tx in block['transactions']
+                     if tx['txID'] in self.transaction_infos]
+            blocks.append({'block': block, 'transaction_infos': infos})
+
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'blocks': blocks}, f)
+
+    def recent_transfers(self, address: str, currency: str, limit: int, offset: int = 0,
+                         min_timestamp: int = 0) -> List[Dict]:
+        """地址最近收到的轉賬（最新在前，從 offset 開始取 limit 條，只包含不早於 min_timestamp 的）"""
+        transfers = self.transfers_by_address.get(base58_to_hex(address), [])
+        matched = [t for t in reversed(transfers) if t['currency'] == currency and t['timestamp'] >= min_timestamp]
+        return matched[offset:offset + limit]
+
+class FakeTronScan:
+    """TronScan / TronGrid 接口模擬"""
+
+    def __init__(self, chain: FakeChain, rate_limit: float = 0, latency: float = 0.0):
+        self.chain = chain
+        self.rate_limit = rate_limit  # 每秒請求上限，0 為不限
+        self.latency = latency
+        self.request_counts = defaultdict(int)
+        self.throttled = 0
+        self._window_start = time.time()
+        self._window_count = 0
+        self._mining_task = None
+        self._runner = None
+
+        self.app = web.Application(middlewares=[self._middleware])
+        self.app.router.add_get('/api/block', self.handle_block)
+        self.app.router.add_get('/api/transaction', self.handle_trx_transactions)
+        self.app.router.add_get('/v1/accounts/{address}/transactions/trc20', self.handle_trc20_transactions)
+        self.app.router.add_post('/wallet/getblockbynum', self.handle_get_block_by_num)
+        self.app.router.add_post('/wallet/gettransactioninfobyid', self.handle_get_transaction_info)
+        self.app.router.add_post('/wallet/gettransactioninfobyblocknum', self.handle_get_transaction_info_by_block)
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        route = request.match_info.route.resource
+        key = route.canonical if route is not None else request.path
+        self.request_counts[key] += 1
+
+        if self.rate_limit:
+            now = time.time()
+            if now - self._window_start >= 1:
+                self._window_start = now
+                self._window_count = 0
+            self._window_count += 1
+            if self._window_count > self.rate_limit:
+                self.throttled += 1
+                return web.Response(status=429, headers={'Retry-After': '1'})
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        return await handler(request)
+
+    async def handle_block(self, request):
+        block = {'number': self.chain.head, 'timestamp': int(time.time() * 1000)}
+        return web.json_response({'number': self.chain.head, 'data': [block]})
+
+    async def handle_trx_transactions(self, request):
+        address = request.query.get('address', '')
+        limit = int(request.query.get('limit', 20))
+        start = int(request.query.get('start', 0))
+        min_timestamp = int(request.query.get('start_timestamp', 0))
+        data = [{
+            'hash': t['tx_id'],
+            'timestamp': t['timestamp'],
+            'ownerAddress': hex_to_base58check(t['from_hex']),
+            'toAddress': address,
+            'amount': t['amount_units'],
+            'contractType': 1
+        } for t in self.chain.recent_transfers(address, 'TRX', limit, start, min_timestamp)]
+        return web.json_response({'data': data, 'total': len(data)})
+
+    async def handle_trc20_transactions(self, request):
+        address = request.match_info['address']
+        limit = int(request.query.get('limit', 20))
+        # fingerprint 為下一頁的偏移量（真實接口為不透明字符串）
+        offset = int(request.query.get('fingerprint', 0))
+        min_timestamp = int(request.query.get('min_timestamp', 0))
+        data = [{
+            'transaction_id': t['tx_id'],
+            'block_timestamp': t['timestamp'],
+            'from': hex_to_base58check(t['from_hex']),
+            'to': address,
+            'value': str(t['amount_units']),
+            'token_info': {'address': USDT_CONTRACT, 'decimals': 6, 'symbol': 'USDT'}
+        } for t in self.chain.recent_transfers(address, 'USDT', limit, offset, min_timestamp)]
+        meta = {'page_size': len(data)}
+        if len(data) >= limit:
+            meta['fingerprint'] = str(offset + len(data))
+        return web.json_response({'data': data, 'success': True, 'meta': meta})
+
+    async def handle_get_block_by_num(self, request):
+        body = await request.json()
+        return web.json_response(self.chain.blocks.get(body.get('num'), {}))
+
+    async def handle_get_transaction_info(self, request):
+        body = await request.json()
+        return web.json_response(self.chain.transaction_infos.get(body.get('value'), {}))
+
+    async def handle_get_transaction_info_by_block(self, request):
+        body = await request.json()
+        block = self.chain.blocks.get(body.get('num'), {})
+        infos = [self.chain.transaction_infos[tx['txID']] for tx in block.get('transactions', [])
+                 if tx['txID'] in self.chain.transaction_infos]
+        return web.json_response(infos)
+
+    async def _mine_loop(self):
+        while True:
+            await asyncio.sleep(self.chain.block_interval)
+            if self.chain.replay_blocks:
+                self.chain.replay_next_block()
+            else:
+                self.chain.mine_block()
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0, mine: bool = True) -> str:
+        """啟動服務，返回基礎 URL；多個服務共用同一條鏈時只讓一個出塊"""
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        actual_port = site._server.sockets[0].getsockname()[1]
+        if mine:
+            self._mining_task = asyncio.create_task(self._mine_loop())
+        return f"http://{host}:{actual_port}"
+
+    async def stop(self):
+        if self._mining_task:
+            self._mining_task.cancel()
+        if self._runner:
+            await self._runner.cleanup()
+
+    def get_stats(self) -> Dict:
+        return {
+            'head': self.chain.head,
+            'requests_total': sum(self.request_counts.values()),
+            'requests_by_endpoint': dict(self.request_counts),
+            'throttled': self.throttled
+        }
+
+async def serve(args):
+    chain = FakeChain(block_interval=args.block_interval, noise_per_block=args.noise)
+    if args.fixture:
+        chain.load_fixture(args.fixture)
+
+    server = FakeTronScan(chain, rate_limit=args.rate_limit, latency=args.latency)
+    url = await server.start(args.host, args.port)
+    print(f"🧪 模擬 TronScan 服務已啟動: {url}")
+    print(f"   設置 TRONGRID_API_URL={url} 讓機器人連接本地服務")
+
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        if args.record:
+            chain.save_fixture(args.record)
+        await server.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description='本地 TronScan 模擬服務')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--block-interval', type=float, default=3.0, help='出塊間隔（秒）')
+    parser.add_argument('--noise', type=int, default=0, help='每個區塊的背景交易數')
+    parser.add_argument('--rate-limit', type=float, default=0, help='每秒請求上限，超過返回 429')
+    parser.add_argument('--latency', type=float, default=0.0, help='每個請求附加延遲（秒）')
+    parser.add_argument('--fixture', help='回放錄製區塊的 JSON 文件')
+    parser.add_argument('--record', help='退出時把區塊保存為錄製文件')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        print("👋 模擬服務已停止")
+
+if __name__ == "__main__":
+    main()
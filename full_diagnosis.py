@@ -11,6 +11,8 @@ import urllib.parse
 import sys
 from datetime import datetime
 
+from transaction_ledger import get_ledger_path, load_ledger
+
 def check_environment():
     """檢查環境變量"""
     print("🔧 檢查環境變量...")
@@ -126,7 +128,7 @@ def check_database():
             data = json.load(f)
         
         orders = data.get('orders', {})
-        transactions = data.get('transactions', {})
+        transactions = data.get('transactions') or load_ledger(get_ledger_path(db_file))
         
         print(f"  📋 總訂單數: {len(orders)}")
         print(f"  💰 總交易數: {len(transactions)}")
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+處理器壓測 - 構造模擬的 Telegram 更新驅動真實的處理器（/start、購買、查單、查詢付款、
+文字消息、管理員面板），Bot API 由本地樁替代，
+按用戶規模統計吞吐量、每個處理器的 p50/p99 耗時和數據庫寫入次數
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+from payment_load_test import percentile
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+FIRST_USER_ID = 500000
+
+def make_stub_request(latency: float):
+    """Bot API 樁：不連接 Telegram，按方法返回固定結果並計數"""
+    from telegram.request import BaseRequest
+
+    class StubRequest(BaseRequest):
+        def __init__(self):
+            self.calls = Counter()
+            self._message_ids = 0
+
+        @property
+        def read_timeout(self):
+            return None
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                             connect_timeout=None, pool_timeout=None):
+            api_method = url.rsplit('/', 1)[-1]
+            self.calls[api_method] += 1
+            if latency:
+                await asyncio.sleep(latency)
+
+            params = request_data.parameters if request_data else {}
+            if api_method == 'getMe':
+                result = BOT_USER
+            elif api_method in ('sendMessage', 'editMessageText'):
+                self._message_ids += 1
+                chat_id = int(params.get('chat_id', 0))
+                result = {
+                    'message_id': params.get('message_id', self._message_ids),
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': BOT_USER,
+                    'text': params.get('text', '')
+                }
+            else:
+                result = True
+            return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    return StubRequest()
+
+class Recorder:
+    """記錄每次處理器調用的耗時，按「處理器:操作」分組"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+
+    @staticmethod
+    def label(handler_name: str, update) -> str:
+        if update.callback_query:
+            # 去掉回調數據中的訂單號，同類操作歸為一組
+            action = re.sub(r'_?TG[0-9A-Z]+$', '', update.callback_query.data or '')
+        elif update.message and update.message.text:
+            text = update.message.text
+            if text.startswith('/'):
+                action = text.split()[0]
+            elif text.startswith('TG'):
+                action = 'order_query'
+            else:
+                action = 'text'
+        else:
+            action = 'other'
+        return f"{handler_name}:{action}"
+
+    def wrap(self, handler):
+        name = getattr(handler, '__name__', repr(handler))
+
+        @functools.wraps(handler)
+        async def recorded(update, context):
+            started_at = time.perf_counter()
+            label = self.label(name, update)
+            try:
+                return await handler(update, context)
+            except Exception:
+                self.errors[label] += 1
+                raise
+            finally:
+                self.samples[label].append(time.perf_counter() - started_at)
+
+        return recorded
+
+class UpdateFactory:
+    """構造模擬更新"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+        self.message_id = 0
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}", 'username': f"bench_{user_id}"}
+
+    def _message(self, user_id: int, text: str) -> dict:
+        self.message_id += 1
+        message = {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return message
+
+    def _update(self, payload: dict):
+        from telegram import Update
+
+        self.update_id += 1
+        return Update.de_json({'update_id': self.update_id, **payload}, self.bot)
+
+    def text(self, user_id: int, text: str):
+        return self._update({'message': self._message(user_id, text)})
+
+    def callback(self, user_id: int, data: str):
+        message = self._message(user_id, '菜單')
+        message['from'] = BOT_USER
+        return self._update({'callback_query': {
+            'id': str(self.update_id + 1),
+            'from': self._user(user_id),
+            'chat_instance': str(user_id),
+            'message': message,
+            'data': data
+        }})
+
+async def run_user(app, bot, factory: UpdateFactory, user_id: int, is_admin: bool):
+    """一個用戶的完整操作流程，同一用戶的更新按順序逐個處理"""
+
+    async def feed(update):
+        await app.update_processor.process_update(update, app.process_update(update))
+
+    await feed(factory.text(user_id, '/start'))
+    await feed(factory.callback(user_id, 'buy_menu'))
+    await feed(factory.callback(user_id, 'buy_weekly'))
+    await feed(factory.callback(user_id, 'my_orders'))
+
+    orders = await bot.storage.run(bot.db.get_user_orders, user_id)
+    if orders:
+        order_id = orders[-1]['order_id']
+        await feed(factory.callback(user_id, f"status_{order_id}"))
+        await feed(factory.callback(user_id, f"check_payment_{order_id}"))
+        await feed(factory.text(user_id, order_id))
+
+    await feed(factory.text(user_id, '你好'))
+
+    if is_admin:
+        await feed(factory.text(user_id, '/admin'))
+        await feed(factory.callback(user_id, 'admin_stats'))
+
+async def run_level(args, users: int) -> dict:
+    """在獨立的工作目錄中按指定用戶數運行一輪"""
+    from telegram.ext import Application
+
+    from main import TGMarketingBot, register_handlers
+    from telegram_outbox import TelegramOutbox
+    from update_processor import PerUserUpdateProcessor
+
+    workdir = tempfile.mkdtemp(prefix=f"handler_bench_{users}_")
+    os.chdir(workdir)
+    print(f"\n📁 工作目錄: {workdir}")
+    admin_ids = [FIRST_USER_ID + i for i in range(min(args.admins, users))]
+    os.environ['ADMIN_IDS'] = ','.join(str(uid) for uid in admin_ids)
+
+    bot = TGMarketingBot()
+    bot.activation_manager.enable_cloud_sync = False
+
+    # 查詢付款會觸發鏈上監控，壓測只衡量處理器本身，不訪問 TRON 網絡
+    async def no_monitoring():
+        pass
+
+    bot.start_smart_monitoring = no_monitoring
+
+    # 統計數據庫寫入（每次寫入都序列化整個文件）
+    writes = {'count': 0, 'seconds': 0.0}
+    save_data = bot.db._save_data
+
+    def counted_save_data(*a, **kw):
+        started_at = time.perf_counter()
+        try:
+            return save_data(*a, **kw)
+        finally:
+            writes['count'] += 1
+            writes['seconds'] += time.perf_counter() - started_at
+
+    bot.db._save_data = counted_save_data
+
+    if not args.real_rate_limits:
+        # 默認不限速，只衡量處理器；--real-rate-limits 時使用配置中的 Telegram 限速
+        bot.outbox = TelegramOutbox(global_rate=1_000_000, chat_rate=1_000_000, chat_burst=1_000_000)
+
+    stub = make_stub_request(args.api_latency)
+    recorder = Recorder()
+    app = (
+        Application.builder()
+        .token(bot.config.BOT_TOKEN)
+        .request(stub)
+        .get_updates_request(make_stub_request(0))
+        .concurrent_updates(PerUserUpdateProcessor(max_workers=args.workers))
+        .build()
+    )
+    bot.application = app
+    bot.update_processor = app.update_processor
+    register_handlers(app, bot, wrap=recorder.wrap)
+
+    await app.initialize()
+    bot.outbox.start(app.bot)
+    factory = UpdateFactory(app.bot)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(
+        run_user(app, bot, factory, FIRST_USER_ID + i, FIRST_USER_ID + i in admin_ids)
+        for i in range(users)
+    ))
+    elapsed = time.perf_counter() - started_at
+
+    await bot.outbox.stop()
+    await app.shutdown()
+    bot.storage.shutdown()
+
+    total = sum(len(samples) for samples in recorder.samples.values())
+    print(f"\n📊 壓測結果（{users} 個用戶，工作槽 {args.workers}，API 延遲 {args.api_latency * 1000:.0f}ms）")
+    print(f"   更新數: {total}，耗時: {elapsed:.2f}s，吞吐量: {total / elapsed:.1f} 更新/秒")
+    print(f"   {'處理器:操作':<36}{'次數':>7}{'p50(ms)':>10}{'p99(ms)':>10}{'錯誤':>6}")
+    for label in sorted(recorder.samples):
+        samples = recorder.samples[label]
+        print(f"   {label:<36}{len(samples):>7}{percentile(samples, 50) * 1000:>10.1f}"
+              f"{percentile(samples, 99) * 1000:>10.1f}{recorder.errors[label]:>6}")
+    print(f"   數據庫寫入: {writes['count']} 次（每更新 {writes['count'] / max(1, total):.2f} 次），"
+          f"序列化耗時共 {writes['seconds']:.2f}s")
+    print(f"   Bot API 調用: {dict(stub.calls)}")
+    print(f"   存儲執行器: {bot.storage.get_metrics()['queue_wait']}")
+    print(f"   更新處理器: {app.update_processor.get_metrics()}")
+
+    return {
+        'users': users,
+        'updates': total,
+        'seconds': elapsed,
+        'db_writes': writes['count'],
+        'errors': sum(recorder.errors.values()),
+        'generated_at': datetime.now().isoformat()
+    }
+
+async def run_benchmark(args):
+    results = []
+    for users in args.users:
+        results.append(await run_level(args, users))
+
+    if len(results) > 1:
+        print("\n📈 規模對比")
+        for result in results:
+            print(f"   {result['users']:>6} 用戶: {result['updates'] / result['seconds']:>8.1f} 更新/秒，"
+                  f"數據庫寫入 {result['db_writes']}，錯誤 {result['errors']}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='處理器壓測（模擬 Telegram 更新，本地 Bot API 樁）')
+    parser.add_argument('--users', type=lambda s: [int(n) for n in s.split(',') if n.strip()], default=[100, 1000],
+                        help='用戶數，可用逗號分隔多個規模，例如 100,1000,10000')
+    parser.add_argument('--admins', type=int, default=1, help='其中管理員用戶數（額外執行 /admin 和統計面板）')
+    parser.add_argument('--workers', type=int, default=32, help='並發處理更新的工作槽數')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='模擬 Bot API 每請求延遲（秒）')
+    parser.add_argument('--real-rate-limits', action='store_true', help='使用配置中的 Telegram 發送限速')
+    args = parser.parse_args()
+
+    # 在臨時目錄運行，避免寫入真實數據庫和日誌
+    sys.path.insert(0, PROJECT_DIR)
+    os.environ.setdefault('BOT_TOKEN', '000000:LOAD_TEST')
+
+    logging.disable(logging.WARNING)
+    asyncio.run(run_benchmark(args))
+
+if __name__ == "__main__":
+    main()
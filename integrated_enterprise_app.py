@@ -14,8 +14,10 @@ import logging
 from datetime import datetime, timedelta
 from flask import Flask, render_template_string, request, redirect, url_for, session, jsonify, send_file
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 import requests
 from database_adapter import DatabaseAdapter
+from abuse_store import AbuseStore
 
 # 設置日誌
 logging.basicConfig(level=logging.INFO)
@@ -24,6 +26,11 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
 
+# 前面的反向代理層數：只信任這些代理追加的 X-Forwarded-For 地址，客戶端自己帶的地址不可信
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', '1'))
+if TRUSTED_PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
+
 # 初始化數據庫適配器
 db_adapter = DatabaseAdapter()
 
@@ -34,6 +41,39 @@ ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'tgwang2024')
 MANAGER_PASSWORD = os.environ.get('MANAGER_PASSWORD', 'manager123')
 AGENT_PASSWORD = os.environ.get('AGENT_PASSWORD', 'agent123')
 
+# 濫用記錄（與機器人進程共用同一個文件，封禁和可疑分數跨進程生效）
+abuse_store = AbuseStore(
+    os.environ.get('ABUSE_STORE_FILE', 'abuse_store.jsonl'),
+    half_life=float(os.environ.get('ABUSE_SCORE_HALF_LIFE', '3600')),
+    ban_threshold=float(os.environ.get('ABUSE_BAN_THRESHOLD', '10')),
+    ban_seconds=float(os.environ.get('ABUSE_BAN_SECONDS', '86400')),
+    max_keys=int(os.environ.get('ABUSE_MAX_KEYS', '20000'))
+)
+
+def get_client_ip():
+    """客戶端 IP（ProxyFix 已按 TRUSTED_PROXY_COUNT 取代理追加的地址）"""
+    return request.remote_addr
+
+def abuse_keys(activation_code=None, device_id=None):
+    """當前請求對應的濫用記錄鍵（IP、設備、激活碼）"""
+    keys = [f"ip:{get_client_ip()}"]
+    if device_id and device_id != 'unknown':
+        keys.append(f"device:{device_id}")
+    if activation_code:
+        keys.append(f"code:{activation_code}")
+    return keys
+
+def is_abuse_banned(activation_code=None, device_id=None):
+    """IP、設備或激活碼是否處於封禁中"""
+    return abuse_store.any_banned(*abuse_keys(activation_code, device_id))
+
+def report_abuse(reason):
+    """為當前請求的 IP 增加可疑分數（無效密鑰、不存在的激活碼等）
+
+    設備 ID 來自請求內容，任何人都能填寫，不計分也不自動封禁，只檢查管理員的手動封禁
+    """
+    abuse_store.add_score(f"ip:{get_client_ip()}", reason=reason)
+
 # 管理員帳號
 ADMIN_USERS = {
     "admin": hashlib.sha256(ADMIN_PASSWORD.encode()).hexdigest(),
@@ -1676,6 +1716,7 @@ def api_upload_software_data():
         # 檢查API密鑰
         api_key = request.headers.get('X-API-Key')
         if api_key != "tg-api-secure-key-2024":
+            report_abuse("無效的API密鑰")
             return jsonify({'error': '無效的API密鑰'}), 401
         
         data = request.get_json()
@@ -1686,9 +1727,13 @@ def api_upload_software_data():
         if not activation_code or not device_id:
             return jsonify({'error': '缺少必要參數'}), 400
         
+        if is_abuse_banned(activation_code, device_id):
+            return jsonify({'error': '請求已被封禁'}), 403
+        
         # 驗證激活碼
         code_info = db_adapter.get_activation_code(activation_code)
         if not code_info:
+            report_abuse(f"激活碼不存在: {activation_code}")
             return jsonify({'error': '激活碼不存在'}), 404
         
         # 檢查是否被停權
@@ -1797,11 +1842,15 @@ def api_upload_collection_data():
         if not activation_code:
             return jsonify({'error': '缺少激活碼'}), 400
         
+        if is_abuse_banned(activation_code, device_id):
+            return jsonify({'error': '請求已被封禁'}), 403
+        
         logger.info(f"激活碼: {activation_code}, 成員數: {len(members_data)}")
         
         # 驗證激活碼
         code_info = db_adapter.get_activation_code(activation_code)
         if not code_info:
+            report_abuse(f"激活碼不存在: {activation_code}")
             return jsonify({'error': '激活碼不存在'}), 404
         
         # 嘗試保存到 PostgreSQL
@@ -2082,6 +2131,7 @@ def api_verify_activation():
         # 檢查API密鑰
         api_key = request.headers.get('X-API-Key')
         if api_key != "tg-api-secure-key-2024":
+            report_abuse("無效的API密鑰")
             return jsonify({
                 "valid": False,
                 "message": "無效的API密鑰"
@@ -2097,11 +2147,18 @@ def api_verify_activation():
                 "message": "缺少激活碼"
             }), 400
         
+        if is_abuse_banned(activation_code, device_id):
+            return jsonify({
+                "valid": False,
+                "message": "請求已被封禁，請稍後再試"
+            }), 403
+        
         # 讀取機器人數據庫
         bot_data = get_bot_database()
         code_info = bot_data.get('activation_codes', {}).get(activation_code)
         
         if not code_info:
+            report_abuse(f"激活碼不存在: {activation_code}")
             return jsonify({
                 "valid": False,
                 "message": "激活碼不存在"
@@ -2153,6 +2210,7 @@ def api_use_activation():
         # 檢查API密鑰
         api_key = request.headers.get('X-API-Key')
         if api_key != "tg-api-secure-key-2024":
+            report_abuse("無效的API密鑰")
             return jsonify({
                 "success": False,
                 "message": "無效的API密鑰"
@@ -2168,11 +2226,18 @@ def api_use_activation():
                 "message": "缺少激活碼"
             }), 400
         
+        if is_abuse_banned(activation_code, device_id):
+            return jsonify({
+                "success": False,
+                "message": "請求已被封禁，請稍後再試"
+            }), 403
+        
         # 讀取機器人數據庫
         bot_data = get_bot_database()
         code_info = bot_data.get('activation_codes', {}).get(activation_code)
         
         if not code_info:
+            report_abuse(f"激活碼不存在: {activation_code}")
             return jsonify({
                 "success": False,
                 "message": "激活碼不存在"
@@ -2273,6 +2338,71 @@ def sync_activation_code():
             "message": f"同步錯誤: {str(e)}"
         }), 500
 
+@app.route('/sync/activation_codes', methods=['POST'])
+def sync_activation_codes():
+    """批量同步激活碼端點 - 機器人同步隊列一次提交多個激活碼"""
+    try:
+        # 檢查API密鑰
+        api_key = request.headers.get('X-API-Key')
+        if api_key != "tg-api-secure-key-2024":
+            return jsonify({
+                "success": False,
+                "message": "無效的API密鑰"
+            }), 401
+        
+        data = request.get_json() or {}
+        codes = data.get('codes') or []
+        
+        if not isinstance(codes, list) or len(codes) > 500:
+            return jsonify({
+                "success": False,
+                "message": "數據格式錯誤或數量超過500"
+            }), 400
+        
+        synced = []
+        failed = []
+        valid_items = []
+        for item in codes:
+            activation_code = item.get('activation_code')
+            code_data = item.get('code_data')
+            if not activation_code or not code_data:
+                failed.append(activation_code)
+                continue
+            
+            if db_adapter.save_activation_code(activation_code, code_data):
+                synced.append(activation_code)
+                valid_items.append((activation_code, code_data))
+            else:
+                failed.append(activation_code)
+        
+        # 同時更新本地JSON文件（向後兼容），整批只寫一次
+        if valid_items:
+            try:
+                bot_data = get_bot_database()
+                for activation_code, code_data in valid_items:
+                    bot_data['activation_codes'][activation_code] = code_data
+                
+                bot_data.setdefault('statistics', {})
+                bot_data['statistics']['activations_generated'] = len(bot_data['activation_codes'])
+                
+                with open(BOT_DATABASE_PATH, 'w', encoding='utf-8') as f:
+                    json.dump(bot_data, f, ensure_ascii=False, indent=2)
+            except Exception as e:
+                print(f"本地JSON保存失敗: {e}")
+        
+        return jsonify({
+            "success": not failed,
+            "message": f"同步成功 {len(synced)} 個，失敗 {len(failed)} 個",
+            "synced": synced,
+            "failed": failed
+        })
+        
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "message": f"同步錯誤: {str(e)}"
+        }), 500
+
 if __name__ == '__main__':
     print("🚀 TG旺企業管理系統 - 機器人數據整合版")
     print("=" * 60)
@@ -15,7 +15,7 @@ import string
 import time
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
-from collections import defaultdict, deque
+from collections import deque
 
 import requests
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -29,6 +29,18 @@ try:
     from database import Database
     from tron_monitor import TronMonitor
     from activation_codes import ActivationCodeManager
+    from multi_address_monitor import PaymentInbox
+    from monitor_checkpoint import MonitorCheckpoint
+    from user_rate_limiter import GcraRateLimiter
+    from bot_executor import StorageExecutor, HandlerTimer
+    from telegram_outbox import TelegramOutbox, PRIORITY_PAYMENT
+    from webhook_server import WebhookServer, run_webhook
+    from update_processor import PerUserUpdateProcessor
+    from order_expiry import ExpiryScheduler
+    from broadcast import BroadcastManager, AUDIENCES
+    from order_ids import OrderIdGenerator
+    from user_sessions import UserSessionCache
+    from abuse_store import AbuseStore
 except ImportError as e:
     print(f"❌ 導入模塊失敗: {e}")
     print("請確保所有必需的模塊文件存在")
@@ -48,47 +60,33 @@ logger = logging.getLogger(__name__)
 class SecurityManager:
     """安全管理器"""
     
-    def __init__(self):
-        # 速率限制：每個用戶每分鐘最多操作次數
-        self.rate_limits = defaultdict(lambda: deque())
+    def __init__(self, abuse: AbuseStore = None):
+        # 速率限制：每個用戶每分鐘/每小時最多操作次數（每個用戶固定大小狀態，空閒用戶自動淘汰）
         self.MAX_REQUESTS_PER_MINUTE = 20
         self.MAX_REQUESTS_PER_HOUR = 100
+        self.rate_limiter = GcraRateLimiter([
+            ('minute', 60, self.MAX_REQUESTS_PER_MINUTE),
+            ('hour', 3600, self.MAX_REQUESTS_PER_HOUR)
+        ])
         
-        # 黑名單用戶
-        self.blacklisted_users = set()
-        
-        # 可疑行為監控
-        self.suspicious_activities = defaultdict(int)
+        # 黑名單和可疑分數（持久化，與其他機器人進程和 API 服務共享）
+        self.abuse = abuse or AbuseStore()
         
         # 輸入驗證模式
         self.order_id_pattern = re.compile(r'^TG[0-9A-Z]{8,12}$')
         self.username_pattern = re.compile(r'^[a-zA-Z0-9_]{1,32}$')
         
     def is_rate_limited(self, user_id: int) -> bool:
-        """檢查用戶是否被速率限制"""
-        now = time.time()
-        user_requests = self.rate_limits[user_id]
-        
-        # 清理過期的請求記錄（1分鐘前）
-        while user_requests and user_requests[0] < now - 60:
-            user_requests.popleft()
-        
-        # 檢查是否超過限制
-        if len(user_requests) >= self.MAX_REQUESTS_PER_MINUTE:
-            return True
-            
-        # 記錄當前請求
-        user_requests.append(now)
-        return False
+        """檢查用戶是否被速率限制（同時檢查分鐘和小時窗口）"""
+        return self.rate_limiter.hit(user_id) is not None
     
     def is_blacklisted(self, user_id: int) -> bool:
-        """檢查用戶是否在黑名單中"""
-        return user_id in self.blacklisted_users
+        """檢查用戶是否在黑名單中（封禁到期後自動解除）"""
+        return self.abuse.is_banned(f"user:{user_id}")
     
-    def add_to_blacklist(self, user_id: int):
-        """添加用戶到黑名單"""
-        self.blacklisted_users.add(user_id)
-        logger.warning(f"用戶 {user_id} 已被加入黑名單")
+    def add_to_blacklist(self, user_id: int, seconds: float = None, reason: str = ''):
+        """添加用戶到黑名單（seconds 為 None 時使用默認封禁時長，0 為永久）"""
+        self.abuse.ban(f"user:{user_id}", seconds, reason)
     
     def validate_order_id(self, order_id: str) -> bool:
         """驗證訂單ID格式"""
@@ -111,13 +109,9 @@ class SecurityManager:
         return sanitized
     
     def log_suspicious_activity(self, user_id: int, activity: str):
-        """記錄可疑活動"""
-        self.suspicious_activities[user_id] += 1
+        """記錄可疑活動（分數隨時間衰減，短時間內可疑活動過多時自動封禁；只更新內存，由後台線程寫入文件）"""
         logger.warning(f"可疑活動 - 用戶 {user_id}: {activity}")
-        
-        # 如果可疑活動過多，加入黑名單
-        if self.suspicious_activities[user_id] > 10:
-            self.add_to_blacklist(user_id)
+        self.abuse.add_score(f"user:{user_id}", reason=activity)
     
     def validate_user_input(self, user_id: int, username: str, first_name: str) -> bool:
         """驗證用戶輸入信息"""
@@ -136,7 +130,7 @@ class SecurityManager:
 class SmartMonitorManager:
     """智能監控管理器 - 只在需要時監控"""
     
-    def __init__(self):
+    def __init__(self, checkpoint: MonitorCheckpoint = None):
         # 待監控的訂單列表 {order_id: {'amount': float, 'created_at': datetime, 'expires_at': datetime}}
         self.pending_orders = {}
         
@@ -148,6 +142,95 @@ class SmartMonitorManager:
         self.MONITOR_WINDOW_MINUTES = 30  # 監控窗口：30分鐘
         self.CHECK_INTERVAL_SECONDS = 60   # 檢查間隔：60秒
         
+        # 檢查點：保存監控列表，重啟後恢復
+        self.checkpoint = checkpoint
+        self.catchup_minutes = 0  # 重啟後首次查詢需額外回溯的分鐘數
+        
+        # 訂單到期時由調度器準時觸發過期處理，不再輪詢掃描
+        self.expiry = ExpiryScheduler()
+        
+        # 自適應輪詢：新訂單密集檢查，隨訂單年齡衰減到 CHECK_INTERVAL_SECONDS
+        self.POLL_SCHEDULE = [(120, 5), (600, 15)]  # (訂單年齡上限秒, 檢查間隔秒)
+        self.BOOST_SECONDS = 60            # 用戶點擊「已付款」後的加速時長
+        self.BOOST_INTERVAL_SECONDS = 3    # 加速期間的檢查間隔
+        self.API_BUDGET_SHARE = 0.2        # 智能監控最多佔用共享 API 配額的比例
+        self.boosted_until = {}            # {order_id: 加速截止時間戳}
+        self.wake_event = None
+        self.current_interval = self.CHECK_INTERVAL_SECONDS
+        self.min_poll_spacing = 0.0        # 配額允許的最短輪詢間距（提前喚醒時也遵守）
+        self.poll_times = deque()
+        self.schedule_stats = {
+            'polls': 0,
+            'boosts': 0,
+            'budget_throttled': 0
+        }
+        
+    def _save_checkpoint(self):
+        """保存監控列表到檢查點"""
+        if not self.checkpoint:
+            return
+        self.checkpoint.save('smart_monitor', {
+            order_id: {
+                'amount': info['amount'],
+                'created_at': info['created_at'].isoformat(),
+                'expires_at': info['expires_at'].isoformat()
+            }
+            for order_id, info in self.pending_orders.items()
+        })
+    
+    def restore(self, db, max_catchup_minutes: int = 180) -> int:
+        """從檢查點和數據庫待付款訂單恢復監控列表，返回恢復的訂單數"""
+        now = datetime.now()
+        saved_orders = self.checkpoint.get('smart_monitor', {}) if self.checkpoint else {}
+        saved_at = self.checkpoint.saved_at('smart_monitor') if self.checkpoint else None
+        
+        # 停機時長（有上限），停機期間到期的訂單也要補查一次
+        downtime_minutes = (time.time() - saved_at) / 60 if saved_at else 0
+        catchup_minutes = min(downtime_minutes, max_catchup_minutes)
+        horizon = now - timedelta(minutes=catchup_minutes)
+        grace = now + timedelta(seconds=self.CHECK_INTERVAL_SECONDS * 2)
+        
+        # 以數據庫為準：只恢復仍是待付款狀態的訂單
+        for order in db.get_pending_orders():
+            order_id = order['order_id']
+            saved = saved_orders.get(order_id)
+            try:
+                if saved:
+                    created_at = datetime.fromisoformat(saved['created_at'])
+                    expires_at = datetime.fromisoformat(saved['expires_at'])
+                else:
+                    created_at = datetime.fromisoformat(order['created_at'])
+                    expires_at = created_at + timedelta(minutes=self.MONITOR_WINDOW_MINUTES)
+            except (KeyError, ValueError):
+                continue
+            
+            if expires_at < horizon:
+                # 早在停機前就已過監控窗口，不再監控，立即按過期處理
+                self.expiry.schedule(order_id, now)
+                continue
+            
+            self.pending_orders[order_id] = {
+                'amount': order['amount'],
+                'created_at': created_at,
+                'expires_at': max(expires_at, grace)
+            }
+            self.expiry.schedule(order_id, self.pending_orders[order_id]['expires_at'])
+        
+        if self.pending_orders:
+            self.catchup_minutes = catchup_minutes
+            logger.info(f"⏪ 從檢查點恢復 {len(self.pending_orders)} 個監控訂單，"
+                        f"停機 {downtime_minutes:.1f} 分鐘")
+        self._save_checkpoint()
+        return len(self.pending_orders)
+    
+    def get_lookback_minutes(self) -> int:
+        """本輪付款查詢的回溯分鐘數；重啟後首輪覆蓋停機時段"""
+        lookback = self.MONITOR_WINDOW_MINUTES
+        if self.catchup_minutes:
+            lookback += int(self.catchup_minutes) + 1
+            self.catchup_minutes = 0
+        return lookback
+    
     def add_order_for_monitoring(self, order_id: str, amount: float):
         """添加訂單到監控列表"""
         now = datetime.now()
@@ -158,6 +241,9 @@ class SmartMonitorManager:
             'created_at': now,
             'expires_at': expires_at
         }
+        self.expiry.schedule(order_id, expires_at)
+        self._save_checkpoint()
+        self._wake()  # 新訂單立即進入密集檢查
         
         logger.info(f"訂單 {order_id} 加入監控列表，金額: {amount} USDT")
         
@@ -167,56 +253,119 @@ class SmartMonitorManager:
     
     def remove_order_from_monitoring(self, order_id: str):
         """從監控列表移除訂單"""
+        self.boosted_until.pop(order_id, None)
+        self.expiry.cancel(order_id)
         if order_id in self.pending_orders:
             del self.pending_orders[order_id]
+            self._save_checkpoint()
             logger.info(f"訂單 {order_id} 已從監控列表移除")
     
-    def cleanup_expired_orders(self, db=None):
-        """清理過期的監控訂單並自動取消"""
-        now = datetime.now()
-        expired_orders = []
-        
-        for order_id, info in self.pending_orders.items():
-            if now > info['expires_at']:
-                expired_orders.append(order_id)
-        
-        for order_id in expired_orders:
-            logger.info(f"訂單 {order_id} 監控已過期，自動取消")
-            
-            # 從監控列表移除
-            del self.pending_orders[order_id]
-            
-            # 如果提供了數據庫實例，自動取消數據庫中的訂單
-            if db:
-                try:
-                    order = db.get_order(order_id)
-                    if order and order.get('status') == 'pending':
-                        db.update_order_status(order_id, 'cancelled')
-                        logger.info(f"訂單 {order_id} 已自動取消（30分鐘未付款）")
-                except Exception as e:
-                    logger.error(f"自動取消訂單 {order_id} 失敗: {e}")
-        
-        return len(expired_orders)
+    def expire_order(self, order_id: str) -> bool:
+        """訂單監控到期，從監控列表移除；返回訂單是否仍在監控中"""
+        self.boosted_until.pop(order_id, None)
+        if order_id not in self.pending_orders:
+            return False
+        del self.pending_orders[order_id]
+        self._save_checkpoint()
+        logger.info(f"訂單 {order_id} 監控已過期，自動取消")
+        return True
     
-    def should_monitor(self, db=None) -> bool:
+    def should_monitor(self) -> bool:
         """判斷是否需要監控"""
-        self.cleanup_expired_orders(db)
         return len(self.pending_orders) > 0
     
-    def get_monitoring_amounts(self, db=None) -> List[float]:
+    def get_monitoring_amounts(self) -> List[float]:
         """獲取需要監控的金額列表"""
-        self.cleanup_expired_orders(db)
         return [info['amount'] for info in self.pending_orders.values()]
     
-    def get_pending_orders_count(self, db=None) -> int:
+    def get_pending_orders_count(self) -> int:
         """獲取待監控訂單數量"""
-        self.cleanup_expired_orders(db)
         return len(self.pending_orders)
+    
+    def boost_order(self, order_id: str):
+        """用戶表示已付款，短時間內加速檢查該訂單"""
+        self.boosted_until[order_id] = time.time() + self.BOOST_SECONDS
+        self.schedule_stats['boosts'] += 1
+        self._wake()
+    
+    def _wake(self):
+        """喚醒等待中的監控循環，按新的間隔重新計劃"""
+        if self.wake_event:
+            self.wake_event.set()
+    
+    def _order_interval(self, order_id: str, info: Dict, now: datetime) -> float:
+        """單個訂單期望的檢查間隔"""
+        if self.boosted_until.get(order_id, 0) > time.time():
+            return min(self.BOOST_INTERVAL_SECONDS, self.CHECK_INTERVAL_SECONDS)
+        
+        age = (now - info['created_at']).total_seconds()
+        for max_age, interval in self.POLL_SCHEDULE:
+            if age < max_age:
+                return min(interval, self.CHECK_INTERVAL_SECONDS)
+        return self.CHECK_INTERVAL_SECONDS
+    
+    def next_interval(self, rate_limiter=None) -> float:
+        """下一輪檢查間隔：取所有訂單中最短的，並受共享 API 配額約束"""
+        now = datetime.now()
+        intervals = [self._order_interval(order_id, info, now) for order_id, info in self.pending_orders.items()]
+        interval = min(intervals) if intervals else self.CHECK_INTERVAL_SECONDS
+        
+        self.min_poll_spacing = 0.0
+        if rate_limiter:
+            # 每輪一次查詢，頻率不超過配額份額；配額緊張時再放慢
+            budget_floor = 1 / (rate_limiter.bucket.rate * self.API_BUDGET_SHARE)
+            self.min_poll_spacing = budget_floor
+            if rate_limiter.get_metrics()['quota_usage'] > 0.8:
+                budget_floor = max(budget_floor, interval * 2)
+            if budget_floor > interval:
+                self.schedule_stats['budget_throttled'] += 1
+                interval = budget_floor
+        
+        return interval
+    
+    async def wait_next_poll(self, rate_limiter=None):
+        """等待到下一輪檢查；新訂單或加速請求會提前喚醒"""
+        self.current_interval = self.next_interval(rate_limiter)
+        if self.wake_event is None:
+            self.wake_event = asyncio.Event()
+        
+        try:
+            await asyncio.wait_for(self.wake_event.wait(), timeout=self.current_interval)
+        except asyncio.TimeoutError:
+            pass
+        self.wake_event.clear()
+        
+        # 提前喚醒時仍保持配額允許的最短間距
+        if self.poll_times:
+            remaining = self.min_poll_spacing - (time.time() - self.poll_times[-1])
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+    
+    def record_poll(self):
+        """記錄一次輪詢"""
+        now = time.time()
+        self.poll_times.append(now)
+        while self.poll_times and self.poll_times[0] < now - 60:
+            self.poll_times.popleft()
+        self.schedule_stats['polls'] += 1
+    
+    def get_schedule_metrics(self) -> Dict:
+        """輪詢調度指標：預期檢測延遲為付款後平均等待的半個檢查間隔"""
+        now = datetime.now()
+        intervals = [self._order_interval(order_id, info, now) for order_id, info in self.pending_orders.items()]
+        return {
+            'current_interval': round(self.current_interval, 1),
+            'polls_last_minute': sum(1 for t in self.poll_times if t >= time.time() - 60),
+            'expected_detection_latency': round(sum(intervals) / len(intervals) / 2, 1) if intervals else 0.0,
+            'worst_detection_latency': round(max(intervals), 1) if intervals else 0.0,
+            'boosted_orders': sum(1 for t in self.boosted_until.values() if t > time.time()),
+            **self.schedule_stats
+        }
 
 class TGMarketingBot:
     """TG營銷系統機器人主類"""
     
-    def __init__(self):
+    def __init__(self, db: Database = None):
         try:
             self.config = Config()
         except Exception as e:
@@ -224,28 +373,67 @@ class TGMarketingBot:
             raise
             
         try:
-            self.db = Database()
+            # 所有組件共用同一個數據庫實例（只加載一次，只有一個寫入者）
+            self.db = db or Database(self.config.DATABASE_FILE)
         except Exception as e:
             logger.error(f"❌ 數據庫初始化失敗: {e}")
             raise
             
         try:
-            self.tron_monitor = TronMonitor()
+            self.tron_monitor = TronMonitor(db=self.db)
         except Exception as e:
             logger.error(f"❌ TRON監控初始化失敗: {e}")
             raise
             
         try:
-            self.activation_manager = ActivationCodeManager()
+            self.activation_manager = ActivationCodeManager(db=self.db)
         except Exception as e:
             logger.error(f"❌ 激活碼管理器初始化失敗: {e}")
             raise
             
+        # 按時間排序的訂單號（多個機器人進程使用不同節點號，互不衝突）
+        self.order_ids = OrderIdGenerator.from_env()
+        self.order_ids.seed(self.db.latest_order_id())
+            
+        # 用戶會話緩存（數據庫寫入時自動失效）
+        self.sessions = UserSessionCache(self.db, self.config.USER_SESSION_CACHE_SIZE)
+        
+        # 阻塞的存儲操作在專用線程中執行，處理器耗時統計
+        self.storage = StorageExecutor()
+        self.handler_timer = HandlerTimer()
+        self.update_processor = None  # 由 main() 創建 Application 時設置
+        self.stats_reconcile_task = None
+        
+        # 發送隊列（全局和每個聊天限速，付款消息優先）
+        self.outbox = TelegramOutbox(
+            global_rate=self.config.TELEGRAM_GLOBAL_RATE,
+            chat_rate=self.config.TELEGRAM_CHAT_RATE,
+            chat_burst=self.config.TELEGRAM_CHAT_BURST
+        )
+        
         # 初始化安全管理器
-        self.security = SecurityManager()
+        self.security = SecurityManager(AbuseStore(
+            self.config.ABUSE_STORE_FILE,
+            half_life=self.config.ABUSE_SCORE_HALF_LIFE,
+            ban_threshold=self.config.ABUSE_BAN_THRESHOLD,
+            ban_seconds=self.config.ABUSE_BAN_SECONDS,
+            max_keys=self.config.ABUSE_MAX_KEYS
+        ))
+        
+        # 初始化智能監控管理器（與區塊監控共用檢查點，並恢復重啟前的監控訂單）
+        self.smart_monitor = SmartMonitorManager(checkpoint=self.tron_monitor.checkpoint)
+        self.smart_monitor.restore(self.db, self.config.CATCHUP_MAX_MINUTES)
+        
+        # 群發管理器（進度保存在共用檢查點中，重啟後繼續）
+        self.broadcaster = BroadcastManager(
+            self.db, self.storage, self.outbox, self.tron_monitor.checkpoint, rate=self.config.BROADCAST_RATE
+        )
         
-        # 初始化智能監控管理器
-        self.smart_monitor = SmartMonitorManager()
+        # 由多機器人管理器的共享付款監控提供付款時，從收件箱讀取而不自行輪詢
+        inbox_file = os.getenv('PAYMENT_INBOX_FILE')
+        self.payment_inbox = PaymentInbox(inbox_file) if inbox_file else None
+        if self.payment_inbox:
+            logger.info(f"💰 使用共享付款監控收件箱: {inbox_file}")
         
         # 測試模式
         self.TEST_MODE = os.getenv('TEST_MODE', 'false').lower() == 'true'
@@ -309,7 +497,7 @@ class TGMarketingBot:
         if self.smart_monitor.is_monitoring:
             return  # 已經在監控中
         
-        if not self.smart_monitor.should_monitor(self.db):
+        if not self.smart_monitor.should_monitor():
             return  # 沒有待監控的訂單
         
         self.smart_monitor.is_monitoring = True
@@ -318,19 +506,21 @@ class TGMarketingBot:
         async def smart_monitor_task():
             logger.info("🔍 智能監控已啟動")
             
-            while self.smart_monitor.should_monitor(self.db):
+            while self.smart_monitor.should_monitor():
                 try:
                     # 獲取需要監控的金額
-                    amounts_to_monitor = self.smart_monitor.get_monitoring_amounts(self.db)
+                    amounts_to_monitor = self.smart_monitor.get_monitoring_amounts()
                     
                     if amounts_to_monitor:
                         logger.info(f"正在監控 {len(amounts_to_monitor)} 個訂單的付款")
                         
                         # 只查詢最近的交易（過去30分鐘）
                         await self.check_recent_transactions(amounts_to_monitor)
+                        self.smart_monitor.record_poll()
                     
-                    # 等待檢查間隔
-                    await asyncio.sleep(self.smart_monitor.CHECK_INTERVAL_SECONDS)
+                    # 按訂單年齡和 API 配額自適應等待
+                    await self.smart_monitor.wait_next_poll(
+                        None if self.payment_inbox else self.tron_monitor.rate_limiter)
                     
                 except Exception as e:
                     logger.error(f"智能監控錯誤: {e}")
@@ -343,16 +533,72 @@ class TGMarketingBot:
         # 啟動監控任務
         self.smart_monitor.monitor_task = asyncio.create_task(smart_monitor_task())
     
+    def start_stats_reconciler(self):
+        """啟動統計聚合定期核對任務（在單獨線程中分批重建，不佔用存儲線程，也不阻塞事件循環）"""
+        async def reconcile_task():
+            while True:
+                await asyncio.sleep(self.config.STATS_RECONCILE_INTERVAL)
+                try:
+                    await asyncio.to_thread(self.db.reconcile_statistics)
+                except Exception as e:
+                    logger.error(f"❌ 統計聚合核對失敗: {e}")
+        
+        self.stats_reconcile_task = asyncio.create_task(reconcile_task())
+    
+    def start_expiry_scheduler(self):
+        """啟動訂單過期調度任務"""
+        if not self.smart_monitor.expiry.is_running:
+            asyncio.create_task(self.smart_monitor.expiry.run(self.handle_order_expired))
+    
+    async def handle_order_expired(self, order_id: str):
+        """訂單到期：移出監控，取消仍待付款的訂單（同時釋放金額索引）並通知用戶"""
+        self.smart_monitor.expire_order(order_id)
+        
+        order = await self.storage.run(self.cancel_order_if_pending, order_id)
+        if not order:
+            return  # 已付款或已手動取消
+        logger.info(f"訂單 {order_id} 已自動取消（{self.smart_monitor.MONITOR_WINDOW_MINUTES}分鐘未付款）")
+        
+        text = f"""⏰ 訂單已過期
+
+🆔 訂單號: {order_id}
+💰 金額: {order['amount']} {self.currency}
+
+訂單在 {self.smart_monitor.MONITOR_WINDOW_MINUTES} 分鐘內未收到付款，已自動取消。
+如已付款，請聯繫客服並提供交易哈希。"""
+        keyboard = [
+            [InlineKeyboardButton("💳 重新購買", callback_data="buy_menu")],
+            [InlineKeyboardButton("📞 聯繫客服", callback_data="contact")]
+        ]
+        self.outbox.enqueue(order['user_id'], text=text, reply_markup=InlineKeyboardMarkup(keyboard))
+    
+    async def boost_payment_check(self, order: Dict):
+        """用戶點擊已付款後加速檢查；訂單已離開監控窗口時重新加入"""
+        order_id = order['order_id']
+        if order_id not in self.smart_monitor.pending_orders:
+            self.smart_monitor.add_order_for_monitoring(order_id, order['amount'])
+        self.smart_monitor.boost_order(order_id)
+        await self.start_smart_monitoring()
+    
     async def check_recent_transactions(self, amounts_to_monitor: List[float]):
         """檢查最近的交易"""
         try:
             logger.info(f"🔍 檢查 {len(amounts_to_monitor)} 個訂單的付款狀態")
             
+            # 每輪只查詢一次收款地址，所有待付款金額共用結果（重啟後首輪覆蓋停機時段）
+            lookback_minutes = self.smart_monitor.get_lookback_minutes()
+            if self.payment_inbox:
+                payments = self.payment_inbox.read_recent(max_age_minutes=lookback_minutes)
+            else:
+                payments = await self.tron_monitor.get_recent_payments(max_age_minutes=lookback_minutes)
+            
+            # 窗口內的付款每輪都會重新查到，跳過已用於激活訂單的（記錄在交易賬本中）
+            payments = [payment for payment in payments if not self.db.transaction_exists(payment['tx_hash'])]
+            if not payments:
+                return
+            
             for amount in amounts_to_monitor:
-                logger.debug(f"檢查金額 {amount} {'TRX' if self.TEST_MODE else 'USDT'} 的交易")
-                
-                # 調用 TronMonitor 驗證付款
-                payment_result = await self.tron_monitor.verify_payment(amount, max_age_minutes=30)
+                payment_result = self.tron_monitor.match_payment(payments, amount)
                 
                 if payment_result:
                     logger.info(f"🎉 發現匹配的付款: {amount} {'TRX' if self.TEST_MODE else 'USDT'}")
@@ -383,9 +629,9 @@ class TGMarketingBot:
     async def send_new_message(self, update: Update, text: str, reply_markup=None, parse_mode=None):
         """發送新消息（不編輯現有消息）"""
         user_id = update.effective_user.id
-        await self.application.bot.send_message(
-            chat_id=user_id,
-            text=text,
+        await self.outbox.send_message(
+            user_id,
+            text,
             reply_markup=reply_markup,
             parse_mode=parse_mode
         )
@@ -401,10 +647,10 @@ class TGMarketingBot:
         
         try:
             # 記錄用戶
-            self.db.add_user(user_id, user.username, user.first_name)
+            await self.storage.run(self.db.add_user, user_id, user.username, user.first_name)
             
             # 檢查是否已有試用記錄
-            trial_used = self.db.has_used_trial(user_id)
+            trial_used = self.sessions.get(user_id).trial_used
         except Exception as e:
             logger.error(f"Database error in start_command: {e}")
             trial_used = False  # 默認值
@@ -467,7 +713,7 @@ class TGMarketingBot:
     async def show_pricing_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """顯示價格選單"""
         user_id = update.effective_user.id
-        trial_used = self.db.has_used_trial(user_id)
+        trial_used = self.sessions.get(user_id).trial_used
         
         text = "💰 **選擇購買方案**：\n\n"
         keyboard = []
@@ -511,11 +757,9 @@ class TGMarketingBot:
         user = update.effective_user
         
         # 檢查是否有未完成的訂單（防止重複購買）
-        user_orders = self.db.get_user_orders(user_id)
-        pending_orders = [order for order in user_orders if order['status'] == 'pending']
+        pending_order = self.sessions.get(user_id).pending_order  # 最新的待付款訂單
         
-        if pending_orders:
-            pending_order = pending_orders[0]  # 獲取最新的待付款訂單
+        if pending_order:
             await update.callback_query.answer(
                 f"❌ 您有未完成的訂單 {pending_order['order_id']}，請先完成付款或等待訂單過期", 
                 show_alert=True
@@ -528,16 +772,13 @@ class TGMarketingBot:
             await update.callback_query.answer("❌ 無效的方案類型", show_alert=True)
             return
         
-        # 生成唯一的訂單金額（避免衝突）
-        unique_amount = self.generate_unique_amount(plan_type)
-        
         if plan_type == 'trial':
             # 處理試用申請
             logger.info(f"🎁 用戶 {user_id} 申請免費試用")
             
             try:
                 # 檢查是否已使用過試用
-                has_trial = self.db.has_used_trial(user_id)
+                has_trial = self.sessions.get(user_id).trial_used
                 logger.info(f"用戶 {user_id} 試用狀態檢查: {'已使用' if has_trial else '可以使用'}")
                 
                 if has_trial:
@@ -546,7 +787,8 @@ class TGMarketingBot:
                 
                 # 直接生成試用激活碼
                 logger.info(f"為用戶 {user_id} 生成試用激活碼...")
-                activation_code = self.activation_manager.generate_activation_code(
+                activation_code = await self.storage.run(
+                    self.activation_manager.generate_activation_code,
                     plan_type='trial',
                     days=2,
                     user_id=user_id
@@ -555,7 +797,7 @@ class TGMarketingBot:
                 
                 # 記錄試用使用
                 logger.info(f"標記用戶 {user_id} 已使用試用...")
-                self.db.mark_trial_used(user_id)
+                await self.storage.run(self.db.mark_trial_used, user_id)
                 logger.info(f"✅ 試用狀態已更新")
                 
                 # 發送激活碼
@@ -600,15 +842,16 @@ class TGMarketingBot:
                 'user_id': user_id,
                 'username': user.username,
                 'plan_type': plan_type,
-                'amount': unique_amount,
                 'days': plan_info['days'],
                 'status': 'pending',
+                'payment_address': self.config.USDT_ADDRESS,
                 'created_at': datetime.now().isoformat(),
                 'expires_at': (datetime.now() + timedelta(hours=24)).isoformat()
             }
             
             try:
-                self.db.create_order(order_data)
+                # 生成唯一的訂單金額（避免衝突）並創建訂單
+                unique_amount = await self.storage.run(self.create_order_with_unique_amount, order_data, plan_type)
             except Exception as e:
                 logger.error(f"Failed to create order: {e}")
                 await update.callback_query.answer("❌ 創建訂單失敗，請稍後重試", show_alert=True)
@@ -723,32 +966,23 @@ class TGMarketingBot:
         
         await self.send_new_message(update, service_text, reply_markup=reply_markup4)
     
-    async def handle_payment_confirmed(self, transaction_data: Dict):
-        """處理確認的付款"""
+    async def handle_payment_confirmed(self, transaction_data: Dict) -> bool:
+        """處理確認的付款，返回是否已處理完畢（沒有匹配的訂單也算處理完畢）；出錯時返回 False，由調用方稍後重試"""
         try:
             amount = transaction_data['amount']
             tx_hash = transaction_data['tx_hash']
             
-            # 查找匹配的訂單
-            order = self.db.find_order_by_amount(amount)
+            # 按精確金額和收款地址查找匹配的訂單
+            order = await self.storage.run(self.db.find_pending_order, amount, transaction_data.get('to_address'))
             if not order:
-                logger.warning(f"找不到金額為 {amount} USDT 的訂單")
-                return
+                logger.warning(f"找不到金額為 {amount} USDT 的唯一待付款訂單")
+                return True
             
-            if order['status'] != 'pending':
+            # 生成激活碼並更新訂單狀態
+            activation_code = await self.storage.run(self.activate_paid_order, order, tx_hash, transaction_data)
+            if not activation_code:
                 logger.warning(f"訂單 {order['order_id']} 狀態不是待付款: {order['status']}")
-                return
-            
-            # 更新訂單狀態
-            self.db.update_order_status(order['order_id'], 'paid', tx_hash)
-            
-            # 生成激活碼
-            activation_code = self.activation_manager.generate_activation_code(
-                plan_type=order['plan_type'],
-                days=order['days'],
-                user_id=order['user_id'],
-                order_id=order['order_id']
-            )
+                return True
             
             # 從監控列表移除已完成的訂單
             self.smart_monitor.remove_order_from_monitoring(order['order_id'])
@@ -758,12 +992,14 @@ class TGMarketingBot:
                 await self.send_activation_messages(order, activation_code, tx_hash)
             
             logger.info(f"✅ 訂單 {order['order_id']} 處理完成，激活碼: {activation_code}")
+            return True
             
         except Exception as e:
             logger.error(f"❌ 處理付款確認失敗: {e}")
+            return False
     
     async def send_activation_messages(self, order: Dict, activation_code: str, tx_hash: str):
-        """發送激活碼相關的獨立消息"""
+        """發送激活碼相關的獨立消息（加入發送隊列後立即返回，不阻塞付款處理）"""
         user_id = order['user_id']
         order_id = order['order_id']
         plan_name = self.pricing[order['plan_type']]['name']
@@ -781,8 +1017,9 @@ class TGMarketingBot:
 🎉 您的激活碼正在生成中，請稍等...
 """
         
-        await self.application.bot.send_message(
-            chat_id=user_id,
+        self.outbox.enqueue(
+            user_id,
+            priority=PRIORITY_PAYMENT,
             text=confirm_text,
             parse_mode='Markdown'
         )
@@ -808,8 +1045,9 @@ class TGMarketingBot:
         ]
         reply_markup1 = InlineKeyboardMarkup(keyboard1)
         
-        await self.application.bot.send_message(
-            chat_id=user_id,
+        self.outbox.enqueue(
+            user_id,
+            priority=PRIORITY_PAYMENT,
             text=activation_text,
             reply_markup=reply_markup1,
             parse_mode='Markdown'
@@ -845,8 +1083,9 @@ TG營銷系統團隊 敬上 ❤️
         ]
         reply_markup2 = InlineKeyboardMarkup(keyboard2)
         
-        await self.application.bot.send_message(
-            chat_id=user_id,
+        self.outbox.enqueue(
+            user_id,
+            priority=PRIORITY_PAYMENT,
             text=usage_text,
             reply_markup=reply_markup2,
             parse_mode='Markdown'
@@ -862,19 +1101,15 @@ TG營銷系統團隊 敬上 ❤️
         user = update.effective_user
         
         # 檢查是否有未完成的訂單（防止重複測試）
-        user_orders = self.db.get_user_orders(user_id)
-        pending_orders = [order for order in user_orders if order['status'] == 'pending']
+        pending_order = self.sessions.get(user_id).pending_order
         
-        if pending_orders:
-            pending_order = pending_orders[0]
+        if pending_order:
             await update.callback_query.answer(
                 f"❌ 您有未完成的測試訂單 {pending_order['order_id']}，請先完成測試或等待過期", 
                 show_alert=True
             )
             return
         
-        # 生成唯一的測試訂單金額 (1 TRX + 小數點)
-        test_amount = self.generate_unique_amount('weekly')  # 使用週方案作為測試
         order_id = self.generate_order_id()
         
         # 創建測試訂單
@@ -883,15 +1118,16 @@ TG營銷系統團隊 敬上 ❤️
             'user_id': user_id,
             'username': user.username,
             'plan_type': 'weekly',
-            'amount': test_amount,
             'days': 7,
             'status': 'pending',
+            'payment_address': self.config.USDT_ADDRESS,
             'created_at': datetime.now().isoformat(),
             'expires_at': (datetime.now() + timedelta(hours=24)).isoformat()
         }
         
         try:
-            self.db.create_order(order_data)
+            # 生成唯一的測試訂單金額 (1 TRX + 小數點)，使用週方案作為測試
+            test_amount = await self.storage.run(self.create_order_with_unique_amount, order_data, 'weekly')
             
             # 將測試訂單加入智能監控系統（真實監控 TRX 付款）
             self.smart_monitor.add_order_for_monitoring(order_id, test_amount)
@@ -994,18 +1230,17 @@ TG營銷系統團隊 敬上 ❤️
             await update.callback_query.answer("❌ 訂單不存在或無權限", show_alert=True)
             return
             
-        if order['status'] != 'pending':
-            await update.callback_query.answer("❌ 訂單狀態異常", show_alert=True)
-            return
-        
         # 模擬交易哈希
         test_tx_hash = f"TEST_{random.randint(100000, 999999)}"
         
         # 更新訂單狀態為已付款
-        self.db.update_order_status(order_id, 'paid', test_tx_hash)
+        if not await self.storage.run(self.mark_order_paid, order, test_tx_hash):
+            await update.callback_query.answer("❌ 訂單狀態異常", show_alert=True)
+            return
         
         # 生成激活碼
-        activation_code = self.activation_manager.generate_activation_code(
+        activation_code = await self.storage.run(
+            self.activation_manager.generate_activation_code,
             plan_type=order['plan_type'],
             days=order['days'],
             user_id=user_id,
@@ -1035,8 +1270,9 @@ TG營銷系統團隊 敬上 ❤️
 🎉 激活碼正在生成中...
 """
         
-        await self.application.bot.send_message(
-            chat_id=user_id,
+        self.outbox.enqueue(
+            user_id,
+            priority=PRIORITY_PAYMENT,
             text=confirm_text,
             parse_mode='Markdown'
         )
@@ -1062,8 +1298,9 @@ TG營銷系統團隊 敬上 ❤️
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await self.application.bot.send_message(
-            chat_id=user_id,
+        self.outbox.enqueue(
+            user_id,
+            priority=PRIORITY_PAYMENT,
             text=activation_text,
             reply_markup=reply_markup,
             parse_mode='Markdown'
@@ -1095,8 +1332,9 @@ TG營銷系統團隊 敬上 ❤️
         ]
         reply_markup2 = InlineKeyboardMarkup(keyboard2)
         
-        await self.application.bot.send_message(
-            chat_id=user_id,
+        self.outbox.enqueue(
+            user_id,
+            priority=PRIORITY_PAYMENT,
             text=verification_text,
             reply_markup=reply_markup2,
             parse_mode='Markdown'
@@ -1294,12 +1532,103 @@ TG營銷系統團隊 敬上 ❤️
             [InlineKeyboardButton("👥 用戶管理", callback_data="admin_users"), InlineKeyboardButton("📋 訂單管理", callback_data="admin_orders")],
             [InlineKeyboardButton("🛡️ 安全管理", callback_data="security_panel"), InlineKeyboardButton("🔄 重啟監控", callback_data="admin_restart")],
             [InlineKeyboardButton("⚙️ 系統設置", callback_data="admin_settings"), InlineKeyboardButton("🧹 清理數據", callback_data="admin_cleanup")],
+            [InlineKeyboardButton("📢 群發消息", callback_data="admin_broadcast")],
             [InlineKeyboardButton("🔙 返回主選單", callback_data="main_menu")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await self.send_message(update, admin_text, reply_markup=reply_markup, parse_mode='Markdown')
     
+    async def broadcast_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """處理 /broadcast 命令
+        
+        /broadcast <受眾> <內容>  預覽並確認後群發
+        /broadcast status|stop|resume  查看、停止或繼續當前群發
+        """
+        user_id = update.effective_user.id
+        
+        if user_id not in self.config.ADMIN_IDS:
+            self.security.log_suspicious_activity(user_id, "嘗試使用群發功能")
+            await self.send_message(update, "❌ 無權限訪問管理功能")
+            return
+        
+        # 保留內容中的換行，只拆出命令和受眾
+        parts = update.message.text.split(maxsplit=2) if update.message and update.message.text else []
+        action = parts[1].lower() if len(parts) > 1 else ''
+        
+        if action == 'status':
+            await self.send_message(update, self.broadcaster.format_progress())
+        elif action == 'stop':
+            stopped = self.broadcaster.stop()
+            await self.send_message(update, "⏸️ 群發將在當前批次發完後停止" if stopped else "ℹ️ 沒有正在進行的群發")
+        elif action == 'resume':
+            resumed = self.broadcaster.resume(stopped=True)
+            await self.send_message(update, "▶️ 群發已繼續" if resumed else "ℹ️ 沒有可以繼續的群發")
+        elif action in AUDIENCES and len(parts) > 2:
+            context.user_data['broadcast_draft'] = {'audience': action, 'text': parts[2]}
+            audience_size = len(await self.storage.run(self.db.get_audience, action))
+            preview_text = f"""📢 群發預覽
+
+受眾: {AUDIENCES[action]}（{audience_size} 人）
+────────────
+{parts[2]}
+────────────
+確認後開始發送，可隨時使用 /broadcast stop 停止。"""
+            keyboard = [
+                [InlineKeyboardButton("✅ 確認發送", callback_data="broadcast_confirm")],
+                [InlineKeyboardButton("❌ 取消", callback_data="broadcast_cancel")]
+            ]
+            # 內容由管理員輸入，不按 Markdown 解析，避免特殊字符導致發送失敗
+            await self.send_message(update, preview_text, reply_markup=InlineKeyboardMarkup(keyboard))
+        else:
+            await self.show_broadcast_help(update, context)
+    
+    async def show_broadcast_help(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """顯示群發用法和當前任務狀態"""
+        user_id = update.effective_user.id
+        
+        if user_id not in self.config.ADMIN_IDS:
+            await update.callback_query.answer("❌ 無權限訪問", show_alert=True)
+            return
+        
+        audiences = '\n'.join(f"• {name}: {label}" for name, label in AUDIENCES.items())
+        help_text = f"""📢 群發消息
+
+用法: /broadcast <受眾> <內容>
+受眾:
+{audiences}
+
+其他命令:
+• /broadcast status 查看進度
+• /broadcast stop 停止群發
+• /broadcast resume 繼續已停止的群發
+
+{self.broadcaster.format_progress()}"""
+        
+        keyboard = [[InlineKeyboardButton("🔙 返回管理", callback_data="admin_panel")]]
+        await self.send_message(update, help_text, reply_markup=InlineKeyboardMarkup(keyboard))
+    
+    async def confirm_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """確認並啟動群發"""
+        user_id = update.effective_user.id
+        query = update.callback_query
+        
+        if user_id not in self.config.ADMIN_IDS:
+            await query.answer("❌ 無權限訪問", show_alert=True)
+            return
+        
+        draft = context.user_data.pop('broadcast_draft', None)
+        if not draft:
+            await query.answer("❌ 群發內容已失效，請重新使用 /broadcast", show_alert=True)
+            return
+        if self.broadcaster.is_running():
+            await query.answer("❌ 已有群發任務正在進行", show_alert=True)
+            return
+        
+        await self.broadcaster.start(draft['audience'], draft['text'], user_id)
+        logger.info(f"管理員 {user_id} 啟動群發，受眾: {draft['audience']}")
+        await query.edit_message_text(f"✅ 群發已開始（{AUDIENCES[draft['audience']]}），進度將在下方消息中更新")
+    
     async def show_admin_panel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """顯示管理員控制面板"""
         user_id = update.effective_user.id
@@ -1322,6 +1651,16 @@ TG營銷系統團隊 敬上 ❤️
         
         try:
             stats = self.db.get_statistics()
+            index_metrics = self.db.get_pending_index_metrics()
+            schedule_metrics = self.smart_monitor.get_schedule_metrics()
+            sync_status = self.activation_manager.get_sync_status()
+            storage_metrics = self.storage.get_metrics()
+            handler_metrics = self.handler_timer.get_metrics()
+            outbox_metrics = self.outbox.get_metrics()
+            processor_metrics = self.update_processor.get_metrics() if self.update_processor else None
+            expiry_stats = self.smart_monitor.expiry.get_stats()
+            session_stats = self.sessions.get_stats()
+            slowest_handler = max(handler_metrics.items(), key=lambda item: item[1]['p95_ms'], default=None)
             
             stats_text = f"""
 📊 **詳細統計報表**
@@ -1352,8 +1691,23 @@ TG營銷系統團隊 敬上 ❤️
 
 🔍 **智能監控狀態**:
 • 監控狀態: {'🟢 運行中' if self.smart_monitor.is_monitoring else '🔴 待命中'}
-• 待監控訂單: {self.smart_monitor.get_pending_orders_count(self.db)}
-• 監控金額: {', '.join([f'{amt:.2f}' for amt in self.smart_monitor.get_monitoring_amounts(self.db)])} USDT
+• 待監控訂單: {self.smart_monitor.get_pending_orders_count()}
+• 監控金額: {', '.join([f'{amt:.2f}' for amt in self.smart_monitor.get_monitoring_amounts()])} USDT
+• 檢查間隔: {schedule_metrics['current_interval']} 秒，近一分鐘 {schedule_metrics['polls_last_minute']} 次
+• 預期檢測延遲: {schedule_metrics['expected_detection_latency']} 秒（最長 {schedule_metrics['worst_detection_latency']} 秒）
+• 待過期訂單: {expiry_stats['pending']}（下一個 {expiry_stats['next_expiry_seconds'] if expiry_stats['next_expiry_seconds'] is not None else '-'} 秒後），已自動過期 {expiry_stats['fired']} 個
+• 金額索引衝突: {index_metrics['collisions']} 次，拒絕模糊匹配: {index_metrics['ambiguous_lookups']} 次
+
+☁️ **雲端同步**:
+• 待同步激活碼: {sync_status['queue_depth']} 個（最久 {sync_status['oldest_age_seconds']} 秒）
+• 已同步: {sync_status['synced']} 個，失敗重試: {sync_status['failed_attempts']} 次，死信: {sync_status['dead_letters']} 個
+
+⏱️ **處理耗時**:
+• 存儲排隊: p95 {storage_metrics['queue_wait']['p95_ms']} ms，等待中 {storage_metrics['pending']} 個
+• 最慢處理器: {f"{slowest_handler[0]} p95 {slowest_handler[1]['p95_ms']} ms" if slowest_handler else '暫無數據'}
+• 更新處理: {f"並發 {processor_metrics['active']}/{processor_metrics['max_workers']}（峰值 {processor_metrics['peak_active']}），排隊 p95 {processor_metrics['queue_wait']['p95_ms']} ms" if processor_metrics else '暫無數據'}
+• 會話緩存: {session_stats['cached_users']} 個用戶，命中率 {session_stats['hit_rate']:.0%}
+• 發送排隊: p95 {outbox_metrics['queue_latency']['p95_ms']} ms，待發送 {sum(outbox_metrics['queue_depth'].values())} 條，限流重試 {outbox_metrics['retry_after']} 次
 
 📅 **更新時間**: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
 """
@@ -1378,26 +1732,29 @@ TG營銷系統團隊 敬上 ❤️
             await update.callback_query.answer("❌ 無權限訪問", show_alert=True)
             return
         
-        blacklist_count = len(self.security.blacklisted_users)
-        suspicious_count = len(self.security.suspicious_activities)
+        abuse_stats = self.security.abuse.get_stats()
+        limiter_stats = self.security.rate_limiter.get_stats()
         
         security_text = f"""
 🛡️ **安全管理面板**
 
 📊 **安全統計**:
-• 黑名單用戶數: {blacklist_count}
-• 可疑活動用戶: {suspicious_count}
-• 速率限制保護: ✅ 啟用
+• 封禁中（用戶/IP/設備/激活碼）: {abuse_stats['banned']}
+• 可疑分數記錄: {abuse_stats['scored']}
+• 封禁攔截: {abuse_stats['blocked']} 次
+• 速率限制保護: ✅ 啟用（{self.security.MAX_REQUESTS_PER_MINUTE}/分鐘，{self.security.MAX_REQUESTS_PER_HOUR}/小時）
+• 限流追蹤用戶: {limiter_stats['tracked_keys']}
+• 限流攔截: 分鐘 {limiter_stats['rejected']['minute']} 次，小時 {limiter_stats['rejected']['hour']} 次
 • 輸入驗證: ✅ 啟用
 
 ⚡ **近期活動**:
 """
         
         # 顯示最近的可疑活動
-        recent_activities = list(self.security.suspicious_activities.items())[-5:]
+        recent_activities = self.security.abuse.recent_scores(5)
         if recent_activities:
-            for user_id, count in recent_activities:
-                security_text += f"• 用戶 {user_id}: {count} 次可疑操作\n"
+            for key, score in recent_activities:
+                security_text += f"• `{key}`: 可疑分數 {score:.1f}\n"
         else:
             security_text += "• 暫無可疑活動\n"
         
@@ -1587,6 +1944,13 @@ TG營銷系統團隊 敬上 ❤️
             await query.answer("清理數據功能開發中", show_alert=True)
         elif data == "admin_settings":
             await query.answer("系統設置功能開發中", show_alert=True)
+        elif data == "admin_broadcast":
+            await self.show_broadcast_help(update, context)
+        elif data == "broadcast_confirm":
+            await self.confirm_broadcast(update, context)
+        elif data == "broadcast_cancel":
+            context.user_data.pop('broadcast_draft', None)
+            await query.edit_message_text("❌ 已取消群發")
         elif data == "security_panel":
             await self.show_security_panel(update, context)
         elif data == "security_blacklist":
@@ -1633,7 +1997,7 @@ TG營銷系統團隊 敬上 ❤️
         
         if order['status'] == 'paid':
             try:
-                activation_code = self.activation_manager.get_activation_code_by_order(order_id)
+                activation_code = self.sessions.get(user_id).code_by_order.get(order_id)
                 if not activation_code:
                     activation_code = "未找到激活碼，請聯繫客服"
                 
@@ -1665,6 +2029,9 @@ TG營銷系統團隊 敬上 ❤️
                 await update.callback_query.answer("❌ 顯示付款信息時發生錯誤", show_alert=True)
                 
         elif order['status'] == 'pending':
+            # 用戶表示已付款，加速檢查該訂單
+            await self.boost_payment_check(order)
+            
             # 訂單仍在等待付款
             status_text = f"""🔍 付款狀態檢查
 
@@ -1717,7 +2084,7 @@ TG營銷系統團隊 敬上 ❤️
     async def show_user_orders(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """顯示用戶訂單"""
         user_id = update.effective_user.id
-        orders = self.db.get_user_orders(user_id)
+        orders = self.sessions.get(user_id).orders
         
         if not orders:
             text = "📋 您還沒有任何訂單\n\n使用 /order 開始購買"
@@ -1753,7 +2120,7 @@ TG營銷系統團隊 敬上 ❤️
                 return
             
             # 更新訂單狀態為已取消
-            self.db.update_order_status(order_id, 'cancelled')
+            await self.storage.run(self.db.update_order_status, order_id, 'cancelled')
             
             # 從智能監控中移除
             try:
@@ -1804,6 +2171,9 @@ TG營銷系統團隊 敬上 ❤️
                 await update.callback_query.answer("❌ 訂單狀態異常", show_alert=True)
                 return
             
+            # 加速檢查該訂單
+            await self.boost_payment_check(order)
+            
             # 發送確認請求消息
             confirm_text = f"""✅ 付款確認請求已提交
 
@@ -1849,7 +2219,7 @@ TG營銷系統團隊 敬上 ❤️
                 return
             
             # 更新訂單狀態為已取消
-            self.db.update_order_status(order_id, 'cancelled')
+            await self.storage.run(self.db.update_order_status, order_id, 'cancelled')
             
             cancel_text = f"""❌ 測試已取消
 
@@ -1919,6 +2289,46 @@ TG營銷系統團隊 敬上 ❤️
             logger.error(f"複製地址失敗: {e}")
             await update.callback_query.answer("❌ 獲取地址時發生錯誤，請重試", show_alert=True)
     
+    def create_order_with_unique_amount(self, order_data: Dict, plan_type: str) -> float:
+        """生成唯一金額並創建訂單，返回金額（在存儲線程中一次完成，兩步之間不會插入其他訂單）"""
+        order_data['amount'] = self.generate_unique_amount(plan_type)
+        self.db.create_order(order_data)
+        return order_data['amount']
+    
+    def mark_order_paid(self, order: Dict, tx_hash: str, transaction_data: Dict = None) -> bool:
+        """把待付款訂單標記為已付款並把交易記入賬本；訂單已被處理時返回 False（在存儲線程中執行，避免重複處理）
+        
+        記入賬本後，這筆付款不會再被後續輪詢匹配給相同金額的新訂單"""
+        if order['status'] != 'pending':
+            return False
+        self.db.update_order_status(order['order_id'], 'paid', tx_hash)
+        self.db.save_transaction(tx_hash, dict(transaction_data or {}, order_id=order['order_id']))
+        return True
+    
+    def activate_paid_order(self, order: Dict, tx_hash: str, transaction_data: Dict) -> Optional[str]:
+        """為待付款訂單生成激活碼，再標記為已付款並記入賬本，返回激活碼；訂單已被處理時返回 None（在存儲線程中執行）
+        
+        先生成激活碼：中途出錯或進程退出時訂單仍為待付款，重試時沿用已生成的激活碼"""
+        if order['status'] != 'pending':
+            return None
+        activation_code = self.db.get_activation_code_by_order(order['order_id']) or \
+            self.activation_manager.generate_activation_code(
+                plan_type=order['plan_type'],
+                days=order['days'],
+                user_id=order['user_id'],
+                order_id=order['order_id']
+            )
+        self.mark_order_paid(order, tx_hash, transaction_data)
+        return activation_code
+    
+    def cancel_order_if_pending(self, order_id: str) -> Optional[Dict]:
+        """取消仍待付款的訂單，返回訂單；已付款或已取消時返回 None（在存儲線程中執行）"""
+        order = self.db.get_order(order_id)
+        if not order or order.get('status') != 'pending':
+            return None
+        self.db.update_order_status(order_id, 'cancelled')
+        return order
+    
     def generate_unique_amount(self, plan_type: str) -> float:
         """生成唯一的訂單金額，避免與其他訂單衝突"""
         base_amount = self.pricing[plan_type]['price']
@@ -1974,10 +2384,8 @@ TG營銷系統團隊 敬上 ❤️
         return round(unique_amount, 2)
     
     def generate_order_id(self) -> str:
-        """生成訂單ID"""
-        timestamp = str(int(time.time()))[-6:]
-        random_str = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
-        return f"TG{timestamp}{random_str}"
+        """生成訂單ID（按創建時間排序，可作為時間索引）"""
+        return self.order_ids.next_id()
     
     def format_order_status(self, order: Dict) -> str:
         """格式化訂單狀態"""
@@ -2015,6 +2423,40 @@ TG營銷系統團隊 敬上 ❤️
         }
         return status_map.get(status, '❓')
 
+def register_handlers(application: Application, bot: TGMarketingBot, wrap=None):
+    """註冊處理器（wrap 用於包裝處理器計時，默認使用機器人自帶的計時器）"""
+    timed = wrap or bot.handler_timer.wrap
+    
+    # 添加主要命令處理器（簡化版）
+    application.add_handler(CommandHandler("start", timed(bot.start_command)))
+    application.add_handler(CommandHandler("admin", timed(bot.admin_command)))  # 保留管理員命令
+    application.add_handler(CommandHandler("broadcast", timed(bot.broadcast_command)))
+    
+    # 添加按鈕回調處理器
+    application.add_handler(CallbackQueryHandler(timed(bot.button_callback)))
+    
+    # 添加消息處理器（處理訂單號查詢等）
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed(bot.handle_message)))
+    
+    # 添加錯誤處理器
+    async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """處理錯誤"""
+        logger.error(f"Exception while handling an update: {context.error}")
+        
+        # 嘗試向用戶發送錯誤消息
+        if update and hasattr(update, 'effective_user') and update.effective_user:
+            try:
+                error_text = "⚠️ 處理您的請求時發生錯誤，請稍後重試或聯繫客服。"
+                
+                if hasattr(update, 'message') and update.message:
+                    await update.message.reply_text(error_text)
+                elif hasattr(update, 'callback_query') and update.callback_query:
+                    await update.callback_query.answer(error_text, show_alert=True)
+            except Exception as e:
+                logger.error(f"Failed to send error message to user: {e}")
+        
+    application.add_error_handler(error_handler)
+
 def main():
     """主函數"""
     try:
@@ -2024,40 +2466,15 @@ def main():
             logger.error("❌ 未設置 BOT_TOKEN 環境變量")
             return
         
-        # 創建機器人實例
-        bot = TGMarketingBot()
+        # 創建共享數據庫和機器人實例
+        db = Database(config.DATABASE_FILE)
+        bot = TGMarketingBot(db=db)
         
         # 創建應用程序
-        application = Application.builder().token(config.BOT_TOKEN).build()
-        
-        # 添加主要命令處理器（簡化版）
-        application.add_handler(CommandHandler("start", bot.start_command))
-        application.add_handler(CommandHandler("admin", bot.admin_command))  # 保留管理員命令
-        
-        # 添加按鈕回調處理器
-        application.add_handler(CallbackQueryHandler(bot.button_callback))
-        
-        # 添加消息處理器（處理訂單號查詢等）
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_message))
-        
-        # 添加錯誤處理器
-        async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-            """處理錯誤"""
-            logger.error(f"Exception while handling an update: {context.error}")
-            
-            # 嘗試向用戶發送錯誤消息
-            if update and hasattr(update, 'effective_user') and update.effective_user:
-                try:
-                    error_text = "⚠️ 處理您的請求時發生錯誤，請稍後重試或聯繫客服。"
-                    
-                    if hasattr(update, 'message') and update.message:
-                        await update.message.reply_text(error_text)
-                    elif hasattr(update, 'callback_query') and update.callback_query:
-                        await update.callback_query.answer(error_text, show_alert=True)
-                except Exception as e:
-                    logger.error(f"Failed to send error message to user: {e}")
-            
-        application.add_error_handler(error_handler)
+        # 並發處理更新，一個慢處理器不會阻塞其他用戶；同一用戶的更新按順序處理
+        bot.update_processor = PerUserUpdateProcessor(max_workers=config.CONCURRENT_UPDATES)
+        application = Application.builder().token(config.BOT_TOKEN).concurrent_updates(bot.update_processor).build()
+        register_handlers(application, bot)
         
         # 保存應用程序實例到機器人中，以便在付款確認時發送消息
         bot.application = application
@@ -2066,31 +2483,58 @@ def main():
         async def post_init(application):
             logger.info("✅ 機器人初始化完成，智能監控待命中...")
             
-            # 啟動定期清理過期訂單的任務
-            async def periodic_cleanup():
-                """定期清理過期訂單"""
-                while True:
-                    try:
-                        # 每5分鐘檢查一次過期訂單
-                        await asyncio.sleep(300)  # 5分鐘
-                        
-                        # 清理過期訂單
-                        expired_count = bot.smart_monitor.cleanup_expired_orders(bot.db)
-                        if expired_count > 0:
-                            logger.info(f"📋 定期清理：已自動取消 {expired_count} 個過期訂單")
-                            
-                    except Exception as e:
-                        logger.error(f"❌ 定期清理任務錯誤: {e}")
-                        await asyncio.sleep(60)  # 錯誤時等待1分鐘再重試
-            
-            # 啟動定期清理任務
-            asyncio.create_task(periodic_cleanup())
+            # 啟動發送隊列
+            bot.outbox.start(application.bot)
+            
+            # 重啟前仍有待付款訂單時，立即恢復監控
+            await bot.start_smart_monitoring()
+            
+            # 啟動激活碼雲端同步後台任務
+            await bot.activation_manager.start_cloud_sync()
+            
+            # 啟動訂單過期調度（訂單到期時準時取消並通知用戶）
+            bot.start_expiry_scheduler()
+            
+            # 啟動統計聚合定期核對
+            bot.start_stats_reconciler()
+            
+            # 重啟前未完成的群發從斷點繼續
+            bot.broadcaster.resume()
+        
+        async def post_shutdown(application):
+            # 盡量發完隊列中的消息，並等待已提交的存儲寫入完成
+            bot.smart_monitor.expiry.stop()
+            if bot.stats_reconcile_task:
+                bot.stats_reconcile_task.cancel()
+            await bot.broadcaster.shutdown()
+            await bot.outbox.stop()
+            await bot.activation_manager.stop_cloud_sync()
+            bot.storage.shutdown()
+            bot.security.abuse.close()
         
         application.post_init = post_init
+        application.post_shutdown = post_shutdown
         
         # 啟動機器人
         logger.info("🚀 TG營銷系統機器人啟動中...")
         
+        if config.BOT_MODE == 'webhook':
+            # webhook 模式：Telegram 直接推送更新，重啟期間的更新不會丟失
+            if not config.WEBHOOK_SECRET_TOKEN:
+                logger.error("❌ webhook 模式需要設置 WEBHOOK_SECRET_TOKEN 環境變量")
+                return
+            server = WebhookServer(
+                application,
+                secret_token=config.WEBHOOK_SECRET_TOKEN,
+                listen=config.WEBHOOK_LISTEN,
+                port=config.WEBHOOK_PORT,
+                url_path=config.WEBHOOK_PATH,
+                max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+                drain_timeout=config.WEBHOOK_DRAIN_TIMEOUT
+            )
+            asyncio.run(run_webhook(application, server, config.WEBHOOK_URL))
+            return
+        
         # 使用 polling 模式以避免 webhook 配置問題
         # 添加錯誤處理以避免多實例衝突
         application.run_polling(
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+監控檢查點模塊 - 持久化監控進度，重啟後從斷點恢復
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class MonitorCheckpoint:
+    """監控檢查點文件，按分區保存各監控器的進度"""
+
+    def __init__(self, checkpoint_file: str = 'monitor_checkpoint.json'):
+        self.checkpoint_file = checkpoint_file
+        self.lock = threading.Lock()
+        self.data: Dict[str, Dict] = self._load()
+
+    def _load(self) -> Dict[str, Dict]:
+        """加載檢查點"""
+        if os.path.exists(self.checkpoint_file):
+            try:
+                with open(self.checkpoint_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (json.JSONDecodeError, IOError) as e:
+                logger.warning(f"⚠️ 加載監控檢查點失敗，將從頭開始: {e}")
+        return {}
+
+    def get(self, section: str, default: Any = None) -> Any:
+        """獲取分區數據"""
+        entry = self.data.get(section)
+        return entry['value'] if entry else default
+
+    def saved_at(self, section: str) -> Optional[float]:
+        """分區最後保存時間（Unix 時間戳）"""
+        entry = self.data.get(section)
+        return entry['saved_at'] if entry else None
+
+    def save(self, section: str, value: Any):
+        """保存分區數據（先寫臨時文件再替換，崩潰時不會損壞舊檢查點）"""
+        with self.lock:
+            self.data[section] = {'value': value, 'saved_at': time.time()}
+            try:
+                temp_file = f"{self.checkpoint_file}.tmp"
+                with open(temp_file, 'w', encoding='utf-8') as f:
+                    json.dump(self.data, f, ensure_ascii=False)
+                os.replace(temp_file, self.checkpoint_file)
+            except IOError as e:
+                logger.error(f"❌ 保存監控檢查點失敗: {e}")
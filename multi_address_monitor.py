@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多地址付款監控模塊 - 一個輪詢循環服務所有代理商機器人
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Callable, Dict, List, Optional
+
+from tron_monitor import TronMonitor
+
+logger = logging.getLogger(__name__)
+
+class PaymentInbox:
+    """跨進程付款收件箱 - 監控服務寫入，機器人進程讀取（JSON Lines 文件）"""
+
+    MAX_ENTRIES = 1000  # 超過後壓縮，只保留最近的付款
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+        self.lock = threading.Lock()
+        # 已讀取且仍在時間窗口內的付款 {tx_hash: 付款}，未匹配的付款之後仍可匹配
+        self.recent: Dict[str, Dict] = {}
+
+    def append(self, payment: Dict):
+        """寫入一筆付款"""
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(payment, ensure_ascii=False) + '\n')
+            self._compact_if_needed()
+
+    def _compact_if_needed(self):
+        """文件過大時只保留最近的付款"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except IOError:
+            return
+
+        if len(lines) <= self.MAX_ENTRIES:
+            return
+
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.writelines(lines[-self.MAX_ENTRIES // 2:])
+        os.replace(temp_path, self.path)
+
+    def read_recent(self, max_age_minutes: int = 30) -> List[Dict]:
+        """讀取時間窗口內的全部付款：新增的從文件讀取，之前讀過的保留在內存中直到超出窗口
+        （付款到達時訂單尚未進入監控，或處理失敗時，下一輪仍可匹配；已處理的付款由調用方按交易賬本過濾）"""
+        cutoff_ms = (time.time() - max_age_minutes * 60) * 1000
+
+        if os.path.exists(self.path):
+            # 文件被壓縮過，從頭讀取（已讀過的付款按交易哈希去重）
+            if os.path.getsize(self.path) < self.offset:
+                self.offset = 0
+
+            with open(self.path, 'r', encoding='utf-8') as f:
+                f.seek(self.offset)
+                for line in f:
+                    if not line.endswith('\n'):
+                        break  # 寫入中的行，下次再讀
+                    self.offset += len(line.encode('utf-8'))
+                    try:
+                        payment = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"⚠️ 收件箱 {self.path} 中有無效記錄")
+                        continue
+                    if payment.get('tx_hash') and payment.get('timestamp', 0) >= cutoff_ms:
+                        self.recent[payment['tx_hash']] = payment
+
+        for tx_hash in [tx_hash for tx_hash, payment in self.recent.items()
+                        if payment.get('timestamp', 0) < cutoff_ms]:
+            del self.recent[tx_hash]
+
+        return list(self.recent.values())
+
+class MultiAddressMonitor:
+    """多地址付款監控器 - 每個收款地址每輪只查詢一次，按地址分發給所屬機器人"""
+
+    MAX_SEEN_TRANSACTIONS = 10000
+
+    def __init__(self, tron_monitor: TronMonitor = None, interval: int = 30, max_age_minutes: int = 30):
+        self.tron_monitor = tron_monitor or TronMonitor()
+        self.interval = interval
+        self.max_age_minutes = max_age_minutes
+        self.is_monitoring = False
+
+        # 地址 -> 所屬機器人列表；機器人 -> 回調 / 隊列
+        self.address_owners = defaultdict(set)
+        self.owner_address = {}
+        self.callbacks = {}
+        self.queues = {}
+
+        # 已分發交易（有界）
+        self.seen_transactions = OrderedDict()
+
+        self.stats = {
+            'polls': 0,
+            'address_queries': 0,
+            'dispatched': 0
+        }
+
+    def watch(self, owner_id: str, address: str, callback: Callable = None) -> Optional[asyncio.Queue]:
+        """註冊收款地址；提供回調時直接回調，否則返回該機器人的付款隊列"""
+        self.unwatch(owner_id)
+
+        self.address_owners[address].add(owner_id)
+        self.owner_address[owner_id] = address
+        if callback:
+            self.callbacks[owner_id] = callback
+        else:
+            self.queues[owner_id] = asyncio.Queue()
+
+        logger.info(f"📧 {owner_id} 監控地址 {address}（共 {len(self.address_owners)} 個地址）")
+        return self.queues.get(owner_id)
+
+    def unwatch(self, owner_id: str):
+        """取消機器人的地址監控"""
+        address = self.owner_address.pop(owner_id, None)
+        if address:
+            self.address_owners[address].discard(owner_id)
+            if not self.address_owners[address]:
+                del self.address_owners[address]
+        self.callbacks.pop(owner_id, None)
+        self.queues.pop(owner_id, None)
+
+    async def poll_once(self) -> int:
+        """輪詢所有地址一次，返回分發的付款數"""
+        addresses = list(self.address_owners.keys())
+        if not addresses:
+            return 0
+
+        self.stats['polls'] += 1
+        self.stats['address_queries'] += len(addresses)
+
+        # 所有地址的查詢並發發出，由共享速率限制器統一調度
+        results = await asyncio.gather(
+            *[self.tron_monitor.get_recent_payments(address, self.max_age_minutes) for address in addresses],
+            return_exceptions=True
+        )
+
+        dispatched = 0
+        for address, payments in zip(addresses, results):
+            if isinstance(payments, Exception):
+                logger.error(f"❌ 查詢地址 {address} 付款失敗: {payments}")
+                continue
+
+            for payment in payments:
+                tx_hash = payment.get('tx_hash')
+                if not tx_hash or tx_hash in self.seen_transactions:
+                    continue
+
+                self.seen_transactions[tx_hash] = time.time()
+                if len(self.seen_transactions) > self.MAX_SEEN_TRANSACTIONS:
+                    self.seen_transactions.popitem(last=False)
+
+                for owner_id in list(self.address_owners.get(address, ())):
+                    await self._dispatch(owner_id, payment)
+                    dispatched += 1
+
+        self.stats['dispatched'] += dispatched
+        return dispatched
+
+    async def _dispatch(self, owner_id: str, payment: Dict):
+        """把付款交給所屬機器人"""
+        queue = self.queues.get(owner_id)
+        if queue is not None:
+            queue.put_nowait(payment)
+
+        callback = self.callbacks.get(owner_id)
+        if callback:
+            try:
+                result = callback(payment)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logger.error(f"❌ 分發付款給 {owner_id} 失敗: {e}")
+
+    async def run(self):
+        """監控主循環"""
+        self.is_monitoring = True
+        logger.info(f"🔍 多地址付款監控已啟動，間隔 {self.interval} 秒")
+
+        consecutive_errors = 0
+        while self.is_monitoring:
+            try:
+                await self.poll_once()
+                consecutive_errors = 0
+                await asyncio.sleep(self.interval)
+            except Exception as e:
+                logger.error(f"❌ 多地址監控錯誤: {e}")
+                await asyncio.sleep(self.tron_monitor.rate_limiter.backoff_delay(consecutive_errors))
+                consecutive_errors += 1
+
+        await self.tron_monitor.close()
+
+    def stop(self):
+        """停止監控"""
+        self.is_monitoring = False
+        logger.info("⏹️ 多地址付款監控已停止")
+
+    def get_status(self) -> Dict:
+        """獲取監控狀態"""
+        return {
+            'addresses': len(self.address_owners),
+            'owners': len(self.owner_address),
+            **self.stats
+        }
+
+def get_inbox_path(bot_id: str) -> str:
+    """機器人付款收件箱路徑"""
+    return f"payment_inbox_{bot_id}.jsonl"
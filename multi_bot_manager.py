@@ -15,6 +15,8 @@ import subprocess
 import threading
 import time
 
+from multi_address_monitor import MultiAddressMonitor, PaymentInbox, get_inbox_path
+
 # 配置日誌
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -27,6 +29,8 @@ class MultiBotManager:
         self.bot_configs = {}  # 機器人配置
         self.agent_bot_mapping = {}  # 代理商-機器人映射
         self.running_processes = {}  # 運行中的進程
+        self.payment_monitor = None  # 共享付款監控（所有機器人共用一個輪詢）
+        self.payment_monitor_loop = None
         
         # 從環境變量和配置文件載入機器人
         self.load_bot_configurations()
@@ -118,9 +122,18 @@ class MultiBotManager:
                 'TRONGRID_API_KEY': config['api_key'] or '',
                 'BOT_NAME': config['name'],
                 'AGENT_ID': config['agent_id'] or '',
-                'TEST_MODE': os.getenv('TEST_MODE', 'true')
+                'TEST_MODE': os.getenv('TEST_MODE', 'true'),
+                # 每個機器人獨立的監控檢查點和確認狀態
+                'MONITOR_CHECKPOINT_FILE': f"monitor_checkpoint_{bot_id}.json",
+                'CONFIRMATION_STATE_FILE': f"confirmation_state_{bot_id}.json",
+                # 每個機器人固定的訂單號節點，保證訂單號跨進程唯一
+                'ORDER_ID_NODE': str(list(self.bot_configs).index(bot_id) + 1)
             })
             
+            # 共享付款監控運行時，機器人從收件箱讀取付款而不是自己輪詢
+            if self.payment_monitor and config['usdt_address']:
+                env['PAYMENT_INBOX_FILE'] = get_inbox_path(bot_id)
+            
             # 啟動機器人進程
             process = subprocess.Popen(
                 ['python', 'main.py'],
@@ -224,6 +237,9 @@ class MultiBotManager:
         
         self.agent_bot_mapping[agent_id] = bot_id
         
+        # 加入共享付款監控
+        self.watch_bot_address(bot_id)
+        
         # 保存配置到文件
         self.save_agent_configs()
         
@@ -238,6 +254,9 @@ class MultiBotManager:
         if bot_id in self.running_processes:
             self.stop_bot(bot_id)
         
+        if self.payment_monitor:
+            self.payment_monitor_loop.call_soon_threadsafe(self.payment_monitor.unwatch, bot_id)
+        
         # 移除配置
         if bot_id in self.bot_configs:
             del self.bot_configs[bot_id]
@@ -271,6 +290,46 @@ class MultiBotManager:
         except Exception as e:
             logger.error(f"保存代理商配置失敗: {e}")
     
+    def start_payment_monitor(self) -> bool:
+        """在背景線程中啟動共享付款監控，按收款地址分發給各機器人"""
+        try:
+            loop = asyncio.new_event_loop()
+            monitor = MultiAddressMonitor()
+            # 與機器人進程保持一致的測試模式
+            monitor.tron_monitor.test_mode = os.getenv('TEST_MODE', 'true').lower() == 'true'
+            
+            for bot_id, config in self.bot_configs.items():
+                if config['usdt_address']:
+                    inbox = PaymentInbox(get_inbox_path(bot_id))
+                    monitor.watch(bot_id, config['usdt_address'], callback=inbox.append)
+            
+            self.payment_monitor = monitor
+            self.payment_monitor_loop = loop
+            
+            def run_monitor():
+                asyncio.set_event_loop(loop)
+                loop.run_until_complete(monitor.run())
+            
+            threading.Thread(target=run_monitor, daemon=True).start()
+            logger.info(f"💰 共享付款監控已啟動: {monitor.get_status()['addresses']} 個收款地址")
+            return True
+            
+        except Exception as e:
+            logger.error(f"啟動共享付款監控失敗: {e}")
+            self.payment_monitor = None
+            return False
+    
+    def watch_bot_address(self, bot_id: str):
+        """將機器人收款地址加入共享監控"""
+        config = self.bot_configs.get(bot_id)
+        if not self.payment_monitor or not config or not config['usdt_address']:
+            return
+        
+        inbox = PaymentInbox(get_inbox_path(bot_id))
+        self.payment_monitor_loop.call_soon_threadsafe(
+            self.payment_monitor.watch, bot_id, config['usdt_address'], inbox.append
+        )
+    
     def get_agent_bot(self, agent_id: str) -> Optional[str]:
         """獲取代理商對應的機器人ID"""
         return self.agent_bot_mapping.get(agent_id)
@@ -319,6 +378,9 @@ def main():
     print("=" * 50)
     
     try:
+        # 啟動共享付款監控（需在機器人啟動前，以便傳入收件箱路徑）
+        manager.start_payment_monitor()
+        
         # 啟動所有機器人
         manager.start_all_bots()
         
@@ -335,6 +397,8 @@ def main():
     except KeyboardInterrupt:
         print("\n🛑 收到停止信號...")
         manager.stop_all_bots()
+        if manager.payment_monitor:
+            manager.payment_monitor_loop.call_soon_threadsafe(manager.payment_monitor.stop)
         print("👋 所有機器人已停止")
 
 if __name__ == "__main__":
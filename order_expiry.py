@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+訂單過期調度模塊 - 按到期時間排序的最小堆，訂單到期時準時觸發
+
+添加、取消、觸發都是 O(log N)，不再定期掃描全部待付款訂單。
+取消採用延遲刪除：只移除索引，堆中的舊條目在彈出時跳過，過多時重建堆。
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class ExpiryScheduler:
+    """訂單過期調度器"""
+
+    def __init__(self):
+        self.heap = []                       # [(到期時間戳, 序號, order_id)]
+        self.deadlines: Dict[str, float] = {}  # {order_id: 當前有效的到期時間戳}
+        self._counter = itertools.count()
+        self._wake_event: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.is_running = False
+
+        self.stats = {
+            'scheduled': 0,
+            'cancelled': 0,
+            'fired': 0,
+            'errors': 0
+        }
+
+    def schedule(self, order_id: str, expires_at: datetime):
+        """安排訂單在 expires_at 過期（重複安排時以最後一次為準）"""
+        deadline = expires_at.timestamp()
+        self.deadlines[order_id] = deadline
+        heapq.heappush(self.heap, (deadline, next(self._counter), order_id))
+        self.stats['scheduled'] += 1
+        # 新的最早到期時間需要喚醒調度循環重新計時
+        if self.heap[0][2] == order_id:
+            self._wake()
+
+    def cancel(self, order_id: str):
+        """取消訂單的過期計劃（已付款或已手動取消）"""
+        if self.deadlines.pop(order_id, None) is not None:
+            self.stats['cancelled'] += 1
+            if len(self.heap) > 2 * len(self.deadlines) + 64:
+                self._compact()
+
+    def _compact(self):
+        """移除已取消的堆條目"""
+        self.heap = [entry for entry in self.heap if self.deadlines.get(entry[2]) == entry[0]]
+        heapq.heapify(self.heap)
+
+    def _wake(self):
+        if self._loop and self._wake_event:
+            self._loop.call_soon_threadsafe(self._wake_event.set)
+
+    def _pop_due(self, now: float) -> Optional[str]:
+        """彈出一個已到期的訂單；沒有時返回 None"""
+        while self.heap and self.heap[0][0] <= now:
+            deadline, _, order_id = heapq.heappop(self.heap)
+            if self.deadlines.get(order_id) == deadline:
+                del self.deadlines[order_id]
+                return order_id
+        return None
+
+    def next_delay(self) -> Optional[float]:
+        """距離下一個有效到期的秒數；沒有待過期訂單時返回 None"""
+        while self.heap and self.deadlines.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - time.time())
+
+    async def run(self, on_expire: Callable[[str], Awaitable]):
+        """調度循環：訂單到期時調用 on_expire(order_id)"""
+        self.is_running = True
+        self._loop = asyncio.get_running_loop()
+        self._wake_event = asyncio.Event()
+        logger.info(f"⏰ 訂單過期調度已啟動，待過期訂單 {len(self.deadlines)} 個")
+
+        while self.is_running:
+            order_id = self._pop_due(time.time())
+            if order_id:
+                self.stats['fired'] += 1
+                try:
+                    await on_expire(order_id)
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    logger.error(f"❌ 處理訂單 {order_id} 過期失敗: {e}")
+                continue
+
+            self._wake_event.clear()
+            try:
+                await asyncio.wait_for(self._wake_event.wait(), timeout=self.next_delay())
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self):
+        self.is_running = False
+        self._wake()
+
+    def get_stats(self) -> Dict:
+        delay = self.next_delay()
+        return {
+            'pending': len(self.deadlines),
+            'heap_size': len(self.heap),
+            'next_expiry_seconds': round(delay, 1) if delay is not None else None,
+            **self.stats
+        }
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+訂單號模塊 - 按時間排序、多進程不衝突的訂單號
+
+格式: TG + 8 位毫秒時間戳 + 2 位節點號 + 2 位序號（均為大寫 36 進制，定長）
+- 定長大寫 36 進制的字典序與數值順序一致，訂單號按創建時間排序，可直接按範圍查詢
+- 同一毫秒內用序號區分，序號用完或時鐘回撥時借用下一毫秒，保證單調遞增
+- 節點號區分不同的機器人進程: 優先使用 ORDER_ID_NODE，否則在工作目錄中用鎖文件申請
+- 共 14 個字符，符合 SecurityManager.order_id_pattern（TG + 8-12 位）
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+PREFIX = 'TG'
+TIME_DIGITS = 8    # 36^8 毫秒，可用到 2059 年
+NODE_DIGITS = 2    # 最多 1296 個節點
+SEQ_DIGITS = 2     # 每毫秒每節點最多 1296 個訂單
+ORDER_ID_LENGTH = len(PREFIX) + TIME_DIGITS + NODE_DIGITS + SEQ_DIGITS
+MAX_NODES = len(ALPHABET) ** NODE_DIGITS
+MAX_SEQ = len(ALPHABET) ** SEQ_DIGITS
+
+def encode_base36(value: int, digits: int) -> str:
+    chars = []
+    for _ in range(digits):
+        value, remainder = divmod(value, len(ALPHABET))
+        chars.append(ALPHABET[remainder])
+    if value:
+        raise ValueError(f"數值超出 {digits} 位 36 進制範圍")
+    return ''.join(reversed(chars))
+
+def _order_id_millis(order_id: str) -> Optional[int]:
+    if not order_id or len(order_id) != ORDER_ID_LENGTH or not order_id.startswith(PREFIX):
+        return None
+    try:
+        return int(order_id[len(PREFIX):len(PREFIX) + TIME_DIGITS], 36)
+    except ValueError:
+        return None
+
+def order_id_time(order_id: str) -> Optional[datetime]:
+    """從訂單號解析創建時間；舊格式訂單號返回 None"""
+    millis = _order_id_millis(order_id)
+    return datetime.fromtimestamp(millis / 1000) if millis is not None else None
+
+def order_id_lower_bound(moment: datetime) -> str:
+    """不早於 moment 創建的訂單號的最小值（用於範圍查詢）"""
+    millis = max(0, int(moment.timestamp() * 1000))
+    return PREFIX + encode_base36(millis, TIME_DIGITS) + '0' * (NODE_DIGITS + SEQ_DIGITS)
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def claim_node_id(directory: str = '.') -> int:
+    """在目錄中用鎖文件申請一個未被運行中進程佔用的節點號（同一主機上的多個機器人進程互不衝突）"""
+    for node_id in range(1, MAX_NODES):
+        lock_file = os.path.join(directory, f".order_node_{node_id}.lock")
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                with open(lock_file, 'r') as f:
+                    owner = int(f.read().strip() or 0)
+            except (IOError, ValueError):
+                continue
+            if owner == os.getpid():
+                return node_id
+            if owner and _process_alive(owner):
+                continue
+            # 持有者已退出，接管鎖文件
+            try:
+                os.remove(lock_file)
+                fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError:
+                continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(os.getpid()))
+        return node_id
+    raise RuntimeError("沒有可用的訂單號節點")
+
+class OrderIdGenerator:
+    """訂單號生成器（線程安全）"""
+
+    def __init__(self, node_id: int):
+        if not 0 <= node_id < MAX_NODES:
+            raise ValueError(f"節點號必須在 0-{MAX_NODES - 1} 之間: {node_id}")
+        self.node = encode_base36(node_id, NODE_DIGITS)
+        self.lock = threading.Lock()
+        self.last_millis = 0
+        self.seq = 0
+
+    @classmethod
+    def from_env(cls, directory: str = '.') -> 'OrderIdGenerator':
+        """節點號取自 ORDER_ID_NODE，未設置時自動申請"""
+        node_env = os.getenv('ORDER_ID_NODE')
+        node_id = int(node_env) if node_env else claim_node_id(directory)
+        logger.info(f"🆔 訂單號節點: {node_id}")
+        return cls(node_id)
+
+    def seed(self, order_id: Optional[str]):
+        """以已存在的最新訂單號為起點（重啟後時鐘回撥也不會生成更早或重複的訂單號）"""
+        millis = _order_id_millis(order_id)
+        if millis is None:
+            return
+        with self.lock:
+            if millis >= self.last_millis:
+                # 下一個同毫秒的訂單號借用下一毫秒
+                self.last_millis = millis
+                self.seq = MAX_SEQ - 1
+
+    def next_id(self) -> str:
+        with self.lock:
+            millis = int(time.time() * 1000)
+            if millis > self.last_millis:
+                self.last_millis = millis
+                self.seq = 0
+            else:
+                # 同一毫秒或時鐘回撥：沿用上一個時間戳並遞增序號，用完時借用下一毫秒
+                self.seq += 1
+                if self.seq >= MAX_SEQ:
+                    self.last_millis += 1
+                    self.seq = 0
+            return (PREFIX + encode_base36(self.last_millis, TIME_DIGITS)
+                    + self.node + encode_base36(self.seq, SEQ_DIGITS))
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+付款流程壓測 - 針對本地 TronScan 模擬服務批量創建訂單並付款，
+統計激活耗時、每單 API 調用次數和漏單數
+
+--check 在有漏單或錯誤激活時以非零狀態退出；--regression 依次運行幾個小規模場景（測試模式 TRX 和生產模式 USDT）
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 回歸場景: (名稱, 環境變量, 命令行參數)，每個場景在獨立進程中運行（端點池和限流器是進程內共享的）
+REGRESSION_ARGS = ['--orders', '30', '--pay-window', '3', '--timeout', '12', '--check-interval', '1']
+REGRESSION_SCENARIOS = [
+    ('smart TRX', {'TEST_MODE': 'true'}, ['--mode', 'smart']),
+    ('smart USDT', {'TEST_MODE': 'false'}, ['--mode', 'smart']),
+    ('blocks USDT', {'TEST_MODE': 'false'}, ['--mode', 'blocks']),
+]
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+async def run_load_test(args):
+    from fake_tronscan import FakeChain, FakeTronScan
+
+    chain = FakeChain(block_interval=args.block_interval, noise_per_block=args.noise)
+    if args.fixture:
+        chain.load_fixture(args.fixture)
+    server = FakeTronScan(chain, rate_limit=args.server_rate_limit, latency=args.latency)
+    os.environ['TRONGRID_API_URL'] = await server.start()
+
+    # 可選：在前面放一個同鏈的慢端點，驗證端點選擇和對沖請求
+    slow_server = None
+    if args.slow_endpoint_latency:
+        slow_server = FakeTronScan(chain, latency=args.slow_endpoint_latency)
+        slow_url = await slow_server.start(mine=False)
+        os.environ['TRON_API_URLS'] = f"{slow_url},{os.environ['TRONGRID_API_URL']}"
+
+    # 在模擬環境下構建機器人（不連接 Telegram，不同步雲端）
+    from main import TGMarketingBot
+
+    bot = TGMarketingBot()
+    bot.application = None
+    bot.activation_manager.enable_cloud_sync = False
+    bot.smart_monitor.CHECK_INTERVAL_SECONDS = args.check_interval
+    bot.tron_monitor.config.MONITORING_INTERVAL = args.check_interval
+
+    # 記錄訂單變為已付款的時間
+    paid_at = {}
+    update_order_status = bot.db.update_order_status
+
+    def tracked_update_order_status(order_id, status, tx_hash=None):
+        if status == 'paid':
+            paid_at[order_id] = time.time()
+        return update_order_status(order_id, status, tx_hash)
+
+    bot.db.update_order_status = tracked_update_order_status
+
+    # 區塊掃描從當前高度開始，覆蓋監控啟動前就已打包的付款
+    bot.tron_monitor.checkpoint.save('tron_monitor', {'last_checked_block': chain.head})
+
+    # 創建訂單（金額間隔 0.02，保證在 0.01 匹配容差內互不衝突）
+    currency = 'TRX' if bot.TEST_MODE else 'USDT'
+    orders = {}
+    payments = {}
+    started_at = time.time()
+
+    for i in range(args.orders):
+        order_id = f"TGLOAD{i:06d}"
+        amount = round(args.base_amount + i * 0.02, 2)
+        now = datetime.now()
+        bot.db.create_order({
+            'order_id': order_id,
+            'user_id': 100000 + i,
+            'username': f"load_user_{i}",
+            'plan_type': 'weekly',
+            'amount': amount,
+            'days': 7,
+            'status': 'pending',
+            'created_at': now.isoformat(),
+            'expires_at': (now + timedelta(hours=24)).isoformat()
+        })
+        orders[order_id] = amount
+
+        if args.mode == 'smart':
+            bot.smart_monitor.add_order_for_monitoring(order_id, amount)
+
+        if random.random() < args.pay_ratio:
+            pay_time = started_at + random.uniform(0, args.pay_window)
+            method = 'transferFrom' if random.random() < args.transfer_from_ratio else 'transfer'
+            chain.schedule_transfer(bot.config.USDT_ADDRESS, amount, currency, at=pay_time, method=method)
+            payments[order_id] = pay_time
+
+    print(f"📦 已創建 {len(orders)} 個訂單，其中 {len(payments)} 個將付款（{args.mode} 模式）")
+
+    if args.mode == 'smart':
+        await bot.start_smart_monitoring()
+        monitor_task = bot.smart_monitor.monitor_task
+    else:
+        monitor_task = asyncio.create_task(bot.tron_monitor.start_monitoring(bot.handle_payment_confirmed))
+
+    # 等待所有付款激活或超時
+    deadline = started_at + args.pay_window + args.timeout
+    while time.time() < deadline:
+        if all(order_id in paid_at for order_id in payments):
+            break
+        await asyncio.sleep(0.5)
+
+    bot.tron_monitor.stop_monitoring()
+    monitor_task.cancel()
+    await bot.tron_monitor.close()
+    server_stats = server.get_stats()
+    await server.stop()
+    if slow_server:
+        slow_stats = slow_server.get_stats()
+        await slow_server.stop()
+        server_stats['requests_total'] += slow_stats['requests_total']
+        for endpoint, count in slow_stats['requests_by_endpoint'].items():
+            server_stats['requests_by_endpoint'][f"{endpoint} (慢端點)"] = count
+
+    # 統計
+    latencies = [paid_at[o] - payments[o] for o in payments if o in paid_at]
+    missed = [o for o in payments if o not in paid_at]
+    false_positives = [o for o in paid_at if o not in payments]
+    api_calls = server_stats['requests_total']
+
+    print("\n📊 壓測結果")
+    print(f"   訂單數: {len(orders)}，付款數: {len(payments)}，已激活: {len(latencies)}")
+    print(f"   漏單: {len(missed)}，錯誤激活: {len(false_positives)}")
+    if latencies:
+        print(f"   激活耗時 p50: {percentile(latencies, 50):.2f}s  p95: {percentile(latencies, 95):.2f}s  "
+              f"p99: {percentile(latencies, 99):.2f}s  最大: {max(latencies):.2f}s  "
+              f"平均: {statistics.mean(latencies):.2f}s")
+    print(f"   API 調用: {api_calls}，每單 {api_calls / max(1, len(orders)):.2f} 次，被限流 {server_stats['throttled']} 次")
+    for endpoint, count in sorted(server_stats['requests_by_endpoint'].items()):
+        print(f"      {endpoint}: {count}")
+    print(f"   客戶端限流指標: {bot.tron_monitor.rate_limiter.get_metrics()}")
+    print(f"   端點指標: {bot.tron_monitor.endpoints.get_metrics()}")
+    if args.mode == 'smart':
+        print(f"   輪詢調度指標: {bot.smart_monitor.get_schedule_metrics()}")
+
+    return {
+        'orders': len(orders),
+        'payments': len(payments),
+        'activated': len(latencies),
+        'missed': len(missed),
+        'false_positives': len(false_positives),
+        'api_calls': api_calls
+    }
+
+def run_regression() -> bool:
+    """依次運行全部回歸場景，返回是否全部通過"""
+    failures = []
+    for name, env, scenario_args in REGRESSION_SCENARIOS:
+        print(f"\n🧪 回歸場景: {name}", flush=True)
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), *REGRESSION_ARGS, *scenario_args, '--check'],
+                                env={**os.environ, **env})
+        if result.returncode != 0:
+            failures.append(name)
+
+    print(f"\n{'❌ 回歸失敗: ' + ', '.join(failures) if failures else '✅ 回歸場景全部通過'}")
+    return not failures
+
+def main():
+    parser = argparse.ArgumentParser(description='付款流程壓測（本地 TronScan 模擬）')
+    parser.add_argument('--orders', type=int, default=1000, help='待付款訂單數')
+    parser.add_argument('--pay-ratio', type=float, default=0.9, help='實際付款的訂單比例')
+    parser.add_argument('--pay-window', type=float, default=30.0, help='付款分佈在多少秒內')
+    parser.add_argument('--timeout', type=float, default=60.0, help='付款窗口後最多等待秒數')
+    parser.add_argument('--mode', choices=['smart', 'blocks'], default='smart',
+                        help='smart: SmartMonitorManager 輪詢；blocks: TronMonitor 區塊掃描')
+    parser.add_argument('--check-interval', type=float, default=2.0, help='監控檢查間隔（秒）')
+    parser.add_argument('--block-interval', type=float, default=1.0, help='模擬出塊間隔（秒）')
+    parser.add_argument('--noise', type=int, default=0, help='每個區塊的背景交易數')
+    parser.add_argument('--base-amount', type=float, default=20.0)
+    parser.add_argument('--transfer-from-ratio', type=float, default=0.0, help='USDT 付款中使用 transferFrom 的比例')
+    parser.add_argument('--server-rate-limit', type=float, default=0, help='模擬服務每秒請求上限')
+    parser.add_argument('--latency', type=float, default=0.0, help='模擬服務每請求延遲（秒）')
+    parser.add_argument('--slow-endpoint-latency', type=float, default=0.0,
+                        help='額外啟動一個同鏈的慢端點（每請求延遲秒數）並排在端點列表首位')
+    parser.add_argument('--fixture', help='回放錄製區塊的 JSON 文件')
+    parser.add_argument('--check', action='store_true', help='有漏單或錯誤激活時以非零狀態退出')
+    parser.add_argument('--regression', action='store_true',
+                        help='運行小規模回歸場景（TRX/USDT 輪詢和區塊掃描），失敗時以非零狀態退出')
+    args = parser.parse_args()
+
+    if args.regression:
+        sys.exit(0 if run_regression() else 1)
+
+    # 在臨時目錄運行，避免寫入真實數據庫和日誌
+    workdir = tempfile.mkdtemp(prefix='payment_load_')
+    sys.path.insert(0, PROJECT_DIR)
+    os.chdir(workdir)
+    os.environ.setdefault('BOT_TOKEN', '000000:LOAD_TEST')
+    os.environ.setdefault('TRONGRID_RATE_LIMIT', '1000')
+    os.environ.setdefault('TRONGRID_RATE_BURST', '100')
+    print(f"📁 工作目錄: {workdir}")
+
+    logging.disable(logging.WARNING)
+    result = asyncio.run(run_load_test(args))
+    if args.check and (result['missed'] or result['false_positives']):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,8 @@ import os
 import json
 from datetime import datetime, timedelta
 
+from transaction_ledger import get_ledger_path, load_ledger
+
 def check_database():
     """檢查數據庫狀態"""
     print("🔍 檢查數據庫狀態...")
@@ -23,7 +25,7 @@ def check_database():
             data = json.load(f)
         
         orders = data.get('orders', {})
-        transactions = data.get('transactions', {})
+        transactions = data.get('transactions') or load_ledger(get_ledger_path(db_file))
         
         print(f"✅ 數據庫文件存在: {db_file}")
         print(f"📊 總訂單數: {len(orders)}")
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+統計聚合模塊 - 由數據庫寫入路徑增量維護的統計數據，管理面板讀取時不再掃描全部訂單和激活碼
+
+- 訂單: 按狀態計數，按創建日期分桶的訂單數和收入（保留最近 31 天）
+- 用戶: 按註冊日期分桶的新增用戶數，付費用戶和各方案買家（按已付款訂單數計數，訂單離開已付款狀態時減去），
+  已屏蔽機器人的用戶索引（群發受眾查詢）
+- 激活碼: 按方案計數、已使用數；未使用激活碼的到期時間放在最小堆中，讀取時只彈出新到期的
+- 啟動時從數據全量構建一次，之後定期全量核對，修正意外的偏差
+- 核對時分批重建（每批只短暫持有數據庫鎖），重建期間的寫入同時轉發給重建中的聚合器（只轉發已讀取過的記錄，
+  未讀取的記錄稍後按最新狀態讀取），最後在鎖內替換
+"""
+
+import heapq
+import logging
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+def _day(timestamp: Optional[str]) -> Optional[str]:
+    """ISO 時間字符串的日期部分（YYYY-MM-DD），不解析完整時間"""
+    return timestamp[:10] if timestamp else None
+
+class StatsAggregator:
+    """統計聚合器（寫入方在數據庫鎖內調用，讀取方可在任意線程調用）"""
+
+    DAYS_KEPT = 31
+    KINDS = ('users', 'orders', 'activation_codes')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.shadow: Optional['StatsAggregator'] = None  # 分批重建中的聚合器
+        self.unread: Optional[Dict[str, set]] = None     # 分批重建時尚未讀取的記錄鍵 {類型: 鍵集合}
+        self.touched: Dict[str, set] = {}                # 未讀鍵集合準備好之前有寫入的記錄鍵
+        self._reset()
+
+    def _reset(self):
+        self.order_status = Counter()
+        self.daily: Dict[str, Counter] = {}  # {日期: {'orders', 'paid_orders', 'revenue', 'new_users'}}
+        self.paid_users = Counter()          # {用戶 ID: 已付款訂單數}，只保留大於 0 的
+        self.buyers_by_plan: Dict[str, Counter] = defaultdict(Counter)  # {方案: {用戶 ID: 該方案已付款訂單數}}
+        self.blocked_users = set()           # 已屏蔽機器人或註銷的用戶，群發時跳過
+
+        self.codes: Dict[str, tuple] = {}    # {激活碼: (方案, 是否已使用)}
+        self.code_plans = Counter()
+        self.codes_used = 0
+        self.codes_expired = set()           # 未使用且已過期的激活碼
+        self.code_expiry = []                # [(到期時間戳, 激活碼)]，只包含寫入時未使用的激活碼
+
+    def rebuild(self, data: Dict):
+        """從完整數據構建（啟動和核對時調用）"""
+        with self.lock:
+            self._reset()
+            for user in data['users'].values():
+                self._add_user(user)
+            for order in data['orders'].values():
+                self._add_order_with_payment(order)
+            for code_data in data['activation_codes'].values():
+                self._save_code(code_data)
+
+    # 分批重建（begin_rebuild 和 add_records 在數據庫鎖內調用，批次之間釋放鎖）
+
+    def begin_rebuild(self) -> 'StatsAggregator':
+        """開始分批重建，返回重建中的聚合器；在 start_forwarding 之前只記錄有寫入的記錄鍵"""
+        rebuilt = StatsAggregator()
+        rebuilt.touched = {kind: set() for kind in self.KINDS}
+        self.shadow = rebuilt
+        return rebuilt
+
+    def start_forwarding(self, unread: Dict[str, set], keys: Dict[str, list]):
+        """設置未讀鍵集合（在鎖外從鍵列表構建），之後的寫入轉發給重建中的聚合器；
+        期間新創建的記錄加入未讀集合和待讀取列表（在重建中的聚合器上調用）"""
+        for kind, touched in self.touched.items():
+            for key in touched - unread[kind]:
+                unread[kind].add(key)
+                keys[kind].append(key)
+        self.unread = unread
+
+    def end_rebuild(self):
+        self.shadow = None
+
+    def add_records(self, kind: str, records: Iterable[Tuple[str, Dict]]):
+        """讀取一批記錄 [(鍵, 記錄)]，已讀取過的記錄跳過"""
+        add = {'users': self._add_user, 'orders': self._add_order_with_payment,
+               'activation_codes': self._save_code}[kind]
+        unread = self.unread[kind]
+        with self.lock:
+            for key, record in records:
+                if key in unread:
+                    unread.discard(key)
+                    add(record)
+
+    def _shadow_for(self, kind: str, key) -> Optional['StatsAggregator']:
+        """重建中的聚合器已讀取過（或重建開始後才創建）的記錄，寫入需要轉發給它"""
+        shadow = self.shadow
+        if shadow is None:
+            return None
+        if shadow.unread is None:
+            shadow.touched[kind].add(key)
+            return None
+        return shadow if key not in shadow.unread[kind] else None
+
+    def _bucket(self, day: Optional[str]) -> Counter:
+        bucket = self.daily.get(day)
+        if bucket is not None:
+            return bucket
+
+        cutoff = (datetime.now() - timedelta(days=self.DAYS_KEPT)).strftime('%Y-%m-%d')
+        if not day or day < cutoff:
+            return Counter()  # 超出保留範圍，不計入日期統計
+        bucket = self.daily[day] = Counter()
+        # 新的一天開始時淘汰過舊的日期桶
+        for old_day in [d for d in self.daily if d < cutoff]:
+            del self.daily[old_day]
+        return bucket
+
+    def _add_user(self, user: Dict):
+        self._bucket(_day(user.get('created_at')))['new_users'] += 1
+        if user.get('blocked_at'):
+            self.blocked_users.add(user.get('user_id'))
+
+    def _add_order(self, order: Dict):
+        self.order_status[order.get('status')] += 1
+        self._bucket(_day(order.get('created_at')))['orders'] += 1
+
+    def _add_order_with_payment(self, order: Dict):
+        self._add_order(order)
+        if order.get('status') == 'paid':
+            self._add_payment(order, 1)
+
+    def _add_payment(self, order: Dict, sign: int):
+        # 與原統計口徑一致：收入計入訂單創建當天
+        bucket = self._bucket(_day(order.get('created_at')))
+        bucket['paid_orders'] += sign
+        bucket['revenue'] += sign * order.get('amount', 0)
+        user_id = order.get('user_id')
+        for buyers in (self.paid_users, self.buyers_by_plan[order.get('plan_type')]):
+            buyers[user_id] += sign
+            if buyers[user_id] <= 0:
+                del buyers[user_id]
+
+    def _save_code(self, code_data: Dict):
+        code = code_data['activation_code']
+        used = bool(code_data.get('used', False))
+        previous = self.codes.get(code)
+        if previous is None:
+            self.code_plans[code_data.get('plan_type')] += 1
+            if not used:
+                try:
+                    expires_at = datetime.fromisoformat(code_data['expires_at']).timestamp()
+                    heapq.heappush(self.code_expiry, (expires_at, code))
+                except (KeyError, TypeError, ValueError):
+                    pass
+        if used and not (previous and previous[1]):
+            self.codes_used += 1
+            self.codes_expired.discard(code)
+        self.codes[code] = (code_data.get('plan_type'), used)
+
+    # 寫入路徑（在 Database.lock 內調用）
+
+    def on_user_added(self, user: Dict):
+        with self.lock:
+            self._add_user(user)
+        shadow = self._shadow_for('users', str(user.get('user_id')))
+        if shadow:
+            shadow.on_user_added(user)
+
+    def on_order_created(self, order: Dict):
+        with self.lock:
+            self._add_order_with_payment(order)
+        shadow = self._shadow_for('orders', order.get('order_id'))
+        if shadow:
+            shadow.on_order_created(order)
+
+    def on_order_status_changed(self, order: Dict, old_status: str, new_status: str):
+        if old_status == new_status:
+            return
+        with self.lock:
+            self.order_status[old_status] -= 1
+            self.order_status[new_status] += 1
+            if new_status == 'paid':
+                self._add_payment(order, 1)
+            elif old_status == 'paid':
+                self._add_payment(order, -1)
+        shadow = self._shadow_for('orders', order.get('order_id'))
+        if shadow:
+            shadow.on_order_status_changed(order, old_status, new_status)
+
+    def on_activation_code_saved(self, code_data: Dict):
+        with self.lock:
+            self._save_code(code_data)
+        shadow = self._shadow_for('activation_codes', code_data.get('activation_code'))
+        if shadow:
+            shadow.on_activation_code_saved(code_data)
+
+    def on_user_blocked(self, user_id: int, blocked: bool = True):
+        with self.lock:
+            if blocked:
+                self.blocked_users.add(user_id)
+            else:
+                self.blocked_users.discard(user_id)
+        shadow = self._shadow_for('users', str(user_id))
+        if shadow:
+            shadow.on_user_blocked(user_id, blocked)
+
+    # 讀取
+
+    def _expire_codes(self, now: float):
+        """把已到期的未使用激活碼計為過期（延遲處理，每個激活碼只彈出一次）"""
+        while self.code_expiry and self.code_expiry[0][0] <= now:
+            _, code = heapq.heappop(self.code_expiry)
+            state = self.codes.get(code)
+            if state and not state[1]:
+                self.codes_expired.add(code)
+
+    def activation_statistics(self) -> Dict:
+        """激活碼統計（與 ActivationCodeManager.get_activation_statistics 相同的字段）"""
+        with self.lock:
+            self._expire_codes(datetime.now().timestamp())
+            total = len(self.codes)
+            return {
+                'total': total,
+                'trial': self.code_plans['trial'],
+                'weekly': self.code_plans['weekly'],
+                'monthly': self.code_plans['monthly'],
+                'used': self.codes_used,
+                'expired': len(self.codes_expired),
+                'active': total - self.codes_used - len(self.codes_expired)
+            }
+
+    def snapshot(self) -> Dict:
+        """統計快照，耗時與數據量無關（最多彙總 31 個日期桶）"""
+        activations = self.activation_statistics()
+        today = datetime.now().date()
+        week_days = {(today - timedelta(days=n)).isoformat() for n in range(7)}
+        month_days = {(today - timedelta(days=n)).isoformat() for n in range(30)}
+
+        with self.lock:
+            def total(field: str, days) -> float:
+                return sum(bucket[field] for day, bucket in self.daily.items() if day in days)
+
+            today_bucket = self.daily.get(today.isoformat(), Counter())
+            return {
+                'pending_orders': self.order_status['pending'],
+                'completed_orders': self.order_status['paid'],
+                'expired_orders': self.order_status['expired'],
+                'cancelled_orders': self.order_status['cancelled'],
+                'today_orders': today_bucket['orders'],
+                'week_orders': total('orders', week_days),
+                'month_orders': total('orders', month_days),
+                'today_revenue': round(today_bucket['revenue'], 2),
+                'week_revenue': round(total('revenue', week_days), 2),
+                'month_revenue': round(total('revenue', month_days), 2),
+                'today_new_users': today_bucket['new_users'],
+                'paid_users': len(self.paid_users),
+                'total_activations': activations['total'],
+                'used_activations': activations['used'],
+                'trial_activations': activations['trial'],
+                'paid_activations': activations['weekly'] + activations['monthly'],
+                'activations': activations
+            }
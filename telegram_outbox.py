@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Telegram 發送隊列模塊 - 全局和每個聊天的令牌桶限速，按優先級通道發送
+
+- 全局: Telegram 對每個機器人約 30 條/秒
+- 每個聊天: 約 1 條/秒（允許短暫突發），同一聊天同時只有一條在途，保證消息順序
+- 收到 RetryAfter 時暫停發送並自動重試，不再由通用錯誤處理器吞掉
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, Optional
+
+from telegram.error import RetryAfter
+
+from api_rate_limiter import TokenBucket
+from bot_executor import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+# 發送優先級（數值越小越優先）
+PRIORITY_PAYMENT = 0      # 付款確認、激活碼
+PRIORITY_INTERACTIVE = 1  # 用戶操作的回覆
+PRIORITY_MARKETING = 2    # 廣播、營銷消息
+
+PRIORITY_NAMES = {
+    PRIORITY_PAYMENT: 'payment',
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_MARKETING: 'marketing'
+}
+
+class OutboundMessage:
+    """待發送的一次 Bot API 調用"""
+
+    __slots__ = ('chat_id', 'method', 'kwargs', 'priority', 'future', 'enqueued_at', 'attempts')
+
+    def __init__(self, chat_id: int, method: str, kwargs: Dict, priority: int, future: asyncio.Future):
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+class TelegramOutbox:
+    """Telegram 發送隊列"""
+
+    SCAN_DEPTH = 200        # 每個通道最多向後查找多少條可發送的消息（跳過正在限速的聊天）
+    CHAT_BUCKETS_MAX = 10_000
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1.0, chat_burst: float = 3,
+                 max_retries: int = 5, max_in_flight: int = 20):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_in_flight = max_in_flight
+
+        self.lanes = {priority: deque() for priority in PRIORITY_NAMES}
+        # 每個聊天的令牌桶，按最近使用排序，空閒（令牌已滿）的桶會被淘汰
+        self.chat_buckets: OrderedDict = OrderedDict()
+        self.busy_chats = set()
+        self.in_flight = 0
+        self._blocked_until = 0.0
+
+        self.bot = None
+        self._task: Optional[asyncio.Task] = None
+        self._wake_event: Optional[asyncio.Event] = None
+
+        self.queue_latency = LatencyStats()
+        self.stats = {
+            'sent': 0,
+            'failed': 0,
+            'retry_after': 0,
+            'sent_by_priority': {name: 0 for name in PRIORITY_NAMES.values()}
+        }
+
+    def start(self, bot):
+        """綁定 Bot 並啟動發送循環（需在事件循環中調用）"""
+        self.bot = bot
+        self._wake_event = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"📮 Telegram 發送隊列已啟動（全局 {self.global_bucket.rate:.0f}/秒，"
+                    f"每個聊天 {self.chat_rate}/秒）")
+
+    async def stop(self, drain_timeout: float = 5.0):
+        """等待隊列在限定時間內發完後停止"""
+        deadline = time.monotonic() + drain_timeout
+        while (self.queue_depth() or self.in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for lane in self.lanes.values():
+            while lane:
+                message = lane.popleft()
+                if not message.future.done():
+                    message.future.cancel()
+
+    def enqueue(self, chat_id: int, method: str = 'send_message', priority: int = PRIORITY_INTERACTIVE,
+                **kwargs) -> asyncio.Future:
+        """加入發送隊列，返回完成時帶有 API 結果的 Future（可不等待）"""
+        future = asyncio.get_running_loop().create_future()
+        # 不等待結果的調用方不會讀取異常，失敗已在發送循環中記錄
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.lanes[priority].append(OutboundMessage(chat_id, method, kwargs, priority, future))
+        self._wake()
+        return future
+
+    async def send_message(self, chat_id: int, text: str, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+        """發送消息並等待結果"""
+        return await self.enqueue(chat_id, 'send_message', priority, text=text, **kwargs)
+
+    def _wake(self):
+        if self._wake_event:
+            self._wake_event.set()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+            if len(self.chat_buckets) > self.CHAT_BUCKETS_MAX:
+                self._evict_idle_buckets()
+        self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _evict_idle_buckets(self):
+        """淘汰令牌已滿的聊天桶（與新建的桶等價，淘汰無損）"""
+        for chat_id in list(self.chat_buckets):
+            if chat_id in self.busy_chats:
+                continue
+            if self.chat_buckets[chat_id].available() < self.chat_burst:
+                continue
+            del self.chat_buckets[chat_id]
+        # 仍然超出上限時淘汰最久未使用的桶（該聊天最多多獲得一次突發額度）
+        while len(self.chat_buckets) > self.CHAT_BUCKETS_MAX:
+            self.chat_buckets.popitem(last=False)
+
+    def _take_ready(self):
+        """按優先級取出第一條可發送的消息；沒有時返回 (None, 最短等待秒數)"""
+        shortest_wait = None
+        for priority in sorted(self.lanes):
+            lane = self.lanes[priority]
+            blocked_chats = set()
+            for index, message in enumerate(lane):
+                if index >= self.SCAN_DEPTH:
+                    break
+                # 同一聊天保持順序：前面的消息未發出時，後面的也不發
+                if message.chat_id in self.busy_chats or message.chat_id in blocked_chats:
+                    continue
+                wait = self._chat_bucket(message.chat_id).try_consume()
+                if wait == 0:
+                    del lane[index]
+                    return message, None
+                blocked_chats.add(message.chat_id)
+                shortest_wait = wait if shortest_wait is None else min(shortest_wait, wait)
+        return None, shortest_wait
+
+    async def _run(self):
+        """發送循環"""
+        while True:
+            self._wake_event.clear()
+            now = time.monotonic()
+
+            wait = None
+            if now < self._blocked_until:
+                wait = self._blocked_until - now
+            elif self.in_flight >= self.max_in_flight:
+                wait = None  # 等待在途請求完成
+            elif self.global_bucket.available() < 1:
+                wait = self.global_bucket.try_consume()
+            elif self.queue_depth():
+                message, wait = self._take_ready()
+                if message:
+                    self.global_bucket.try_consume()
+                    self._dispatch(message)
+                    continue
+
+            if wait is None and not self.queue_depth():
+                await self._wake_event.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._wake_event.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self, message: OutboundMessage):
+        self.in_flight += 1
+        self.busy_chats.add(message.chat_id)
+        if message.attempts == 0:
+            self.queue_latency.record(time.monotonic() - message.enqueued_at)
+        asyncio.create_task(self._deliver(message))
+
+    async def _deliver(self, message: OutboundMessage):
+        """調用 Bot API，處理 RetryAfter"""
+        message.attempts += 1
+        try:
+            result = await getattr(self.bot, message.method)(chat_id=message.chat_id, **message.kwargs)
+            self.stats['sent'] += 1
+            self.stats['sent_by_priority'][PRIORITY_NAMES[message.priority]] += 1
+            if not message.future.done():
+                message.future.set_result(result)
+        except RetryAfter as e:
+            self.stats['retry_after'] += 1
+            delay = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else float(e.retry_after)
+            # 限流針對整個機器人，暫停所有發送
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            if message.attempts <= self.max_retries:
+                logger.warning(f"⚠️ Telegram 限流，暫停 {delay:.0f} 秒後重試（聊天 {message.chat_id}）")
+                self.lanes[message.priority].appendleft(message)
+            else:
+                self._fail(message, e)
+        except Exception as e:
+            self._fail(message, e)
+        finally:
+            self.in_flight -= 1
+            self.busy_chats.discard(message.chat_id)
+            self._wake()
+
+    def _fail(self, message: OutboundMessage, error: Exception):
+        self.stats['failed'] += 1
+        logger.error(f"❌ 發送 Telegram 消息失敗（聊天 {message.chat_id}，{message.method}）: {error}")
+        if not message.future.done():
+            message.future.set_exception(error)
+
+    def queue_depth(self) -> int:
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """隊列指標"""
+        return {
+            'queue_depth': {PRIORITY_NAMES[priority]: len(lane) for priority, lane in self.lanes.items()},
+            'queue_latency': self.queue_latency.to_dict(),
+            'in_flight': self.in_flight,
+            'tracked_chats': len(self.chat_buckets),
+            'blocked_seconds': round(max(0.0, self._blocked_until - time.monotonic()), 1),
+            **self.stats,
+            'sent_by_priority': dict(self.stats['sent_by_priority'])
+        }
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+交易賬本模塊 - 已處理交易的追加式賬本和有界去重集合
+
+- 賬本: JSON Lines 文件，只追加完整交易記錄
+- 去重: 內存中保存最近時間窗口的交易哈希；更早的哈希合併到磁盤上的有序段文件，
+  由內存布隆過濾器擋住絕大多數查詢，命中時再二分查找確認（不會把新交易誤判為已處理）
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+HASH_LINE_LENGTH = 65  # 64 位十六進制交易哈希 + 換行
+
+def get_ledger_path(db_file: str) -> str:
+    """數據庫文件對應的交易賬本路徑"""
+    base, _ = os.path.splitext(db_file)
+    return f"{base}_transactions.jsonl"
+
+def _segment_key(tx_hash: str) -> str:
+    """磁盤段中的定長鍵：64 位十六進制哈希直接使用，其他格式取 SHA-256"""
+    key = tx_hash.lower()
+    if len(key) == HASH_LINE_LENGTH - 1 and all(c in '0123456789abcdef' for c in key):
+        return key
+    return hashlib.sha256(tx_hash.encode()).hexdigest()
+
+def load_ledger(ledger_file: str) -> Dict[str, Dict]:
+    """讀取賬本中的全部交易記錄（供診斷腳本使用）"""
+    transactions = {}
+    for tx_hash, record, _ in _iter_ledger(ledger_file):
+        transactions[tx_hash] = record
+    return transactions
+
+def _iter_ledger(ledger_file: str, offset: int = 0) -> Iterator[Tuple[str, Dict, int]]:
+    """從指定偏移量讀取賬本，產出 (交易哈希, 記錄, 該行結束偏移量)"""
+    if not os.path.exists(ledger_file):
+        return
+    with open(ledger_file, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break  # 寫入中斷的行，忽略
+            offset += len(line)
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"⚠️ 交易賬本 {ledger_file} 中有無效記錄")
+                continue
+            yield entry['tx_hash'], entry['data'], offset
+
+class BloomFilter:
+    """簡單的布隆過濾器（約 1% 誤判率，誤判時由磁盤段二分查找糾正）"""
+
+    def __init__(self, capacity: int, bits_per_item: int = 10, num_hashes: int = 7):
+        self.capacity = capacity
+        self.size = max(1024, capacity * bits_per_item)
+        self.num_hashes = num_hashes
+        self.bits = bytearray(self.size // 8 + 1)
+
+    def _positions(self, key: str) -> List[int]:
+        digest = hashlib.sha256(key.encode()).digest()
+        return [int.from_bytes(digest[i * 4:i * 4 + 4], 'big') % self.size for i in range(self.num_hashes)]
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+class TransactionLedger:
+    """已處理交易賬本（追加寫入）+ 有界去重集合"""
+
+    COMPACT_BATCH = 500  # 過期哈希累積到此數量時合併到磁盤段
+
+    def __init__(self, ledger_file: str = 'bot_database_transactions.jsonl', window_hours: int = 48):
+        self.ledger_file = ledger_file
+        self.segment_file = f"{ledger_file}.seen"
+        self.meta_file = f"{ledger_file}.meta"
+        self.window_seconds = window_hours * 3600
+        self.lock = threading.Lock()
+
+        # 最近窗口 {tx_hash: (記錄時間, 賬本結束偏移量)}，按寫入順序排列
+        self.recent: OrderedDict = OrderedDict()
+        # 已合併到磁盤段的賬本偏移量
+        self.segment_offset = 0
+        self.segment_count = 0
+        self.bloom = BloomFilter(0)
+
+        self.stats = {
+            'lookups': 0,
+            'segment_lookups': 0,
+            'bloom_false_positives': 0
+        }
+
+        self._load()
+
+    def _load(self):
+        """從元數據、磁盤段和賬本尾部恢復去重狀態"""
+        if os.path.exists(self.meta_file):
+            try:
+                with open(self.meta_file, 'r', encoding='utf-8') as f:
+                    self.segment_offset = json.load(f).get('segment_offset', 0)
+            except (json.JSONDecodeError, IOError) as e:
+                logger.warning(f"⚠️ 加載交易賬本元數據失敗，將重建去重段: {e}")
+
+        self._load_segment()
+
+        # 尚未合併的賬本尾部進入最近窗口
+        for tx_hash, record, end_offset in _iter_ledger(self.ledger_file, self.segment_offset):
+            self.recent[tx_hash] = (record.get('_recorded_at', time.time()), end_offset)
+
+        self._compact_if_needed(force=True)
+
+    def _load_segment(self):
+        """加載磁盤段並重建布隆過濾器"""
+        if not os.path.exists(self.segment_file):
+            self.segment_count = 0
+            self.bloom = BloomFilter(0)
+            return
+
+        self.segment_count = os.path.getsize(self.segment_file) // HASH_LINE_LENGTH
+        self.bloom = BloomFilter(self.segment_count * 2)
+        with open(self.segment_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                self.bloom.add(line.rstrip('\n'))
+
+    def _segment_contains(self, key: str) -> bool:
+        """在有序磁盤段中二分查找"""
+        self.stats['segment_lookups'] += 1
+        low, high = 0, self.segment_count - 1
+        with open(self.segment_file, 'r', encoding='utf-8') as f:
+            while low <= high:
+                mid = (low + high) // 2
+                f.seek(mid * HASH_LINE_LENGTH)
+                value = f.read(HASH_LINE_LENGTH - 1)
+                if value == key:
+                    return True
+                if value < key:
+                    low = mid + 1
+                else:
+                    high = mid - 1
+        return False
+
+    def contains(self, tx_hash: str) -> bool:
+        """交易是否已處理"""
+        self.stats['lookups'] += 1
+        if tx_hash in self.recent:
+            return True
+        if not self.segment_count:
+            return False
+        key = _segment_key(tx_hash)
+        if key not in self.bloom:
+            return False
+        if self._segment_contains(key):
+            return True
+        self.stats['bloom_false_positives'] += 1
+        return False
+
+    def append(self, tx_hash: str, transaction_data: Dict, recorded_at: float = None):
+        """追加交易記錄（遷移舊數據時可指定記錄時間）"""
+        with self.lock:
+            if tx_hash in self.recent:
+                return
+
+            now = recorded_at or time.time()
+            record = dict(transaction_data, _recorded_at=now)
+            line = json.dumps({'tx_hash': tx_hash, 'data': record}, ensure_ascii=False) + '\n'
+            try:
+                with open(self.ledger_file, 'ab') as f:
+                    f.write(line.encode('utf-8'))
+                    end_offset = f.tell()
+            except IOError as e:
+                logger.error(f"❌ 寫入交易賬本失敗: {e}")
+                return
+
+            self.recent[tx_hash] = (now, end_offset)
+            self._compact_if_needed()
+
+    def _compact_if_needed(self, force: bool = False):
+        """把窗口外的哈希合併到有序磁盤段"""
+        cutoff = time.time() - self.window_seconds
+        expired = []
+        for tx_hash, (recorded_at, end_offset) in self.recent.items():
+            if recorded_at >= cutoff:
+                break
+            expired.append((tx_hash, end_offset))
+
+        if not expired or (len(expired) < self.COMPACT_BATCH and not force):
+            return
+
+        new_keys = sorted(_segment_key(tx_hash) for tx_hash, _ in expired)
+        self._merge_segment(new_keys)
+
+        for tx_hash, _ in expired:
+            del self.recent[tx_hash]
+        self.segment_offset = expired[-1][1]
+        self._save_meta()
+
+        # 布隆過濾器容量足夠時增量加入，否則按新大小重建
+        self.segment_count = os.path.getsize(self.segment_file) // HASH_LINE_LENGTH
+        if self.segment_count <= self.bloom.capacity:
+            for key in new_keys:
+                self.bloom.add(key)
+        else:
+            self._load_segment()
+
+        logger.info(f"🗜️ 已合併 {len(new_keys)} 個交易哈希到去重段（共 {self.segment_count} 個）")
+
+    def compact(self):
+        """立即合併所有窗口外的哈希"""
+        with self.lock:
+            self._compact_if_needed(force=True)
+
+    def _merge_segment(self, new_keys: List[str]):
+        """歸併排序寫入新的磁盤段（先寫臨時文件再替換）"""
+        temp_file = f"{self.segment_file}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as out:
+            existing = open(self.segment_file, 'r', encoding='utf-8') if os.path.exists(self.segment_file) else None
+            try:
+                old = existing.readline().rstrip('\n') if existing else ''
+                i = 0
+                last = None
+                while old or i < len(new_keys):
+                    if old and (i >= len(new_keys) or old <= new_keys[i]):
+                        value, old = old, existing.readline().rstrip('\n')
+                    else:
+                        value = new_keys[i]
+                        i += 1
+                    if value != last:
+                        out.write(value + '\n')
+                        last = value
+            finally:
+                if existing:
+                    existing.close()
+        os.replace(temp_file, self.segment_file)
+
+    def _save_meta(self):
+        """保存已合併偏移量"""
+        temp_file = f"{self.meta_file}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump({'segment_offset': self.segment_offset}, f)
+        os.replace(temp_file, self.meta_file)
+
+    def get_stats(self) -> Dict:
+        """去重集合統計"""
+        return {
+            'recent': len(self.recent),
+            'segment': self.segment_count,
+            **self.stats
+        }
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TRON API 端點池模塊 - 按延遲和錯誤率選擇端點，為慢請求計算對沖延遲
+"""
+
+import logging
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+class EndpointHealth:
+    """單個端點的健康統計"""
+
+    EWMA_ALPHA = 0.2         # 延遲/錯誤率的指數移動平均係數
+    LATENCY_SAMPLES = 100    # 計算 p95 的樣本數
+    COOLDOWN_AFTER_FAILURES = 3
+    COOLDOWN_SECONDS = 30
+
+    def __init__(self, url: str):
+        self.url = url
+        self.latency_ewma: Optional[float] = None
+        self.error_rate = 0.0
+        self.latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def record(self, latency: float, ok: bool):
+        """記錄一次請求結果"""
+        self.requests += 1
+        if ok:
+            self.latencies.append(latency)
+            self.latency_ewma = latency if self.latency_ewma is None else \
+                self.EWMA_ALPHA * latency + (1 - self.EWMA_ALPHA) * self.latency_ewma
+            self.consecutive_failures = 0
+        else:
+            self.errors += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.COOLDOWN_AFTER_FAILURES:
+                self.cooldown_until = time.monotonic() + self.COOLDOWN_SECONDS
+                logger.warning(f"⚠️ TRON 端點 {self.url} 連續失敗 {self.consecutive_failures} 次，"
+                               f"暫停使用 {self.COOLDOWN_SECONDS} 秒")
+        self.error_rate = self.EWMA_ALPHA * (0 if ok else 1) + (1 - self.EWMA_ALPHA) * self.error_rate
+
+    def in_cooldown(self) -> bool:
+        return time.monotonic() < self.cooldown_until
+
+    def score(self) -> float:
+        """越小越好：平均延遲按錯誤率加權；未測量過的端點優先試探"""
+        if self.latency_ewma is None:
+            return float('inf') if self.errors else 0.0
+        return self.latency_ewma * (1 + 5 * self.error_rate)
+
+    def p95(self) -> Optional[float]:
+        if len(self.latencies) < 20:
+            return None
+        values = sorted(self.latencies)
+        return values[int(0.95 * (len(values) - 1))]
+
+class EndpointPool:
+    """兼容 API 的端點池（TronScan / TronGrid / 自建節點）"""
+
+    def __init__(self, urls: List[str], hedge_enabled: bool = True, hedge_min_delay: float = 0.3,
+                 hedge_default_delay: float = 1.0):
+        self.endpoints = [EndpointHealth(url.rstrip('/')) for url in urls]
+        self.hedge_enabled = hedge_enabled and len(self.endpoints) > 1
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+        self.stats = {
+            'hedged_requests': 0,
+            'hedge_wins': 0
+        }
+
+    def select(self, exclude: Optional[EndpointHealth] = None) -> Optional[EndpointHealth]:
+        """選擇最健康的端點；全部暫停時選擇最早恢復的"""
+        candidates = [e for e in self.endpoints if e is not exclude]
+        if not candidates:
+            return None
+        healthy = [e for e in candidates if not e.in_cooldown()]
+        if healthy:
+            return min(healthy, key=EndpointHealth.score)
+        return min(candidates, key=lambda e: e.cooldown_until)
+
+    def hedge_delay(self, endpoint: EndpointHealth) -> Optional[float]:
+        """主請求超過此時間仍未返回時發出對沖請求；不對沖時返回 None"""
+        if not self.hedge_enabled:
+            return None
+        p95 = endpoint.p95()
+        return max(self.hedge_min_delay, p95 if p95 is not None else self.hedge_default_delay)
+
+    def record_hedge(self, hedge_won: bool):
+        self.stats['hedged_requests'] += 1
+        if hedge_won:
+            self.stats['hedge_wins'] += 1
+
+    def get_metrics(self) -> Dict:
+        """端點池指標"""
+        return {
+            'endpoints': [
+                {
+                    'url': e.url,
+                    'latency_ms': round(e.latency_ewma * 1000, 1) if e.latency_ewma is not None else None,
+                    'p95_ms': round(e.p95() * 1000, 1) if e.p95() is not None else None,
+                    'error_rate': round(e.error_rate, 3),
+                    'requests': e.requests,
+                    'errors': e.errors,
+                    'cooldown': e.in_cooldown()
+                }
+                for e in self.endpoints
+            ],
+            **self.stats
+        }
+
+_shared_pool: Optional[EndpointPool] = None
+
+def get_shared_pool() -> EndpointPool:
+    """獲取進程內共享的端點池（所有監控器共用端點健康統計）"""
+    global _shared_pool
+    if _shared_pool is None:
+        config = Config()
+        _shared_pool = EndpointPool(
+            config.TRON_API_URLS,
+            hedge_enabled=config.TRON_HEDGE_ENABLED,
+            hedge_min_delay=config.TRON_HEDGE_MIN_DELAY
+        )
+        logger.info(f"🌐 TRON API 端點: {', '.join(config.TRON_API_URLS)}"
+                    f"（對沖請求: {'開啟' if _shared_pool.hedge_enabled else '關閉'}）")
+    return _shared_pool
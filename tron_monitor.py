@@ -5,188 +5,513 @@ TRON 交易監控模塊
 """
 
 import asyncio
+import hashlib
 import logging
 import os
 import time
 from datetime import datetime
-from typing import Callable, Dict, List, Optional
+from functools import lru_cache
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
 
 import aiohttp
+from api_rate_limiter import (PRIORITY_CONFIRMATION, PRIORITY_SCAN, PRIORITY_VERIFY,
+                              get_shared_limiter)
 from config import Config
-from database import Database
+from confirmation_tracker import ConfirmationTracker
+from database import Database, amount_to_units
+from monitor_checkpoint import MonitorCheckpoint
+from tron_endpoints import EndpointHealth, get_shared_pool
 
 logger = logging.getLogger(__name__)
 
+BASE58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+def normalize_hex_address(hex_address: str) -> str:
+    """將十六進制地址統一為 21 字節小寫形式（41 前綴）"""
+    if hex_address.startswith('0x'):
+        hex_address = hex_address[2:]
+    hex_address = hex_address.lower()
+    if len(hex_address) == 40:
+        hex_address = '41' + hex_address
+    return hex_address
+
+def base58_to_hex(address: str) -> str:
+    """將 Base58 TRON 地址解碼為 21 字節十六進制地址（含校驗）"""
+    num = 0
+    for char in address:
+        index = BASE58_ALPHABET.find(char)
+        if index < 0:
+            raise ValueError(f"無效的 Base58 字符: {char}")
+        num = num * 58 + index
+    
+    if num >= 1 << 200:
+        raise ValueError(f"TRON 地址長度錯誤: {address}")
+    full_address = num.to_bytes(25, 'big')
+    addr_bytes, checksum = full_address[:21], full_address[21:]
+    
+    if hashlib.sha256(hashlib.sha256(addr_bytes).digest()).digest()[:4] != checksum:
+        raise ValueError(f"TRON 地址校驗和錯誤: {address}")
+    if addr_bytes[0] != 0x41:
+        raise ValueError(f"不是 TRON 主網地址: {address}")
+    
+    return addr_bytes.hex()
+
+@lru_cache(maxsize=1024)
+def hex_to_base58check(hex_address: str) -> str:
+    """將 21 字節十六進制地址編碼為 Base58 TRON 地址（帶緩存）"""
+    addr_bytes = bytes.fromhex(hex_address)
+    checksum = hashlib.sha256(hashlib.sha256(addr_bytes).digest()).digest()[:4]
+    full_address = addr_bytes + checksum
+    
+    num = int.from_bytes(full_address, 'big')
+    encoded = ""
+    while num > 0:
+        num, remainder = divmod(num, 58)
+        encoded = BASE58_ALPHABET[remainder] + encoded
+    
+    # 處理前導零字節
+    for byte in full_address:
+        if byte == 0:
+            encoded = '1' + encoded
+        else:
+            break
+    
+    return encoded
+
+# TRC-20 Transfer(address,address,uint256) 事件主題
+TRANSFER_TOPIC = 'ddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+
+class BlockScanError(Exception):
+    """區塊獲取或解碼失敗，掃描進度停在該區塊之前，下一輪重試"""
+
+class Trc20Transfer(NamedTuple):
+    """從事件日誌解碼的 TRC-20 轉賬"""
+    tx_id: str
+    log_index: int
+    from_address: str  # 21 字節十六進制
+    to_address: str    # 21 字節十六進制
+    amount: int        # 最小單位
+    success: bool
+
+def decode_trc20_transfers(tx_infos: List[Dict], contract_hex: str) -> Iterator[Trc20Transfer]:
+    """批量解碼交易詳情中的 Transfer 事件（覆蓋 transfer、transferFrom 和代理/批量調用）"""
+    for info in tx_infos:
+        tx_id = info.get('id')
+        logs = info.get('log') or []
+        if not tx_id or not logs:
+            continue
+        
+        success = info.get('receipt', {}).get('result', 'SUCCESS') == 'SUCCESS' and info.get('result') != 'FAILED'
+        
+        for index, log in enumerate(logs):
+            topics = log.get('topics') or []
+            if len(topics) < 3 or topics[0].lower() != TRANSFER_TOPIC:
+                continue
+            if normalize_hex_address(log.get('address', '')) != contract_hex:
+                continue
+            try:
+                amount = int(log.get('data') or '0', 16)
+            except ValueError:
+                continue
+            
+            yield Trc20Transfer(
+                tx_id=tx_id,
+                log_index=index,
+                from_address='41' + topics[1][-40:].lower(),
+                to_address='41' + topics[2][-40:].lower(),
+                amount=amount,
+                success=success
+            )
+
 class TronMonitor:
     """TRON 區塊鏈交易監控器"""
     
-    def __init__(self):
+    CONFIRMATION_BATCH_SIZE = 20  # 每批並發獲取的交易詳情數
+    MAX_BLOCKS_PER_CHECK = 100    # 每輪最多掃描的區塊數（補掃時分多輪完成）
+    CHECKPOINT_EVERY_BLOCKS = 20  # 每掃描多少個區塊保存一次檢查點
+    MAX_PAYMENT_PAGES = 40        # 查詢最近付款時最多翻頁數（每頁 limit 條）
+    
+    def __init__(self, db: Database = None):
         self.config = Config()
-        self.db = Database()
+        # 與機器人共用同一個數據庫實例；單獨使用時自行創建
+        self.db = db or Database(self.config.DATABASE_FILE)
         self.is_monitoring = False
         self.last_checked_block = 0
+        self.rate_limiter = get_shared_limiter()
+        self.endpoints = get_shared_pool()
+        self._session = None
+        self.payment_callback = None
+        
+        # 候選轉賬確認隊列（跨重啟持久化）
+        self.confirmations = ConfirmationTracker(
+            state_file=self.config.CONFIRMATION_STATE_FILE,
+            required_confirmations=self.config.CONFIRMATION_BLOCKS
+        )
+        
+        # 區塊掃描進度檢查點
+        self.checkpoint = MonitorCheckpoint(self.config.MONITOR_CHECKPOINT_FILE)
         # 檢查是否為測試模式
         self.test_mode = os.getenv('TEST_MODE', 'false').lower() == 'true'
         
+        # 監控地址在啟動時解碼一次，掃描時直接比較十六進制
+        self.watch_address_hex = base58_to_hex(self.config.USDT_ADDRESS)
+        self.usdt_contract_hex = base58_to_hex(self.config.USDT_CONTRACT)
+        
     async def start_monitoring(self, payment_callback: Callable):
         """開始監控交易"""
         self.is_monitoring = True
         self.payment_callback = payment_callback
         
-        # 獲取當前區塊高度
-        self.last_checked_block = await self.get_latest_block_number()
+        # 獲取當前區塊高度，並從檢查點恢復掃描進度
+        current_block = await self.get_latest_block_number()
         currency = "TRX" if self.test_mode else "USDT"
         
-        if self.last_checked_block == 0:
+        if current_block == 0:
             logger.error(f"❌ 無法連接到 TronGrid API，監控啟動失敗")
             logger.error(f"   請檢查 TRONGRID_API_KEY 環境變量是否正確設置")
-            logger.error(f"   API URL: {self.config.TRONGRID_API_URL}")
+            logger.error(f"   API 端點: {', '.join(self.config.TRON_API_URLS)}")
             self.is_monitoring = False
             return
         
+        self.last_checked_block = self._resume_block(current_block)
+        
         logger.info(f"🔍 開始監控 {currency} 交易，從區塊 {self.last_checked_block} 開始")
         logger.info(f"🔑 API 密鑰: {'已設置' if self.config.TRONGRID_API_KEY else '未設置（使用公共API）'}")
         logger.info(f"📧 監控地址: {self.config.USDT_ADDRESS}")
         logger.info(f"🧪 測試模式: {'開啟' if self.test_mode else '關閉'}")
         
+        consecutive_errors = 0
         while self.is_monitoring:
             try:
-                await self.check_new_transactions()
-                await asyncio.sleep(self.config.MONITORING_INTERVAL)
+                caught_up = await self.check_new_transactions()
+                consecutive_errors = 0
+                # 補掃未完成時立即進入下一輪
+                if caught_up:
+                    await asyncio.sleep(self.config.MONITORING_INTERVAL)
             except Exception as e:
                 logger.error(f"❌ 監控交易時發生錯誤: {e}")
-                await asyncio.sleep(60)  # 錯誤時等待更長時間
+                # 連續錯誤時指數退避
+                await asyncio.sleep(self.rate_limiter.backoff_delay(consecutive_errors))
+                consecutive_errors += 1
+    
+    def _resume_block(self, current_block: int) -> int:
+        """根據檢查點決定起始區塊，停機期間的區塊有上限地補掃"""
+        saved_block = self.checkpoint.get('tron_monitor', {}).get('last_checked_block')
+        if not saved_block or saved_block >= current_block:
+            return current_block
+        
+        gap = current_block - saved_block
+        if gap > self.config.CATCHUP_MAX_BLOCKS:
+            logger.warning(f"⚠️ 停機期間產生 {gap} 個區塊，超過補掃上限，"
+                           f"只補掃最近 {self.config.CATCHUP_MAX_BLOCKS} 個")
+            return current_block - self.config.CATCHUP_MAX_BLOCKS
+        
+        logger.info(f"⏪ 從檢查點恢復，補掃區塊 {saved_block + 1} - {current_block}（{gap} 個）")
+        return saved_block
+    
+    def _save_checkpoint(self):
+        """保存區塊掃描進度"""
+        self.checkpoint.save('tron_monitor', {'last_checked_block': self.last_checked_block})
     
     def stop_monitoring(self):
         """停止監控"""
         self.is_monitoring = False
         logger.info("⏹️ 停止 TRON 交易監控")
     
-    async def get_latest_block_number(self) -> int:
-        """獲取最新區塊號"""
+    async def close(self):
+        """關閉 HTTP 會話"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        """獲取復用的 HTTP 會話"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15))
+        return self._session
+    
+    async def _request(self, method: str, path: str, priority: int = PRIORITY_SCAN,
+                       params: Dict = None, json: Dict = None):
+        """經過共享速率限制器發送 API 請求，返回 (狀態碼, 數據)"""
+        max_retries = self.config.TRONGRID_MAX_RETRIES
+        status = 0
+        
+        for attempt in range(max_retries + 1):
+            await self.rate_limiter.acquire(priority)
+            
+            # 選擇最健康的端點，慢於其 p95 時向備用端點對沖
+            endpoint = self.endpoints.select()
+            status, data, retry_after, error = await self._hedged_send(
+                endpoint, method, path, priority, params, json)
+            
+            if status == 200:
+                return status, data
+            
+            if status and status != 429 and status < 500:
+                return status, None
+            
+            if error:
+                logger.warning(f"⚠️ TRON API 連接錯誤 {path}: {error}")
+                delay = self.rate_limiter.backoff_delay(attempt)
+            else:
+                delay = self.rate_limiter.record_response(status, retry_after, attempt)
+            
+            if attempt < max_retries:
+                self.rate_limiter.record_retry()
+                await asyncio.sleep(delay)
+        
+        return status, None
+    
+    async def _send(self, endpoint: EndpointHealth, method: str, path: str,
+                    params: Dict = None, json: Dict = None):
+        """向指定端點發送一次請求並記錄延遲，返回 (狀態碼, 數據, Retry-After)"""
+        started_at = time.monotonic()
         try:
-            async with aiohttp.ClientSession() as session:
-                url = f"{self.config.TRONGRID_API_URL}/api/block"
-                headers = self.config.get_trongrid_headers()
+            session = self._get_session()
+            async with session.request(method, f"{endpoint.url}{path}", headers=self.config.get_trongrid_headers(),
+                                       params=params, json=json) as response:
+                status = response.status
+                data = await response.json(content_type=None) if status == 200 else None
                 
-                logger.debug(f"🌐 請求 TronGrid API: {url}")
+                retry_after = response.headers.get('Retry-After')
+                retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
                 
-                async with session.get(url, headers=headers) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        # TronScan API 可能返回數組，取第一個或最新的區塊
-                        if isinstance(data, list) and len(data) > 0:
-                            block_number = data[0].get('number', 0)
-                        elif isinstance(data, dict):
-                            block_number = data.get('number', 0)
-                        else:
-                            block_number = 0
-                            
-                        if block_number > 0:
-                            logger.debug(f"✅ 成功獲取區塊號: {block_number}")
-                        else:
-                            logger.warning(f"⚠️ 無法從 API 響應中獲取區塊號: {data}")
-                        return block_number
-                    elif response.status == 429:
-                        logger.error(f"❌ TronGrid API 請求頻率限制: HTTP {response.status}")
-                        logger.error(f"   提示: 考慮設置 TRONGRID_API_KEY 提高限制")
-                        return 0
-                    elif response.status == 403:
-                        logger.error(f"❌ TronGrid API 訪問被拒絕: HTTP {response.status}")
-                        logger.error(f"   提示: 檢查 TRONGRID_API_KEY 是否正確")
-                        return 0
-                    else:
-                        logger.error(f"❌ 獲取最新區塊失敗: HTTP {response.status}")
-                        try:
-                            error_text = await response.text()
-                            logger.error(f"   錯誤詳情: {error_text[:200]}")
-                        except:
-                            pass
-                        return 0
-        except aiohttp.ClientError as e:
-            logger.error(f"❌ TronGrid API 連接錯誤: {e}")
-            return 0
+                endpoint.record(time.monotonic() - started_at, ok=status != 429 and status < 500)
+                return status, data, retry_after
+        except asyncio.CancelledError:
+            # 對沖落敗被取消，耗時作為延遲下限計入統計
+            endpoint.record(time.monotonic() - started_at, ok=True)
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            endpoint.record(time.monotonic() - started_at, ok=False)
+            raise
+    
+    @staticmethod
+    def _outcome(task: asyncio.Task):
+        """取出請求結果，返回 (狀態碼, 數據, Retry-After, 連接錯誤)"""
+        try:
+            status, data, retry_after = task.result()
+            return status, data, retry_after, None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return 0, None, None, e
+    
+    @staticmethod
+    def _is_final(outcome) -> bool:
+        """成功或不可重試的結果"""
+        status = outcome[0]
+        return bool(status) and status != 429 and status < 500
+    
+    async def _hedged_send(self, endpoint: EndpointHealth, method: str, path: str, priority: int,
+                           params: Dict = None, json: Dict = None):
+        """發送請求；超過對沖延遲仍未返回時向另一端點發出重複請求，取先成功者"""
+        primary = asyncio.ensure_future(self._send(endpoint, method, path, params, json))
+        
+        hedge_delay = self.endpoints.hedge_delay(endpoint)
+        if hedge_delay is not None:
+            await asyncio.wait({primary}, timeout=hedge_delay)
+        if hedge_delay is None or primary.done():
+            await asyncio.wait({primary})
+            return self._outcome(primary)
+        
+        backup = self.endpoints.select(exclude=endpoint)
+        await self.rate_limiter.acquire(priority)
+        hedge = asyncio.ensure_future(self._send(backup, method, path, params, json))
+        
+        pending = {primary, hedge}
+        outcome = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    outcome = self._outcome(task)
+                    if self._is_final(outcome):
+                        self.endpoints.record_hedge(hedge_won=task is hedge)
+                        return outcome
+        finally:
+            for task in pending:
+                task.cancel()
+        
+        self.endpoints.record_hedge(hedge_won=False)
+        return outcome
+    
+    async def get_latest_block_number(self, priority: int = PRIORITY_SCAN) -> int:
+        """獲取最新區塊號"""
+        try:
+            status, data = await self._request('GET', '/api/block', priority)
+            
+            if status == 200:
+                # TronScan API 可能返回數組，取第一個或最新的區塊
+                if isinstance(data, list) and len(data) > 0:
+                    block_number = data[0].get('number', 0)
+                elif isinstance(data, dict):
+                    block_number = data.get('number', 0)
+                else:
+                    block_number = 0
+                    
+                if block_number > 0:
+                    logger.debug(f"✅ 成功獲取區塊號: {block_number}")
+                else:
+                    logger.warning(f"⚠️ 無法從 API 響應中獲取區塊號: {data}")
+                return block_number
+            elif status == 429:
+                logger.error(f"❌ TronGrid API 請求頻率限制: HTTP {status}")
+                logger.error(f"   提示: 考慮設置 TRONGRID_API_KEY 提高限制")
+                return 0
+            elif status == 403:
+                logger.error(f"❌ TronGrid API 訪問被拒絕: HTTP {status}")
+                logger.error(f"   提示: 檢查 TRONGRID_API_KEY 是否正確")
+                return 0
+            else:
+                logger.error(f"❌ 獲取最新區塊失敗: HTTP {status}")
+                return 0
         except Exception as e:
             logger.error(f"❌ 獲取最新區塊時發生未知錯誤: {e}")
             return 0
     
-    async def check_new_transactions(self):
-        """檢查新交易"""
+    async def check_new_transactions(self) -> bool:
+        """檢查新交易，返回是否已追上最新區塊"""
         try:
             current_block = await self.get_latest_block_number()
             if current_block <= self.last_checked_block:
-                return
+                return True
+            
+            # 檢查新區塊中的交易（補掃時每輪有上限）
+            end_block = min(current_block, self.last_checked_block + self.MAX_BLOCKS_PER_CHECK)
+            failed_block = None
+            for block_num in range(self.last_checked_block + 1, end_block + 1):
+                if not await self.check_block_transactions(block_num):
+                    # 不跳過失敗的區塊，否則其中的付款永遠不會被發現
+                    failed_block = block_num
+                    break
+                self.last_checked_block = block_num
+                if block_num % self.CHECKPOINT_EVERY_BLOCKS == 0:
+                    self._save_checkpoint()
+            
+            self._save_checkpoint()
             
-            # 檢查新區塊中的交易
-            for block_num in range(self.last_checked_block + 1, current_block + 1):
-                await self.check_block_transactions(block_num)
+            # 區塊高度前進後，批量確認已達深度的候選轉賬
+            await self.process_confirmations(current_block)
             
-            self.last_checked_block = current_block
+            if failed_block is not None:
+                raise BlockScanError(f"區塊 {failed_block} 掃描失敗，下一輪從該區塊重試")
             
+            return self.last_checked_block >= current_block
+            
+        except BlockScanError:
+            raise
         except Exception as e:
             logger.error(f"❌ 檢查新交易時發生錯誤: {e}")
+            return True
     
-    async def check_block_transactions(self, block_number: int):
-        """檢查指定區塊的交易"""
+    async def check_block_transactions(self, block_number: int) -> bool:
+        """檢查指定區塊的交易，返回區塊是否已完整處理（獲取失敗時返回 False，由調用方重試）"""
+        if not self.test_mode:
+            # 生產模式：一次請求獲取整個區塊的事件日誌
+            return await self.check_block_trc20_events(block_number)
+        
         try:
             # 獲取區塊信息
             block_data = await self.get_block_by_number(block_number)
             if not block_data:
-                return
+                return False
             
             transactions = block_data.get('transactions', [])
             
             for tx in transactions:
-                await self.process_transaction(tx)
+                await self.process_transaction(tx, block_number)
+            return True
                 
         except Exception as e:
             logger.error(f"❌ 檢查區塊 {block_number} 交易時發生錯誤: {e}")
+            return False
+    
+    async def check_block_trc20_events(self, block_number: int) -> bool:
+        """從區塊事件日誌解碼 USDT 轉賬，成功與否已知，無需逐筆獲取詳情；返回區塊是否已完整處理"""
+        try:
+            tx_infos = await self.get_transaction_info_by_block(block_number)
+            if tx_infos is None:
+                return False
+            
+            for transfer in decode_trc20_transfers(tx_infos, self.usdt_contract_hex):
+                if transfer.to_address != self.watch_address_hex:
+                    continue
+                
+                # 同一交易內多筆轉給我們的轉賬用日誌序號區分
+                tx_key = transfer.tx_id if transfer.log_index == 0 else f"{transfer.tx_id}:{transfer.log_index}"
+                if self.confirmations.has(tx_key) or self.db.transaction_exists(tx_key):
+                    continue
+                
+                if not transfer.success:
+                    logger.warning(f"⚠️ USDT 交易 {transfer.tx_id} 執行失敗，忽略")
+                    continue
+                
+                self.confirmations.add_candidate(tx_key, {
+                    'from_address': hex_to_base58check(transfer.from_address),
+                    'to_address': self.config.USDT_ADDRESS,
+                    'amount': transfer.amount / 1_000_000,  # USDT 有 6 位小數
+                    'currency': 'USDT',
+                    'receipt': 'SUCCESS'
+                }, block_number)
+            return True
+                
+        except Exception as e:
+            logger.error(f"❌ 解碼區塊 {block_number} 事件日誌時發生錯誤: {e}")
+            return False
+    
+    async def get_transaction_info_by_block(self, block_number: int) -> Optional[List[Dict]]:
+        """獲取區塊內所有交易詳情（含事件日誌）"""
+        try:
+            status, data = await self._request('POST', '/wallet/gettransactioninfobyblocknum', PRIORITY_SCAN,
+                                               json={"num": block_number})
+            if status == 200:
+                # 空區塊可能返回空對象
+                return data if isinstance(data, list) else []
+            else:
+                logger.warning(f"⚠️ 獲取區塊 {block_number} 交易詳情失敗: HTTP {status}")
+                return None
+        except Exception as e:
+            logger.error(f"❌ 獲取區塊 {block_number} 交易詳情時發生錯誤: {e}")
+            return None
     
     async def get_block_by_number(self, block_number: int) -> Optional[Dict]:
         """根據區塊號獲取區塊信息"""
         try:
-            async with aiohttp.ClientSession() as session:
-                url = f"{self.config.TRONGRID_API_URL}/wallet/getblockbynum"
-                headers = self.config.get_trongrid_headers()
-                data = {"num": block_number}
-                
-                async with session.post(url, json=data, headers=headers) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        logger.warning(f"⚠️ 獲取區塊 {block_number} 失敗: HTTP {response.status}")
-                        return None
+            status, data = await self._request('POST', '/wallet/getblockbynum', PRIORITY_SCAN,
+                                               json={"num": block_number})
+            if status == 200:
+                return data
+            else:
+                logger.warning(f"⚠️ 獲取區塊 {block_number} 失敗: HTTP {status}")
+                return None
         except Exception as e:
             logger.error(f"❌ 獲取區塊 {block_number} 時發生錯誤: {e}")
             return None
     
-    async def process_transaction(self, transaction: Dict):
+    async def process_transaction(self, transaction: Dict, block_number: int = 0):
         """處理單個交易"""
         try:
             tx_id = transaction.get('txID')
             if not tx_id:
                 return
             
-            # 檢查是否已處理過此交易
-            if self.db.transaction_exists(tx_id):
+            # 檢查是否已處理過或已在確認隊列中
+            if self.confirmations.has(tx_id) or self.db.transaction_exists(tx_id):
                 return
             
             # 檢查交易類型
             raw_data = transaction.get('raw_data', {})
             contracts = raw_data.get('contract', [])
             
+            # 測試模式：監控原生 TRX 轉賬（USDT 轉賬由區塊事件日誌處理）
             for contract in contracts:
-                if self.test_mode and contract.get('type') == 'TransferContract':
-                    # 測試模式：監控原生 TRX 轉賬
-                    await self.process_trx_transaction(tx_id, contract, transaction)
-                elif not self.test_mode and contract.get('type') == 'TriggerSmartContract':
-                    # 生產模式：監控 TRC-20 (USDT) 轉賬
-                    await self.process_trc20_transaction(tx_id, contract, transaction)
+                if contract.get('type') == 'TransferContract':
+                    await self.process_trx_transaction(tx_id, contract, transaction, block_number)
             
         except Exception as e:
             logger.error(f"❌ 處理交易時發生錯誤: {e}")
     
-    async def process_trx_transaction(self, tx_id: str, contract: Dict, full_transaction: Dict):
+    async def process_trx_transaction(self, tx_id: str, contract: Dict, full_transaction: Dict,
+                                      block_number: int = 0):
         """處理原生 TRX 轉賬交易（測試模式）"""
         try:
             parameter = contract.get('parameter', {})
@@ -199,163 +524,119 @@ class TronMonitor:
             if not to_address:
                 return
             
-            # 轉換地址格式（從 hex 到 base58）
-            to_address_base58 = await self.hex_to_base58(to_address)
-            
-            # 檢查是否轉給我們的地址
-            if to_address_base58 != self.config.USDT_ADDRESS:
-                return
-            
-            # 轉換金額（從 sun 到 TRX）
-            amount_trx = amount_sun / 1_000_000
-            
-            # 獲取交易詳情和確認狀態
-            tx_info = await self.get_transaction_info(tx_id)
-            if not tx_info:
-                return
-            
-            # 檢查交易是否成功
-            if tx_info.get('receipt', {}).get('result') != 'SUCCESS':
-                logger.warning(f"⚠️ TRX 交易 {tx_id} 執行失敗")
-                return
-            
-            # 檢查確認數
-            current_block = await self.get_latest_block_number()
-            tx_block = tx_info.get('blockNumber', 0)
-            confirmations = current_block - tx_block
-            
-            if confirmations < self.config.CONFIRMATION_BLOCKS:
-                logger.info(f"⏳ TRX 交易 {tx_id} 確認數不足: {confirmations}/{self.config.CONFIRMATION_BLOCKS}")
+            # 檢查是否轉給我們的地址（直接比較十六進制）
+            if normalize_hex_address(to_address) != self.watch_address_hex:
                 return
             
             # 獲取發送方地址
             from_address = value.get('owner_address')
-            from_address_base58 = await self.hex_to_base58(from_address) if from_address else ""
-            
-            # 記錄交易
-            transaction_data = {
-                'tx_hash': tx_id,
-                'from_address': from_address_base58,
-                'to_address': to_address_base58,
-                'amount': amount_trx,
-                'currency': 'TRX',
-                'block_number': tx_block,
-                'confirmations': confirmations,
-                'timestamp': datetime.now().isoformat(),
-                'processed': True
-            }
-            
-            self.db.save_transaction(tx_id, transaction_data)
             
-            logger.info(f"✅ 檢測到 TRX 轉賬: {amount_trx} TRX 到 {to_address_base58}")
-            logger.info(f"📋 交易哈希: {tx_id}")
-            
-            # 調用付款回調
-            if self.payment_callback:
-                await self.payment_callback(transaction_data)
+            # 加入確認隊列，達到確認深度後再獲取交易詳情
+            self.confirmations.add_candidate(tx_id, {
+                'from_address': await self.hex_to_base58(from_address) if from_address else "",
+                'to_address': self.config.USDT_ADDRESS,
+                'amount': amount_sun / 1_000_000,  # 轉換金額（從 sun 到 TRX）
+                'currency': 'TRX'
+            }, block_number)
             
         except Exception as e:
             logger.error(f"❌ 處理 TRX 交易時發生錯誤: {e}")
     
-    async def process_trc20_transaction(self, tx_id: str, contract: Dict, full_transaction: Dict):
-        """處理 TRC-20 轉賬交易"""
-        try:
-            parameter = contract.get('parameter', {})
-            value = parameter.get('value', {})
-            
-            # 檢查合約地址
-            contract_address = value.get('contract_address')
-            if not contract_address:
-                return
-            
-            # 轉換地址格式
-            contract_address_base58 = await self.hex_to_base58(contract_address)
-            if contract_address_base58 != self.config.USDT_CONTRACT:
-                return
-            
-            # 解析轉賬數據
-            data = value.get('data', '')
-            if not data or len(data) < 136:  # transfer方法調用的最小長度
-                return
-            
-            # 檢查是否是 transfer 方法 (方法ID: a9059cbb)
-            method_id = data[:8]
-            if method_id != 'a9059cbb':
-                return
-            
-            # 解析接收地址和金額
-            to_address_hex = data[32:72]  # 跳過方法ID和填充
-            amount_hex = data[72:136]
-            
-            # 轉換地址
-            to_address = await self.hex_to_base58('41' + to_address_hex)
-            
-            # 檢查是否轉給我們的地址
-            if to_address != self.config.USDT_ADDRESS:
-                return
-            
-            # 轉換金額 (USDT 有 6 位小數)
-            amount_wei = int(amount_hex, 16)
-            amount_usdt = amount_wei / 1_000_000
-            
-            # 獲取交易詳情和確認狀態
-            tx_info = await self.get_transaction_info(tx_id)
-            if not tx_info:
-                return
-            
-            # 檢查交易是否成功
-            if tx_info.get('receipt', {}).get('result') != 'SUCCESS':
-                logger.warning(f"⚠️ 交易 {tx_id} 執行失敗")
-                return
-            
-            # 檢查確認數
-            current_block = await self.get_latest_block_number()
-            tx_block = tx_info.get('blockNumber', 0)
-            confirmations = current_block - tx_block
+    async def process_confirmations(self, current_block: int):
+        """批量確認已達深度的候選轉賬，結果未知的交易只獲取一次詳情"""
+        due = self.confirmations.due_candidates(current_block)
+        if not due:
+            return
+        
+        self.confirmations.mark_confirming(due)
+        
+        # 事件日誌已給出執行結果的轉賬，達到深度即可確認
+        unresolved = []
+        for tx_id in due:
+            candidate = self.confirmations.get(tx_id)
+            if candidate['transfer'].get('receipt'):
+                await self._finish_confirmation(tx_id, {
+                    'blockNumber': candidate['block_number'],
+                    'receipt': {'result': candidate['transfer']['receipt']}
+                }, current_block)
+            else:
+                unresolved.append(tx_id)
+        
+        for i in range(0, len(unresolved), self.CONFIRMATION_BATCH_SIZE):
+            batch = unresolved[i:i + self.CONFIRMATION_BATCH_SIZE]
+            infos = await asyncio.gather(*[self.get_transaction_info(tx_id) for tx_id in batch])
             
-            if confirmations < self.config.CONFIRMATION_BLOCKS:
-                logger.info(f"⏳ 交易 {tx_id} 確認數不足: {confirmations}/{self.config.CONFIRMATION_BLOCKS}")
+            for tx_id, tx_info in zip(batch, infos):
+                await self._finish_confirmation(tx_id, tx_info, current_block)
+        
+        self.confirmations.prune()
+    
+    async def _finish_confirmation(self, tx_id: str, tx_info: Optional[Dict], current_block: int):
+        """根據交易詳情完成確認"""
+        candidate = self.confirmations.get(tx_id)
+        transfer = candidate['transfer']
+        currency = transfer['currency']
+        
+        # 節點尚未返回詳情，下一個區塊再查
+        if not tx_info or not tx_info.get('blockNumber'):
+            self.confirmations.retry_later(tx_id)
+            return
+        
+        # 檢查交易是否成功
+        if tx_info.get('receipt', {}).get('result') != 'SUCCESS':
+            self.confirmations.mark_failed(tx_id, f"{currency} 交易執行失敗")
+            return
+        
+        # 檢查確認數
+        tx_block = tx_info['blockNumber']
+        confirmations = current_block - tx_block
+        
+        if confirmations < self.config.CONFIRMATION_BLOCKS:
+            logger.info(f"⏳ {currency} 交易 {tx_id} 確認數不足: {confirmations}/{self.config.CONFIRMATION_BLOCKS}")
+            self.confirmations.retry_later(tx_id)
+            return
+        
+        # 記錄交易
+        transaction_data = {
+            'tx_hash': tx_id,
+            'from_address': transfer['from_address'],
+            'to_address': transfer['to_address'],
+            'amount': transfer['amount'],
+            'currency': currency,
+            'block_number': tx_block,
+            'confirmations': confirmations,
+            'timestamp': datetime.now().isoformat(),
+            'processed': True
+        }
+        
+        logger.info(f"✅ 檢測到 {currency} 轉賬: {transfer['amount']} {currency} 到 {transfer['to_address']}")
+        logger.info(f"📋 交易哈希: {tx_id}")
+        
+        # 調用付款回調，成功後才記錄交易並標記為已確認；
+        # 回調失敗或進程在此之前退出時候選保持確認中狀態，下一輪（或重啟後）重新投遞
+        if self.payment_callback:
+            try:
+                delivered = await self.payment_callback(transaction_data)
+            except Exception as e:
+                logger.error(f"❌ 付款回調出錯: {e}")
+                delivered = False
+            if delivered is False:
+                self.confirmations.mark_delivery_failed(tx_id, "付款回調失敗")
                 return
-            
-            # 記錄交易
-            transaction_data = {
-                'tx_hash': tx_id,
-                'from_address': await self.hex_to_base58('41' + data[32:72]),  # 發送方地址
-                'to_address': to_address,
-                'amount': amount_usdt,
-                'currency': 'USDT',
-                'block_number': tx_block,
-                'confirmations': confirmations,
-                'timestamp': datetime.now().isoformat(),
-                'processed': True
-            }
-            
-            self.db.save_transaction(tx_id, transaction_data)
-            
-            logger.info(f"✅ 檢測到 USDT 轉賬: {amount_usdt} USDT 到 {to_address}")
-            logger.info(f"📋 交易哈希: {tx_id}")
-            
-            # 調用付款回調
-            if self.payment_callback:
-                await self.payment_callback(transaction_data)
-            
-        except Exception as e:
-            logger.error(f"❌ 處理 TRC-20 交易時發生錯誤: {e}")
+        
+        self.db.save_transaction(tx_id, transaction_data)
+        self.confirmations.mark_confirmed(tx_id, tx_block, confirmations)
     
     async def get_transaction_info(self, tx_id: str) -> Optional[Dict]:
         """獲取交易詳情"""
         try:
-            async with aiohttp.ClientSession() as session:
-                url = f"{self.config.TRONGRID_API_URL}/wallet/gettransactioninfobyid"
-                headers = self.config.get_trongrid_headers()
-                data = {"value": tx_id}
-                
-                async with session.post(url, json=data, headers=headers) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        logger.warning(f"⚠️ 獲取交易 {tx_id} 詳情失敗: HTTP {response.status}")
-                        return None
+            status, data = await self._request('POST', '/wallet/gettransactioninfobyid', PRIORITY_CONFIRMATION,
+                                               json={"value": tx_id})
+            if status == 200:
+                return data
+            else:
+                logger.warning(f"⚠️ 獲取交易 {tx_id} 詳情失敗: HTTP {status}")
+                return None
         except Exception as e:
             logger.error(f"❌ 獲取交易 {tx_id} 詳情時發生錯誤: {e}")
             return None
@@ -363,19 +644,11 @@ class TronMonitor:
     async def hex_to_base58(self, hex_address: str) -> str:
         """將十六進制地址轉換為 Base58 地址"""
         try:
-            # 移除 0x 前綴
-            if hex_address.startswith('0x'):
-                hex_address = hex_address[2:]
+            hex_address = normalize_hex_address(hex_address)
             
-            # 如果已經是完整的 TRON 地址格式，直接返回
+            # 只有完整的 TRON 地址才進行編碼
             if len(hex_address) == 42 and hex_address.startswith('41'):
-                # 實現簡化的 Base58 轉換 (適用於測試)
-                return await self.simple_hex_to_tron_address(hex_address)
-            
-            # 如果是40位地址，加上TRON前綴41
-            if len(hex_address) == 40:
-                hex_address = '41' + hex_address
-                return await self.simple_hex_to_tron_address(hex_address)
+                return hex_to_base58check(hex_address)
             
             # 其他情況返回原地址
             return hex_address
@@ -387,106 +660,89 @@ class TronMonitor:
     async def simple_hex_to_tron_address(self, hex_address: str) -> str:
         """簡化的十六進制到TRON地址轉換"""
         try:
-            import hashlib
-            
-            # 將十六進制轉換為字節
-            addr_bytes = bytes.fromhex(hex_address)
-            
-            # 雙重SHA256哈希用於校驗和
-            hash1 = hashlib.sha256(addr_bytes).digest()
-            hash2 = hashlib.sha256(hash1).digest()
-            
-            # 取前4字節作為校驗和
-            checksum = hash2[:4]
-            
-            # 組合地址和校驗和
-            full_address = addr_bytes + checksum
-            
-            # Base58編碼字符表
-            alphabet = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
-            
-            # 轉換為大整數
-            num = int.from_bytes(full_address, 'big')
-            
-            # Base58編碼
-            encoded = ""
-            while num > 0:
-                num, remainder = divmod(num, 58)
-                encoded = alphabet[remainder] + encoded
-            
-            # 處理前導零字節
-            for byte in full_address:
-                if byte == 0:
-                    encoded = '1' + encoded
-                else:
-                    break
-            
-            return encoded
-            
+            return hex_to_base58check(hex_address.lower())
         except Exception as e:
             logger.error(f"❌ 簡化地址轉換錯誤: {e}")
             # 如果轉換失敗，返回原始地址
             return hex_address
     
-    async def get_account_transactions(self, limit: int = 20) -> List[Dict]:
-        """獲取賬戶交易記錄"""
+    async def get_account_transactions_page(self, limit: int = 50, address: str = None,
+                                            min_timestamp: int = None,
+                                            fingerprint: str = None) -> Tuple[List[Dict], Optional[str]]:
+        """獲取一頁賬戶 TRC20 交易記錄（最新在前），返回 (交易列表, 下一頁 fingerprint)"""
         try:
-            async with aiohttp.ClientSession() as session:
-                url = f"{self.config.TRONGRID_API_URL}/v1/accounts/{self.config.USDT_ADDRESS}/transactions/trc20"
-                headers = self.config.get_trongrid_headers()
-                params = {
-                    'limit': limit,
-                    'contract_address': self.config.USDT_CONTRACT
-                }
-                
-                async with session.get(url, headers=headers, params=params) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return data.get('data', [])
-                    else:
-                        logger.error(f"❌ 獲取賬戶交易失敗: HTTP {response.status}")
-                        return []
+            address = address or self.config.USDT_ADDRESS
+            params = {
+                'limit': limit,
+                'contract_address': self.config.USDT_CONTRACT,
+                'only_to': 'true',
+                'order_by': 'block_timestamp,desc'
+            }
+            if min_timestamp:
+                params['min_timestamp'] = int(min_timestamp)
+            if fingerprint:
+                params['fingerprint'] = fingerprint
+            status, data = await self._request('GET', f"/v1/accounts/{address}/transactions/trc20",
+                                               PRIORITY_VERIFY, params=params)
+            if status == 200:
+                return data.get('data', []), (data.get('meta') or {}).get('fingerprint')
+            else:
+                logger.error(f"❌ 獲取賬戶交易失敗: HTTP {status}")
+                return [], None
         except Exception as e:
             logger.error(f"❌ 獲取賬戶交易時發生錯誤: {e}")
-            return []
+            return [], None
     
-    async def get_trx_transactions(self, limit: int = 20) -> List[Dict]:
-        """獲取 TRX 交易記錄（測試模式）"""
+    async def get_account_transactions(self, limit: int = 20, address: str = None) -> List[Dict]:
+        """獲取賬戶交易記錄"""
+        transactions, _ = await self.get_account_transactions_page(limit, address)
+        return transactions
+    
+    async def get_trx_transactions_page(self, limit: int = 50, address: str = None, min_timestamp: int = None,
+                                        start: Optional[int] = None) -> Tuple[List[Dict], Optional[int]]:
+        """獲取一頁 TRX 交易記錄（測試模式，最新在前），返回 (交易列表, 下一頁起始位置)"""
+        start = start or 0  # 第一頁的游標為 None，查詢參數不能為 None
         try:
-            async with aiohttp.ClientSession() as session:
-                url = f"{self.config.TRONGRID_API_URL}/api/transaction"
-                headers = self.config.get_trongrid_headers()
-                params = {
-                    'limit': limit,
-                    'address': self.config.USDT_ADDRESS,
-                    'start': 0,
-                    'direction': 'in'  # 只獲取轉入交易
-                }
+            params = {
+                'limit': limit,
+                'address': address or self.config.USDT_ADDRESS,
+                'start': start,
+                'sort': '-timestamp',
+                'direction': 'in'  # 只獲取轉入交易
+            }
+            if min_timestamp:
+                params['start_timestamp'] = int(min_timestamp)
+            status, data = await self._request('GET', '/api/transaction', PRIORITY_VERIFY, params=params)
+            
+            if status == 200:
+                # 處理 TronScan API 返回的交易數據
+                trx_transactions = []
+                transactions = data.get('data', [])
                 
-                async with session.get(url, headers=headers, params=params) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        # 處理 TronScan API 返回的交易數據
-                        trx_transactions = []
-                        transactions = data.get('data', [])
-                        
-                        for tx in transactions:
-                            # TronScan API 返回格式
-                            if tx.get('contractType') == 1:  # TRX 轉賬
-                                trx_transactions.append({
-                                    'transaction_id': tx.get('hash'),
-                                    'block_timestamp': tx.get('timestamp'),
-                                    'from': tx.get('ownerAddress'),
-                                    'to': tx.get('toAddress'),
-                                    'value': tx.get('amount', 0)
-                                })
-                        return trx_transactions
-                    else:
-                        logger.error(f"❌ 獲取 TRX 交易失敗: HTTP {response.status}")
-                        return []
+                for tx in transactions:
+                    # TronScan API 返回格式
+                    if tx.get('contractType') == 1:  # TRX 轉賬
+                        trx_transactions.append({
+                            'transaction_id': tx.get('hash'),
+                            'block_timestamp': tx.get('timestamp'),
+                            'from': tx.get('ownerAddress'),
+                            'to': tx.get('toAddress'),
+                            'value': tx.get('amount', 0)
+                        })
+                # 返回條數不足一頁時已到末尾
+                next_start = start + len(transactions) if len(transactions) >= limit else None
+                return trx_transactions, next_start
+            else:
+                logger.error(f"❌ 獲取 TRX 交易失敗: HTTP {status}")
+                return [], None
         except Exception as e:
             logger.error(f"❌ 獲取 TRX 交易時發生錯誤: {e}")
-            return []
+            return [], None
+    
+    async def get_trx_transactions(self, limit: int = 20, address: str = None) -> List[Dict]:
+        """獲取 TRX 交易記錄（測試模式）"""
+        transactions, _ = await self.get_trx_transactions_page(limit, address)
+        return transactions
     
     async def verify_payment(self, amount: float, max_age_minutes: int = 30) -> Optional[Dict]:
         """驗證指定金額的付款"""
@@ -502,38 +758,77 @@ class TronMonitor:
             logger.error(f"❌ 驗證付款時發生錯誤: {e}")
             return None
     
+    async def get_recent_payments(self, address: str = None, max_age_minutes: int = 30,
+                                  limit: int = 50) -> List[Dict]:
+        """獲取地址在時間窗口內收到的全部付款（逐頁查詢直到早於窗口，供多個訂單共用）"""
+        address = address or self.config.USDT_ADDRESS
+        
+        if self.test_mode:
+            # 測試模式：TRX 交易
+            fetch_page = self.get_trx_transactions_page
+            currency = 'TRX'
+        else:
+            # 生產模式：USDT 交易
+            fetch_page = self.get_account_transactions_page
+            currency = 'USDT'
+        
+        cutoff_ms = (time.time() - max_age_minutes * 60) * 1000  # 轉換為毫秒
+        transactions = []
+        cursor = None
+        for _ in range(self.MAX_PAYMENT_PAGES):
+            page, cursor = await fetch_page(limit, address, cutoff_ms, cursor)
+            transactions.extend(page)
+            # 沒有下一頁，或本頁已早於時間窗口（服務端未按時間過濾時）
+            if cursor is None or not page or min(tx.get('block_timestamp', 0) for tx in page) < cutoff_ms:
+                break
+        else:
+            logger.warning(f"⚠️ 地址 {address} 的付款超過 {self.MAX_PAYMENT_PAGES} 頁，更早的付款本輪未查詢")
+        
+        payments = []
+        seen = set()
+        
+        for tx in transactions:
+            # 檢查交易時間
+            tx_time = tx.get('block_timestamp', 0)
+            if tx_time < cutoff_ms:
+                continue
+            
+            # 翻頁期間有新交易時，同一筆交易可能出現在相鄰兩頁
+            tx_hash = tx.get('transaction_id')
+            if tx_hash in seen:
+                continue
+            seen.add(tx_hash)
+            
+            # 檢查交易方向（收款）
+            if tx.get('to') != address:
+                continue
+            
+            payments.append({
+                'tx_hash': tx.get('transaction_id'),
+                'amount': float(tx.get('value', 0)) / 1_000_000,  # sun / 最小單位轉換
+                'currency': currency,
+                'from_address': tx.get('from'),
+                'to_address': address,
+                'timestamp': tx_time,
+                'confirmations': 'confirmed'  # 賬戶交易接口返回的交易都是已確認的
+            })
+        
+        return payments
+    
+    @staticmethod
+    def match_payment(payments: List[Dict], amount: float) -> Optional[Dict]:
+        """在付款列表中查找指定金額的付款（按最小單位精確匹配）"""
+        units = amount_to_units(amount)
+        for payment in payments:
+            if amount_to_units(payment['amount']) == units:
+                return payment
+        return None
+    
     async def verify_trx_payment(self, amount: float, max_age_minutes: int = 30) -> Optional[Dict]:
         """驗證 TRX 付款（測試模式）"""
         try:
-            # 獲取 TRX 交易記錄
-            transactions = await self.get_trx_transactions(50)
-            
-            current_time = time.time() * 1000  # 轉換為毫秒
-            max_age_ms = max_age_minutes * 60 * 1000
-            
-            for tx in transactions:
-                # 檢查交易時間
-                tx_time = tx.get('block_timestamp', 0)
-                if current_time - tx_time > max_age_ms:
-                    continue
-                
-                # 檢查交易方向（收款）
-                if tx.get('to') != self.config.USDT_ADDRESS:
-                    continue
-                
-                # 檢查金額（TRX 以 sun 為單位）
-                tx_amount = float(tx.get('value', 0)) / 1_000_000  # 轉換為 TRX
-                if abs(tx_amount - amount) < 0.001:  # 允許小額誤差
-                    return {
-                        'tx_hash': tx.get('transaction_id'),
-                        'amount': tx_amount,
-                        'currency': 'TRX',
-                        'from_address': tx.get('from'),
-                        'timestamp': tx_time,
-                        'confirmations': 'confirmed'
-                    }
-            
-            return None
+            payments = await self.get_recent_payments(max_age_minutes=max_age_minutes)
+            return self.match_payment(payments, amount)
             
         except Exception as e:
             logger.error(f"❌ 驗證 TRX 付款時發生錯誤: {e}")
@@ -542,35 +837,9 @@ class TronMonitor:
     async def verify_usdt_payment(self, amount: float, max_age_minutes: int = 30) -> Optional[Dict]:
         """驗證 USDT 付款（生產模式）"""
         try:
-            transactions = await self.get_account_transactions(50)
-            
-            current_time = time.time() * 1000  # 轉換為毫秒
-            max_age_ms = max_age_minutes * 60 * 1000
-            
-            for tx in transactions:
-                # 檢查交易時間
-                tx_time = tx.get('block_timestamp', 0)
-                if current_time - tx_time > max_age_ms:
-                    continue
-                
-                # 檢查交易方向（收款）
-                if tx.get('to') != self.config.USDT_ADDRESS:
-                    continue
-                
-                # 檢查金額
-                tx_amount = float(tx.get('value', 0)) / 1_000_000  # 轉換為 USDT
-                if abs(tx_amount - amount) < 0.01:  # 允許小額誤差
-                    return {
-                        'tx_hash': tx.get('transaction_id'),
-                        'amount': tx_amount,
-                        'currency': 'USDT',
-                        'from_address': tx.get('from'),
-                        'timestamp': tx_time,
-                        'confirmations': 'confirmed'  # TronGrid API 返回的交易都是已確認的
-                    }
-            
-            return None
+            payments = await self.get_recent_payments(max_age_minutes=max_age_minutes)
+            return self.match_payment(payments, amount)
             
         except Exception as e:
             logger.error(f"❌ 驗證 USDT 付款時發生錯誤: {e}")
-            return None
\ No newline at end of file
+            return None
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+更新處理器模塊 - 並發處理不同用戶的更新，同一用戶的更新按到達順序串行處理
+
+同一用戶連續點擊（例如重複點擊「購買」）時，第二次點擊在第一次處理完成後才開始，
+不會與之競爭；不同用戶之間互不阻塞。
+"""
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from bot_executor import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """按用戶保序的並發更新處理器
+
+    max_workers: 同時執行處理器的更新數（工作池大小）
+    max_pending: 已接收但未完成的更新上限（包括等待同一用戶前序更新的）
+    """
+
+    def __init__(self, max_workers: int = 32, max_pending: int = 1024):
+        super().__init__(max(max_pending, max_workers))
+        self.max_workers = max_workers
+        self._workers: Optional[asyncio.Semaphore] = None
+        # {用戶: [鎖, 引用數]}，用戶沒有待處理更新時移除
+        self._user_locks: Dict[Hashable, list] = {}
+
+        self.active = 0
+        self.peak_active = 0
+        self.queue_wait = LatencyStats()
+        self.stats = {
+            'processed': 0,
+            'waited_for_same_user': 0
+        }
+
+    async def initialize(self) -> None:
+        self._workers = asyncio.Semaphore(self.max_workers)
+
+    async def shutdown(self) -> None:
+        pass
+
+    @staticmethod
+    def _order_key(update: object) -> Optional[Hashable]:
+        """保序鍵：用戶 ID，沒有用戶時使用聊天 ID"""
+        if isinstance(update, Update):
+            if update.effective_user:
+                return ('user', update.effective_user.id)
+            if update.effective_chat:
+                return ('chat', update.effective_chat.id)
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        if self._workers is None:
+            await self.initialize()
+
+        received_at = time.perf_counter()
+        key = self._order_key(update)
+        if key is None:
+            async with self._workers:
+                await self._run(coroutine, received_at)
+            return
+
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        lock = entry[0]
+        try:
+            if lock.locked():
+                self.stats['waited_for_same_user'] += 1
+            # 先按用戶排隊再佔用工作槽，等待前序更新時不佔用工作池
+            async with lock:
+                async with self._workers:
+                    await self._run(coroutine, received_at)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[key]
+
+    async def _run(self, coroutine: Awaitable, received_at: float):
+        self.queue_wait.record(time.perf_counter() - received_at)
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        try:
+            await coroutine
+        finally:
+            self.active -= 1
+            self.stats['processed'] += 1
+
+    def get_metrics(self) -> Dict:
+        """處理器指標"""
+        return {
+            'max_workers': self.max_workers,
+            'active': self.active,
+            'peak_active': self.peak_active,
+            'users_pending': len(self._user_locks),
+            'queue_wait': self.queue_wait.to_dict(),
+            **self.stats
+        }
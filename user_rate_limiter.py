@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+用戶速率限制模塊 - GCRA（通用信元速率算法），每個用戶每個窗口只保存一個時間戳
+
+理論到達時間（TAT）已過去的用戶狀態與新用戶完全相同，可以無損淘汰，
+因此內存只與最近活躍的用戶數相關，不隨歷史用戶總數增長。
+"""
+
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+
+class GcraRateLimiter:
+    """多窗口 GCRA 速率限制器"""
+
+    SWEEP_EVERY = 1000  # 每處理多少次請求清理一次空閒用戶
+
+    def __init__(self, limits: List[Tuple[str, float, int]], max_keys: int = 100_000):
+        """
+        limits: [(窗口名稱, 窗口秒數, 窗口內最多請求數)]，例如 [('minute', 60, 20), ('hour', 3600, 100)]
+        max_keys: 追蹤用戶數上限，超過時淘汰最久未活動的用戶
+        """
+        self.limits = [(name, period, period / limit) for name, period, limit in limits]
+        self.max_keys = max_keys
+
+        # {key: [每個窗口的 TAT]}，按最近訪問排序
+        self.states: OrderedDict = OrderedDict()
+        self._requests_since_sweep = 0
+
+        self.stats = {
+            'allowed': 0,
+            'evicted_idle': 0,
+            'evicted_capacity': 0,
+            'rejected': {name: 0 for name, _, _ in limits}
+        }
+
+    def hit(self, key: Hashable, now: float = None) -> Optional[str]:
+        """記錄一次請求；允許時返回 None，否則返回觸發限制的窗口名稱（被拒請求不計數）"""
+        now = time.monotonic() if now is None else now
+
+        tats = self.states.get(key)
+        new_tats = []
+        for index, (name, period, interval) in enumerate(self.limits):
+            tat = max(tats[index], now) if tats else now
+            new_tat = tat + interval
+            # 窗口內允許的突發量即為窗口限額
+            if new_tat - now > period:
+                self.stats['rejected'][name] += 1
+                return name
+            new_tats.append(new_tat)
+
+        self.states[key] = new_tats
+        self.states.move_to_end(key)
+        self.stats['allowed'] += 1
+
+        self._requests_since_sweep += 1
+        if self._requests_since_sweep >= self.SWEEP_EVERY or len(self.states) > self.max_keys:
+            self._sweep(now)
+        return None
+
+    def _sweep(self, now: float):
+        """淘汰空閒用戶，超出上限時再淘汰最久未活動的用戶"""
+        self._requests_since_sweep = 0
+
+        # 按訪問順序從最舊開始，TAT 全部已過去的狀態可無損刪除
+        while self.states:
+            key, tats = next(iter(self.states.items()))
+            if max(tats) > now:
+                break
+            self.states.popitem(last=False)
+            self.stats['evicted_idle'] += 1
+
+        while len(self.states) > self.max_keys:
+            self.states.popitem(last=False)
+            self.stats['evicted_capacity'] += 1
+
+    def get_stats(self) -> Dict:
+        return {
+            'tracked_keys': len(self.states),
+            'allowed': self.stats['allowed'],
+            'evicted_idle': self.stats['evicted_idle'],
+            'evicted_capacity': self.stats['evicted_capacity'],
+            'rejected': dict(self.stats['rejected'])
+        }
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+用戶會話緩存模塊 - 緩存每個用戶的訂單、待付款訂單、試用狀態和激活碼，按鈕操作不再重新查詢
+
+- 數據庫寫入時通過寫入監聽器使對應用戶的會話失效，下次訪問時從數據庫的用戶索引重新加載
+- 按最近訪問淘汰，只保留活躍用戶
+- 加載期間發生寫入時不緩存加載結果，避免緩存舊數據
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+class UserSession:
+    """單個用戶的會話數據"""
+
+    __slots__ = ('user_id', 'orders', 'pending_order', 'trial_used', 'activation_codes', 'code_by_order')
+
+    def __init__(self, user_id: int, orders: List[Dict], trial_used: bool, activation_codes: List[Dict]):
+        self.user_id = user_id
+        self.orders = orders  # 按創建時間倒序
+        self.pending_order: Optional[Dict] = next((order for order in orders if order['status'] == 'pending'), None)
+        self.trial_used = trial_used
+        self.activation_codes = activation_codes
+        self.code_by_order = {code['order_id']: code['activation_code']
+                              for code in activation_codes if code.get('order_id')}
+
+class UserSessionCache:
+    """用戶會話緩存（LRU）"""
+
+    def __init__(self, db, max_users: int = 10_000):
+        self.db = db
+        self.max_users = max_users
+        self.sessions: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self._generation = 0  # 每次失效遞增，加載前後不一致時放棄緩存
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'invalidations': 0,
+            'evictions': 0
+        }
+        db.add_write_listener(self.invalidate)
+
+    def get(self, user_id: int) -> UserSession:
+        """獲取用戶會話，未緩存時從數據庫索引加載（只讀取該用戶的數據）"""
+        with self.lock:
+            session = self.sessions.get(user_id)
+            if session is not None:
+                self.sessions.move_to_end(user_id)
+                self.stats['hits'] += 1
+                return session
+            self.stats['misses'] += 1
+            generation = self._generation
+
+        session = UserSession(
+            user_id,
+            self.db.get_user_orders(user_id),
+            self.db.has_used_trial(user_id),
+            self.db.get_user_activation_codes(user_id)
+        )
+
+        with self.lock:
+            if generation == self._generation:
+                self.sessions[user_id] = session
+                if len(self.sessions) > self.max_users:
+                    self.sessions.popitem(last=False)
+                    self.stats['evictions'] += 1
+        return session
+
+    def invalidate(self, user_id: int):
+        """使用戶會話失效（數據庫寫入監聽器，在寫入線程中調用）"""
+        with self.lock:
+            self._generation += 1
+            if self.sessions.pop(user_id, None) is not None:
+                self.stats['invalidations'] += 1
+
+    def get_stats(self) -> Dict:
+        lookups = self.stats['hits'] + self.stats['misses']
+        return {
+            'cached_users': len(self.sessions),
+            'hit_rate': round(self.stats['hits'] / lookups, 3) if lookups else 0.0,
+            **self.stats
+        }
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Webhook 模塊 - 用 aiohttp 接收 Telegram 推送的更新，替代長輪詢
+
+- 校驗 X-Telegram-Bot-Api-Secret-Token，拒絕偽造請求
+- 更新處理完成後才返回 200；處理失敗或正在關閉時返回錯誤碼，由 Telegram 稍後重發
+- 同時處理的更新數有上限，超出時請求排隊等待（Telegram 端 max_connections 也設為同一值）
+- 關閉時先停止接收新更新，等待處理中的更新完成；不刪除 webhook，部署期間的更新由 Telegram 保留
+"""
+
+import asyncio
+import hmac
+import json
+import logging
+import signal
+from typing import Optional
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+class WebhookServer:
+    """Telegram webhook 服務"""
+
+    def __init__(self, application: Application, secret_token: str, listen: str = '0.0.0.0', port: int = 8443,
+                 url_path: str = 'webhook', max_connections: int = 40, drain_timeout: float = 25.0):
+        if not secret_token:
+            raise ValueError("webhook 模式必須設置 secret token")
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.url_path = url_path.strip('/')
+        self.secret_token = secret_token
+        self.max_connections = max_connections
+        self.drain_timeout = drain_timeout
+
+        self.semaphore = asyncio.Semaphore(max_connections)
+        self.in_flight = 0
+        self.draining = False
+        self._idle_event = asyncio.Event()
+        self._idle_event.set()
+        self._runner: Optional[web.AppRunner] = None
+
+        self.stats = {
+            'received': 0,
+            'processed': 0,
+            'rejected_secret': 0,
+            'rejected_draining': 0,
+            'errors': 0
+        }
+
+    def _build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(f"/{self.url_path}", self.handle_update)
+        app.router.add_get('/healthz', self.handle_health)
+        return app
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        """接收一個更新並處理完成後返回"""
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret_token):
+            self.stats['rejected_secret'] += 1
+            logger.warning(f"⚠️ 拒絕 secret token 不匹配的 webhook 請求: {request.remote}")
+            return web.Response(status=403)
+
+        if self.draining:
+            # 返回錯誤碼讓 Telegram 稍後重發給新實例
+            self.stats['rejected_draining'] += 1
+            return web.Response(status=503)
+
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.application.bot)
+        except (json.JSONDecodeError, ValueError, TypeError, KeyError) as e:
+            logger.warning(f"⚠️ 無效的 webhook 更新: {e}")
+            return web.Response(status=400)
+
+        self.stats['received'] += 1
+        self.in_flight += 1
+        self._idle_event.clear()
+        try:
+            async with self.semaphore:
+                await self.application.update_processor.process_update(
+                    update, self.application.process_update(update)
+                )
+            self.stats['processed'] += 1
+            return web.Response(status=200)
+        except Exception as e:
+            # 處理器內部異常已由 Application 的錯誤處理器處理，這裡只兜底
+            self.stats['errors'] += 1
+            logger.error(f"❌ 處理 webhook 更新失敗: {e}")
+            return web.Response(status=500)
+        finally:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self._idle_event.set()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            'status': 'draining' if self.draining else 'ok',
+            'in_flight': self.in_flight,
+            **self.stats
+        })
+
+    async def start(self):
+        """啟動 HTTP 服務"""
+        self._runner = web.AppRunner(self._build_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.listen, self.port)
+        await site.start()
+        logger.info(f"🌐 Webhook 服務已啟動: http://{self.listen}:{self.port}/{self.url_path}")
+
+    async def drain(self):
+        """停止接收新更新，等待處理中的更新完成"""
+        self.draining = True
+        if self.in_flight:
+            logger.info(f"⏳ 等待 {self.in_flight} 個處理中的更新完成...")
+        try:
+            await asyncio.wait_for(self._idle_event.wait(), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ 等待超時，仍有 {self.in_flight} 個更新未完成")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+async def run_webhook(application: Application, server: WebhookServer, webhook_url: Optional[str] = None):
+    """以 webhook 模式運行 Application，收到 SIGINT/SIGTERM 後平滑關閉
+
+    webhook_url 為空時不向 Telegram 註冊（本地測試，可直接 POST 模擬更新）
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # Windows 不支持，依靠 KeyboardInterrupt
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+
+        await application.start()
+        await server.start()
+
+        if webhook_url:
+            # 不丟棄待處理更新：重啟期間 Telegram 保留的更新會在註冊後推送過來
+            await application.bot.set_webhook(
+                url=f"{webhook_url.rstrip('/')}/{server.url_path}",
+                secret_token=server.secret_token,
+                max_connections=server.max_connections,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=False
+            )
+            logger.info(f"✅ 已向 Telegram 註冊 webhook: {webhook_url}")
+        else:
+            logger.info("ℹ️ 未設置 WEBHOOK_URL，不註冊 webhook（本地測試模式）")
+
+        await stop_event.wait()
+        logger.info("🛑 收到停止信號，開始平滑關閉...")
+        await server.drain()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)